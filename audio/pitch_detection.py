@@ -4,19 +4,21 @@ import wave
 from datetime import datetime
 from multiprocessing import Queue
 
-import aubio
-import crepe
 import numpy as np
-import pyaudio
-from scipy.io import wavfile
 
-FORMAT = pyaudio.paInt16  # 數據格式
+# aubio, crepe (and so TensorFlow), pyaudio, scipy and demucs are imported by the functions
+# using them, so that importing this module, e.g. in the processes spawned by `main.py`,
+# stays cheap.
 CHANNELS = 1  # 單聲道
 RATE = 16000  # 採樣率
 CHUNK = 1024  # 每次讀取的數據塊大小
+CREPE_RATE = 16000  # CREPE 模型的採樣率
 
 
 def YIN_realtime_pitch_detection(store_place: Queue, stop_signal):
+    import aubio
+    import pyaudio
+
     # Save the recorded audio
     frames = []
 
@@ -67,23 +69,39 @@ def YIN_realtime_pitch_detection(store_place: Queue, stop_signal):
     dt_string = now.strftime("%Y%m%d%H%M%S")
     wf = wave.open(f"recorded_audio/{dt_string}.wav", 'wb')
     wf.setnchannels(CHANNELS)
-    wf.setsampwidth(p.get_sample_size(FORMAT))
+    wf.setsampwidth(p.get_sample_size(pyaudio.paInt16))
     wf.setframerate(RATE)
     wf.writeframes(b''.join(frames))
     wf.close()
 
 
 def pitch_detection(audio_file: str):
+    import crepe
+    import torch
+    from scipy.io import wavfile
+
+    from demucs.audio import get_resampler
+
     # Load the audio file
     sr, x = wavfile.read(audio_file)
 
+    # Resample to the samplerate of CREPE with the cached resampler of demucs,
+    # instead of letting CREPE do it with resampy.
+    x = x.astype(np.float32)
+    if x.ndim == 2:
+        x = x.mean(1)
+    x = get_resampler(sr, CREPE_RATE)(torch.from_numpy(x)).numpy()
+
     # Get the pitch
-    time, frequency, confidence, activation = crepe.predict(x, sr, viterbi=True)
+    time, frequency, confidence, activation = crepe.predict(x, CREPE_RATE, viterbi=True)
 
     return time, frequency, confidence, activation
 
 
 def realtime_pitch_detection(store_place: Queue, stop_signal):
+    import crepe
+    import pyaudio
+
     # Save the recorded audio
     frames = []
 
@@ -141,7 +159,7 @@ def realtime_pitch_detection(store_place: Queue, stop_signal):
     dt_string = now.strftime("%Y%m%d%H%M%S")
     wf = wave.open(f"recorded_audio/{dt_string}.wav", 'wb')
     wf.setnchannels(CHANNELS)
-    wf.setsampwidth(p.get_sample_size(FORMAT))
+    wf.setsampwidth(p.get_sample_size(pyaudio.paInt16))
     wf.setframerate(RATE)
     wf.writeframes(b''.join(frames))
     wf.close()
\ No newline at end of file
@@ -1,10 +1,10 @@
 import time
 import wave
 
-import pyaudio
-
 
 def play_audio(filename: str, stop_signal, start_time_conn):
+    import pyaudio
+
     # Load file.
     wf = wave.open(filename, 'rb')
 
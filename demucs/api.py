@@ -13,6 +13,7 @@ Classes
 Functions
 ---------
 `demucs.api.save_audio`: Save an audio
+`demucs.api.save_stems`: Save several audios concurrently
 `demucs.api.list_models`: Get models list
 
 Examples
@@ -20,18 +21,28 @@ Examples
 See the end of this module (if __name__ == "__main__")
 """
 
+import hashlib
+import json
 import subprocess
 from pathlib import Path
-from typing import Callable, Dict, Optional, Tuple, Union
+from typing import Callable, Dict, List, Optional, Tuple, Union
 
 import torch as th
-import torchaudio as ta
-from dora.log import fatal
 
-from .apply import _replace_dict, apply_model
-from .audio import AudioFile, convert_audio, save_audio
-from .pretrained import REMOTE_ROOT, _parse_remote_files, get_model
+from .apply import PRECISIONS, _replace_dict, apply_model
+from .audio import AudioFile, AudioOutput, convert_audio, save_audio, save_stems  # noqa
+from .autotune import Plan, autotune
+from .demucs import fuse_dconv, set_blstm_max_batch
+from .hdemucs import set_multiwrap_workers
+from .pretrained import REMOTE_ROOT, _parse_remote_files, get_model, get_store
+from .quantize import quantize_int8
 from .repo import BagOnlyRepo, LocalRepo, ModelOnlyRepo, RemoteRepo
+from .states import model_signature
+from .transformer import set_attention_backend
+
+
+BACKENDS = ["torch", "onnx"]
+SEPARATOR_PRECISIONS = list(PRECISIONS) + ["int8"]
 
 
 class LoadAudioError(Exception):
@@ -59,10 +70,21 @@ class Separator:
         overlap: float = 0.25,
         split: bool = True,
         segment: Optional[int] = None,
-        jobs: int = 0,
+        jobs: Optional[int] = None,
         progress: bool = False,
         callback: Optional[Callable[[dict], None]] = None,
         callback_arg: Optional[dict] = None,
+        stems: Optional[List[str]] = None,
+        shift_mode: str = "random",
+        shift_seed: Optional[int] = None,
+        autotune: bool = True,
+        memory_budget: Optional[float] = None,
+        precision: str = "fp32",
+        attention_backend: str = "auto",
+        backend: str = "torch",
+        blstm_max_batch: Optional[int] = None,
+        fuse: bool = False,
+        multiwrap_workers: Optional[int] = None,
     ):
         """
         `class Separator`
@@ -78,6 +100,10 @@ class Separator:
             apply the oppositve shift to the output. This is repeated `shifts` time and all \
             predictions are averaged. This effectively makes the model time equivariant and \
             improves SDR by up to 0.2 points. If not specified, will use the command line option.
+        shift_mode: How the shifts are chosen, either "random" or "even" (evenly spaced shifts). \
+            With "even" or with a `shift_seed`, the output is reproducible and all the shifted \
+            copies of a segment are separated as a single batch.
+        shift_seed: Seed for the random shifts.
         split: If True, the input will be broken down into small chunks (length set by `segment`) \
             and predictions will be performed individually on each and concatenated. Useful for \
             model with large memory footprint like Tasnet. If not specified, will use the command \
@@ -89,13 +115,46 @@ class Separator:
             `wav.device`, only local computations will be on `device`, while the entire tracks \
             will be stored on `wav.device`. If not specified, will use the command line option.
         jobs: Number of jobs. This can increase memory usage but will be much faster when \
-            multiple cores are available. If not specified, will use the command line option.
+            multiple cores are available. If None, picked by the autotuner, or 0 when not \
+            autotuning.
         callback: A function will be called when the separation of a chunk starts or finished. \
             The argument passed to the function will be a dict. For more information, please see \
             the Callback section.
         callback_arg: A dict containing private parameters to be passed to callback function. For \
             more information, please see the Callback section.
         progress: If true, show a progress bar.
+        stems: If provided, only separate those stems. For a bag of models, the sub-models \
+            which do not contribute to any of these stems are skipped.
+        autotune: If true and `segment` is not given, the segment, overlap, batch size and \
+            number of jobs (unless given) are picked by benchmarking a few candidates the first \
+            time something is separated. The result is cached per model and host. \
+            See `demucs.autotune`.
+        memory_budget: Maximum memory (in GB) used for the separation when autotuning.
+        precision: Inference precision, "fp32", "bf16" (autocast, e.g. on CPUs with bfloat16 \
+            support), "fp16" (CUDA only) or "int8" (CPU only, linear layers quantized \
+            dynamically, and convolutions quantized statically after calling `calibrate`, \
+            see `demucs.quantize`). The STFT, Wiener filtering and normalization always \
+            run in float32.
+        attention_backend: Implementation of the sparse attention layers of transformer models, \
+            "xformers", "sdpa" (pure PyTorch, using `scaled_dot_product_attention`) or "auto" \
+            (xformers if installed). This is applied when loading the model.
+        backend: Inference backend, "torch" or "onnx". With "onnx", the model (which must be \
+            made of `HTDemucs` models) is exported to ONNX the first time it is used, in the \
+            `demucs_onnx` folder of the torch hub folder, then run on CPU with ONNX Runtime, \
+            without loading it with PyTorch. Requires `onnx` and `onnxruntime`, and only \
+            supports the "fp32" precision. See `demucs.onnx_backend`.
+        blstm_max_batch: For models with BLSTM layers splitting their input (`demucs` and \
+            `mdx` models), maximum number of chunks given to the LSTM at once, so that its \
+            memory usage no longer grows with the segment. The output is unchanged. None to \
+            process all the chunks at once. This is applied when loading the model.
+        fuse: If true, the residual branches of the model are replaced with their inference \
+            only version, `demucs.demucs.FusedDConv`, which is faster on CPU and gives the same \
+            output. CPU only, with the "fp32" or "int8" precision. This is applied when loading \
+            the model.
+        multiwrap_workers: For models with frequency bands processed by separate layers \
+            (`hdemucs` models trained with `multi_freqs`), number of threads processing the \
+            bands concurrently. The output is unchanged. None or 0 to process them one after \
+            the other. This is applied when loading the model.
 
         Callback
         --------
@@ -105,20 +164,33 @@ class Separator:
         To abort the separation, raise `KeyboardInterrupt`.
 
         Progress information contains several keys (These keys will always exist):
-        - `model_idx_in_bag`: The index of the submodel in `BagOfModels`. Starts from 0.
+        - `model_idx_in_bag`: The index of the submodel in `BagOfModels`, among the ones
+            run for the requested sources. Starts from 0.
         - `shift_idx`: The index of shifts. Starts from 0.
         - `segment_offset`: The offset of current segment. If the number is 441000, it doesn't
             mean that it is at the 441000 second of the audio, but the "frame" of the tensor.
         - `state`: Could be `"start"` or `"end"`.
         - `audio_length`: Length of the audio (in "frame" of the tensor).
-        - `models`: Count of submodels in the model.
+        - `models`: Count of submodels in the model run for the requested sources.
         """
         self._name = model
         self._repo = repo
+        self._attention_backend = attention_backend
+        if backend not in BACKENDS:
+            raise ValueError(f"Invalid backend {backend}, must be one of {', '.join(BACKENDS)}.")
+        if backend == "onnx" and (fuse or blstm_max_batch is not None or multiwrap_workers):
+            raise ValueError("fuse, blstm_max_batch and multiwrap_workers are not supported "
+                             "by the onnx backend.")
+        self._backend = backend
+        self._blstm_max_batch = blstm_max_batch
+        self._fuse = fuse
+        self._multiwrap_workers = multiwrap_workers
         self._load_model()
         self.update_parameter(device=device, shifts=shifts, overlap=overlap, split=split,
                               segment=segment, jobs=jobs, progress=progress, callback=callback,
-                              callback_arg=callback_arg)
+                              callback_arg=callback_arg, stems=stems, shift_mode=shift_mode,
+                              shift_seed=shift_seed, autotune=autotune,
+                              memory_budget=memory_budget, precision=precision)
 
     def update_parameter(
         self,
@@ -127,12 +199,18 @@ class Separator:
         overlap: Union[float, _NotProvided] = NotProvided,
         split: Union[bool, _NotProvided] = NotProvided,
         segment: Optional[Union[int, _NotProvided]] = NotProvided,
-        jobs: Union[int, _NotProvided] = NotProvided,
+        jobs: Optional[Union[int, _NotProvided]] = NotProvided,
         progress: Union[bool, _NotProvided] = NotProvided,
         callback: Optional[
             Union[Callable[[dict], None], _NotProvided]
         ] = NotProvided,
         callback_arg: Optional[Union[dict, _NotProvided]] = NotProvided,
+        stems: Optional[Union[List[str], _NotProvided]] = NotProvided,
+        shift_mode: Union[str, _NotProvided] = NotProvided,
+        shift_seed: Optional[Union[int, _NotProvided]] = NotProvided,
+        autotune: Union[bool, _NotProvided] = NotProvided,
+        memory_budget: Optional[Union[float, _NotProvided]] = NotProvided,
+        precision: Union[str, _NotProvided] = NotProvided,
     ):
         """
         Update the parameters of separation.
@@ -145,6 +223,10 @@ class Separator:
             apply the oppositve shift to the output. This is repeated `shifts` time and all \
             predictions are averaged. This effectively makes the model time equivariant and \
             improves SDR by up to 0.2 points. If not specified, will use the command line option.
+        shift_mode: How the shifts are chosen, either "random" or "even" (evenly spaced shifts). \
+            With "even" or with a `shift_seed`, the output is reproducible and all the shifted \
+            copies of a segment are separated as a single batch.
+        shift_seed: Seed for the random shifts.
         split: If True, the input will be broken down into small chunks (length set by `segment`) \
             and predictions will be performed individually on each and concatenated. Useful for \
             model with large memory footprint like Tasnet. If not specified, will use the command \
@@ -156,13 +238,26 @@ class Separator:
             `wav.device`, only local computations will be on `device`, while the entire tracks \
             will be stored on `wav.device`. If not specified, will use the command line option.
         jobs: Number of jobs. This can increase memory usage but will be much faster when \
-            multiple cores are available. If not specified, will use the command line option.
+            multiple cores are available. If None, picked by the autotuner, or 0 when not \
+            autotuning.
         callback: A function will be called when the separation of a chunk starts or finished. \
             The argument passed to the function will be a dict. For more information, please see \
             the Callback section.
         callback_arg: A dict containing private parameters to be passed to callback function. For \
             more information, please see the Callback section.
         progress: If true, show a progress bar.
+        stems: If provided, only separate those stems. For a bag of models, the sub-models \
+            which do not contribute to any of these stems are skipped.
+        autotune: If true and `segment` is not given, the segment, overlap, batch size and \
+            number of jobs (unless given) are picked by benchmarking a few candidates the first \
+            time something is separated. The result is cached per model and host. \
+            See `demucs.autotune`.
+        memory_budget: Maximum memory (in GB) used for the separation when autotuning.
+        precision: Inference precision, "fp32", "bf16" (autocast, e.g. on CPUs with bfloat16 \
+            support), "fp16" (CUDA only) or "int8" (CPU only, linear layers quantized \
+            dynamically, and convolutions quantized statically after calling `calibrate`, \
+            see `demucs.quantize`). The STFT, Wiener filtering and normalization always \
+            run in float32.
 
         Callback
         --------
@@ -172,13 +267,14 @@ class Separator:
         To abort the separation, raise `KeyboardInterrupt`.
 
         Progress information contains several keys (These keys will always exist):
-        - `model_idx_in_bag`: The index of the submodel in `BagOfModels`. Starts from 0.
+        - `model_idx_in_bag`: The index of the submodel in `BagOfModels`, among the ones
+            run for the requested sources. Starts from 0.
         - `shift_idx`: The index of shifts. Starts from 0.
         - `segment_offset`: The offset of current segment. If the number is 441000, it doesn't
             mean that it is at the 441000 second of the audio, but the "frame" of the tensor.
         - `state`: Could be `"start"` or `"end"`.
         - `audio_length`: Length of the audio (in "frame" of the tensor).
-        - `models`: Count of submodels in the model.
+        - `models`: Count of submodels in the model run for the requested sources.
         """
         if not isinstance(device, _NotProvided):
             self._device = device
@@ -198,13 +294,109 @@ class Separator:
             self._callback = callback
         if not isinstance(callback_arg, _NotProvided):
             self._callback_arg = callback_arg
+        if not isinstance(stems, _NotProvided):
+            if stems is not None:
+                for stem in stems:
+                    if stem not in self._model.sources:
+                        raise ValueError(f"Unknown stem {stem}, "
+                                         f"model stems are {', '.join(self._model.sources)}.")
+            self._stems = stems
+        if not isinstance(shift_mode, _NotProvided):
+            self._shift_mode = shift_mode
+        if not isinstance(shift_seed, _NotProvided):
+            self._shift_seed = shift_seed
+        if not isinstance(autotune, _NotProvided):
+            self._autotune = autotune
+        if not isinstance(memory_budget, _NotProvided):
+            self._memory_budget = memory_budget
+        if not isinstance(precision, _NotProvided):
+            if precision not in SEPARATOR_PRECISIONS:
+                raise ValueError(f"Invalid precision {precision}, "
+                                 f"must be one of {', '.join(SEPARATOR_PRECISIONS)}.")
+            if self._backend == "onnx" and precision != "fp32":
+                raise ValueError("The onnx backend only supports the fp32 precision.")
+            self._precision = precision
+        if self._precision == "int8" and th.device(self._device).type != "cpu":
+            raise ValueError("The int8 precision is only supported on CPU.")
+        if self._fuse:
+            if th.device(self._device).type != "cpu":
+                raise ValueError("fuse is only supported on CPU.")
+            if self._precision not in ["fp32", "int8"]:
+                raise ValueError("fuse only supports the fp32 and int8 precisions.")
+        # Any change might invalidate the tuned plan.
+        self._plan: Optional[Plan] = None
 
     def _load_model(self):
-        self._model = get_model(name=self._name, repo=self._repo)
-        if self._model is None:
-            raise LoadModelError("Failed to load model")
+        if self._backend == "onnx":
+            self._load_onnx_model()
+        else:
+            self._model = get_model(name=self._name, repo=self._repo)
+            if self._model is None:
+                raise LoadModelError("Failed to load model")
+            set_attention_backend(self._model, self._attention_backend)
+            if self._blstm_max_batch is not None:
+                set_blstm_max_batch(self._model, self._blstm_max_batch)
+            if self._fuse:
+                fuse_dconv(self._model)
+            if self._multiwrap_workers:
+                set_multiwrap_workers(self._model, self._multiwrap_workers)
         self._audio_channels = self._model.audio_channels
         self._samplerate = self._model.samplerate
+        self._int8_model = None
+
+    def _load_onnx_model(self):
+        from .onnx_backend import export_onnx, has_onnx, load_onnx
+
+        model = None
+        key = _checkpoints_key(self._name, self._repo)
+        if key is None:
+            model = get_model(name=self._name, repo=self._repo)
+            if model is None:
+                raise LoadModelError("Failed to load model")
+            key = model_signature(model)
+        folder = Path(th.hub.get_dir()) / "demucs_onnx" / f"{self._name}-{key}"
+        if not has_onnx(folder):
+            if model is None:
+                model = get_model(name=self._name, repo=self._repo)
+            if model is None:
+                raise LoadModelError("Failed to load model")
+            try:
+                export_onnx(model, folder)
+            except ValueError as error:
+                raise LoadModelError(error.args[0])
+        self._model = load_onnx(folder)
+
+    def _inference_model(self):
+        # Model and precision to use with `apply_model`.
+        if self._precision != "int8":
+            return self._model, self._precision
+        if self._int8_model is None:
+            self._int8_model = quantize_int8(self._model)
+        return self._int8_model, "fp32"
+
+    def calibrate(self, tracks: List[Union[Path, th.Tensor]], duration: Optional[float] = 30.):
+        """
+        Calibrate the int8 quantization of the convolutions on the given tracks, and use
+        it from now on with the "int8" precision. Without calibration, only the linear layers
+        are quantized.
+
+        Parameters
+        ----------
+        tracks: Paths of audio files, or waveforms at the samplerate of the model, with \
+            the same format as for `separate_tensor`.
+        duration: If not None, only the `duration` seconds in the middle of each track are used.
+        """
+        wavs = []
+        for track in tracks:
+            wav = track if isinstance(track, th.Tensor) else self._load_audio(track)
+            if duration is not None:
+                length = int(duration * self._samplerate)
+                offset = max(0, (wav.shape[-1] - length) // 2)
+                wav = wav[..., offset: offset + length]
+            wavs.append(wav)
+        self._int8_model = quantize_int8(self._model, wavs, split=self._split,
+                                         overlap=self._overlap, segment=self._segment)
+        self._plan = None
 
     def _load_audio(self, track: Path):
         errors = {}
@@ -219,6 +411,8 @@ class Separator:
             errors["ffmpeg"] = "FFmpeg could not read the file."
 
         if wav is None:
+            import torchaudio as ta
+
             try:
                 wav, sr = ta.load(str(track))
             except RuntimeError as err:
@@ -263,23 +457,35 @@ class Separator:
         """
         if sr is not None and sr != self.samplerate:
             wav = convert_audio(wav, sr, self._samplerate, self._audio_channels)
+        segment, overlap, jobs, batch_size = self._segment, self._overlap, self._jobs or 0, 1
+        plan = self.plan
+        if plan is not None:
+            # `num_workers` is the user's `jobs` when given, see `plan`.
+            segment, overlap, jobs = plan.segment, plan.overlap, plan.num_workers
+            batch_size = plan.batch_size
         ref = wav.mean(0)
         wav -= ref.mean()
         wav /= ref.std() + 1e-8
+        model, precision = self._inference_model()
         out = apply_model(
-            self._model,
+            model,
             wav[None],
-            segment=self._segment,
+            segment=segment,
             shifts=self._shifts,
             split=self._split,
-            overlap=self._overlap,
+            overlap=overlap,
             device=self._device,
-            num_workers=self._jobs,
+            num_workers=jobs,
+            batch_size=batch_size,
+            precision=precision,
             callback=self._callback,
             callback_arg=_replace_dict(
                 self._callback_arg, ("audio_length", wav.shape[1])
             ),
             progress=self._progress,
+            sources=self._stems,
+            shift_mode=self._shift_mode,
+            shift_seed=self._shift_seed,
         )
         if out is None:
             raise KeyboardInterrupt
@@ -287,7 +493,7 @@ class Separator:
         out += ref.mean()
         wav *= ref.std() + 1e-8
         wav += ref.mean()
-        return (wav, dict(zip(self._model.sources, out[0])))
+        return (wav, dict(zip(self.stems, out[0])))
 
     def separate_audio_file(self, file: Path):
         """
@@ -305,6 +511,25 @@ class Separator:
         """
         return self.separate_tensor(self._load_audio(file), self.samplerate)
 
+    def save_stems(self, stems: Dict[str, th.Tensor], outputs: Dict[str, AudioOutput],
+                   jobs: Optional[int] = None, **kwargs):
+        """
+        Save separated stems, concurrently.
+
+        Parameters
+        ----------
+        stems: Separated waves, as returned by `separate_tensor` or `separate_audio_file`.
+        outputs: For each stem to save, where to save it. Either a path, a binary file-like \
+            object or a function called with each block of encoded bytes, e.g. to stream the \
+            stem in an HTTP response while it is being encoded.
+        jobs: Number of stems encoded at the same time, default to one per stem, up to the \
+            number of cores.
+        kwargs: Extra arguments for `save_audio`, e.g. `format`, which is required for \
+            outputs that are not paths.
+        """
+        save_stems({output: stems[stem] for stem, output in outputs.items()},
+                   self.samplerate, jobs, **kwargs)
+
     @property
     def samplerate(self):
         return self._samplerate
@@ -317,6 +542,80 @@ class Separator:
     def model(self):
         return self._model
 
+    @property
+    def stems(self):
+        if self._stems is None:
+            return list(self._model.sources)
+        return list(self._stems)
+
+    @property
+    def plan(self) -> Optional[Plan]:
+        """
+        The plan found by the autotuner, or None if autotuning is disabled or
+        does not apply. The benchmark runs the first time this is accessed.
+        """
+        if not self._autotune or not self._split or self._segment is not None:
+            return None
+        if self._plan is None:
+            model, precision = self._inference_model()
+            # Keyed on the checkpoints, so that a plan is not reused for another model
+            # with the same name, or once the checkpoints are updated.
+            key = _checkpoints_key(self._name, self._repo)
+            if key is None and self._backend == "torch":
+                key = model_signature(self._model)
+            name: Optional[str] = None  # Not cached if the model cannot be identified.
+            if key is not None:
+                name = f"{self._name}-{key}"
+                if self._backend != "torch":
+                    name += f":{self._backend}"
+                if self._precision == "int8":
+                    name += ":int8" if self._int8_model is None else ":int8-calibrated"
+                if self._fuse:
+                    name += ":fused"
+                if self._blstm_max_batch is not None:
+                    name += f":blstm{self._blstm_max_batch}"
+                if self._multiwrap_workers:
+                    name += f":multiwrap{self._multiwrap_workers}"
+            self._plan = autotune(model, self._device, memory_budget=self._memory_budget,
+                                  name=name, overlap=self._overlap, precision=precision,
+                                  num_workers=self._jobs, shifts=self._shifts,
+                                  shift_mode=self._shift_mode, shift_seed=self._shift_seed,
+                                  sources=self._stems)
+        return self._plan
+
+
+def _checkpoints_key(name: str, repo: Optional[Path]) -> Optional[str]:
+    # Short hash of the checkpoints `name` resolves to, as done by `get_model`, without
+    # loading them, or None if `name` cannot be resolved this way. Remote files and files
+    # in the model store are identified by their checksum, local files by their path,
+    # size and modification time.
+    import yaml
+
+    hasher = hashlib.sha256(f"{name}|{repo}".encode())
+    store = get_store()
+    if repo is None and store is not None and store.has_model(name):
+        bag = store.index['bags'].get(name)
+        signatures = [name] if bag is None else bag['models']
+        entries = [bag] + [store.index['models'][sig] for sig in signatures]
+        hasher.update(json.dumps(entries, sort_keys=True).encode())
+        return hasher.hexdigest()[:8]
+    models = list_models(repo)
+    if name in models["single"]:
+        signatures = [name]
+    elif name in models["bag"]:
+        text = Path(models["bag"][name]).read_text()
+        hasher.update(text.encode())
+        signatures = yaml.safe_load(text)['models']
+    else:
+        return None
+    for sig in signatures:
+        location = models["single"].get(sig)
+        if isinstance(location, Path):
+            stat = location.stat()
+            location = f"{location.resolve()}|{stat.st_size}|{stat.st_mtime_ns}"
+        hasher.update(f"|{sig}|{location}".encode())
+    return hasher.hexdigest()[:8]
+
 
 def list_models(repo: Optional[Path] = None) -> Dict[str, Dict[str, Union[str, Path]]]:
     """
@@ -339,6 +638,8 @@ def list_models(repo: Optional[Path] = None) -> Dict[str, Dict[str, Union[str, P
         bag_repo = BagOnlyRepo(REMOTE_ROOT, model_repo)
     else:
         if not repo.is_dir():
+            from dora.log import fatal
+
             fatal(f"{repo} must exist and be a directory.")
         model_repo = LocalRepo(repo)
         bag_repo = BagOnlyRepo(repo, model_repo)
@@ -361,8 +662,20 @@ if __name__ == "__main__":
         split=args.split,
         segment=args.segment,
         jobs=args.jobs,
+        shift_mode=args.shift_mode,
+        shift_seed=args.shift_seed,
+        autotune=args.autotune,
+        memory_budget=args.memory_budget,
+        precision=args.precision,
+        attention_backend=args.attention_backend,
+        backend=args.backend,
+        blstm_max_batch=args.blstm_max_batch,
+        fuse=args.fuse,
+        multiwrap_workers=args.multiwrap_workers,
         callback=print
     )
+    if args.calibrate:
+        separator.calibrate(args.tracks)
     out = args.out / args.name
     out.mkdir(parents=True, exist_ok=True)
     for file in args.tracks:
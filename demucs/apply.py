@@ -11,6 +11,7 @@ import copy
 import random
 import typing as tp
 from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from threading import Lock
 
 import torch as th
@@ -19,11 +20,18 @@ from torch import nn
 from torch.nn import functional as F
 
 from .demucs import Demucs
+from .export import FixedLengthModel
 from .hdemucs import HDemucs
 from .htdemucs import HTDemucs
 from .utils import DummyPoolExecutor, center_trim
 
-Model = tp.Union[Demucs, HDemucs, HTDemucs]
+Model = tp.Union[Demucs, HDemucs, HTDemucs, FixedLengthModel]
+# Autocast dtype for each inference precision, None meaning no autocast.
+PRECISIONS: tp.Dict[str, tp.Optional[th.dtype]] = {
+    'fp32': None,
+    'bf16': th.bfloat16,
+    'fp16': th.float16,
+}
 
 
 class BagOfModels(nn.Module):
@@ -50,7 +58,8 @@ class BagOfModels(nn.Module):
             assert other.sources == first.sources
             assert other.samplerate == first.samplerate
             assert other.audio_channels == first.audio_channels
-            if segment is not None:
+            if segment is not None and not isinstance(other, FixedLengthModel):
+                # Exported models have a fixed length, and keep their segment.
                 if not isinstance(other, HTDemucs) or segment <= other.segment:
                     other.segment = segment
 
@@ -67,11 +76,21 @@ class BagOfModels(nn.Module):
                 assert len(weight) == len(first.sources)
         self.weights = weights
 
+    def active_models(self, sources: tp.Optional[tp.Sequence[str]] = None) -> tp.List[int]:
+        """
+        Return the indexes of the sub-models that have a non zero weight for at least
+        one of the given `sources` (all the sources if None). The other sub-models do not
+        contribute to the requested estimates and can be skipped entirely.
+        """
+        indexes = _source_indexes(self, sources)
+        return [idx for idx, weights in enumerate(self.weights)
+                if any(weights[k] for k in indexes)]
+
     @property
     def max_allowed_segment(self) -> float:
         max_allowed_segment = float('inf')
         for model in self.models:
-            if isinstance(model, HTDemucs):
+            if isinstance(model, (HTDemucs, FixedLengthModel)):
                 max_allowed_segment = min(max_allowed_segment, float(model.segment))
         return max_allowed_segment
 
@@ -132,6 +151,17 @@ def tensor_chunk(tensor_or_chunk):
         return TensorChunk(tensor_or_chunk)
 
 
+def _source_indexes(model: tp.Union[BagOfModels, Model],
+                    sources: tp.Optional[tp.Sequence[str]]) -> tp.List[int]:
+    if sources is None:
+        return list(range(len(model.sources)))
+    for source in sources:
+        if source not in model.sources:
+            raise ValueError(f"Unknown source {source}, "
+                             f"model sources are {', '.join(model.sources)}.")
+    return [model.sources.index(source) for source in sources]
+
+
 def _replace_dict(_dict: tp.Optional[dict], *subs: tp.Tuple[tp.Hashable, tp.Any]) -> dict:
     if _dict is None:
         _dict = {}
@@ -142,6 +172,155 @@ def _replace_dict(_dict: tp.Optional[dict], *subs: tp.Tuple[tp.Hashable, tp.Any]
     return _dict
 
 
+def _shift_offsets(shifts: int, max_shift: int, shift_mode: str,
+                   shift_seed: tp.Optional[int]) -> tp.List[int]:
+    if shift_mode == 'even':
+        # Evenly spaced offsets, each one in the middle of its own slice of `[0, max_shift]`.
+        return [int((idx + 0.5) * max_shift / shifts) for idx in range(shifts)]
+    elif shift_mode == 'random':
+        rng = random.Random(shift_seed)
+        return [rng.randint(0, max_shift) for _ in range(shifts)]
+    else:
+        raise ValueError(f"Invalid shift mode {shift_mode}")
+
+
+def _transition_weight(segment_length: int, transition_power: float, device) -> th.Tensor:
+    # We start from a triangle shaped weight, with maximal weight in the middle
+    # of the segment. Then we normalize and take to the power `transition_power`.
+    # Large values of transition power will lead to sharper transitions.
+    weight = th.cat([th.arange(1, segment_length // 2 + 1, device=device),
+                     th.arange(segment_length - segment_length // 2, 0, -1, device=device)])
+    assert len(weight) == segment_length
+    # If the overlap < 50%, this will translate to linear transition when
+    # transition_power is 1.
+    return (weight / weight.max())**transition_power
+
+
+def _autocast(precision: str, device: th.device):
+    if precision not in PRECISIONS:
+        raise ValueError(f"Invalid precision {precision}, "
+                         f"must be one of {', '.join(PRECISIONS)}")
+    dtype = PRECISIONS[precision]
+    if dtype is None:
+        return nullcontext()
+    if dtype is th.float16 and device.type != 'cuda':
+        raise ValueError("fp16 precision is only supported on CUDA, use bf16 instead.")
+    if device.type not in ['cpu', 'cuda']:
+        raise ValueError(f"Mixed precision is not supported on {device.type}.")
+    return th.autocast(device.type, dtype=dtype)
+
+
+def _run_model(model: Model, chunks: tp.List[TensorChunk], device, segment: tp.Optional[float],
+               lock, callback: tp.Optional[tp.Callable[[dict], None]],
+               callback_arg: dict, precision: str = 'fp32') -> th.Tensor:
+    """Evaluate `model` on chunks of identical length, stacked along the batch dimension."""
+    length = chunks[0].length
+    assert all(chunk.length == length for chunk in chunks)
+    valid_length: int
+    if isinstance(model, (HTDemucs, FixedLengthModel)) and segment is not None:
+        valid_length = int(segment * model.samplerate)
+    elif hasattr(model, 'valid_length'):
+        valid_length = model.valid_length(length)  # type: ignore
+    else:
+        valid_length = length
+    padded_mix = th.cat([chunk.padded(valid_length) for chunk in chunks]).to(device)
+    with lock:
+        if callback is not None:
+            callback(_replace_dict(callback_arg, ("state", "start")))  # type: ignore
+    with th.no_grad(), _autocast(precision, device):
+        out = model(padded_mix)
+    with lock:
+        if callback is not None:
+            callback(_replace_dict(callback_arg, ("state", "end")))  # type: ignore
+    assert isinstance(out, th.Tensor)
+    return center_trim(out.float(), length)
+
+
+def _batch_positions(positions: tp.Iterable[int], segment_length: int, total_length: int,
+                     batch_size: int) -> tp.List[tp.List[int]]:
+    """
+    Group consecutive positions into batches of at most `batch_size` positions,
+    such that all the chunks in a batch have the same length.
+    """
+    batches: tp.List[tp.Tuple[int, tp.List[int]]] = []
+    for position in positions:
+        chunk_length = min(segment_length, total_length - position)
+        if batches and batches[-1][0] == chunk_length and len(batches[-1][1]) < batch_size:
+            batches[-1][1].append(position)
+        else:
+            batches.append((chunk_length, [position]))
+    return [group for _, group in batches]
+
+
+def _apply_batched_shifts(model: Model, mix: TensorChunk, offsets: tp.List[int], max_shift: int,
+                          split: bool, overlap: float, transition_power: float,
+                          progress: bool, device, pool, segment: tp.Optional[float], lock,
+                          callback: tp.Optional[tp.Callable[[dict], None]],
+                          callback_arg: dict, batch_size: int = 1,
+                          precision: str = 'fp32') -> th.Tensor:
+    """
+    Shift trick where all the shifted copies of a given segment go through the model
+    as a single batch. The estimates of all the segments of all the copies are
+    overlap-added together into the output, each one weighted by its transition weight,
+    instead of averaging uniformly the copies once each has been overlap-added.
+    """
+    batch, channels, length = mix.shape
+    padded_mix = mix.padded(length + 2 * max_shift)
+    # All the shifted copies have the same length, so that the same segment
+    # is extracted from each of them at a given position.
+    shifted_length = length + max_shift
+    copies = [TensorChunk(padded_mix, offset, shifted_length) for offset in offsets]
+    if split:
+        if segment is None:
+            segment = model.segment
+        assert segment is not None and segment > 0.
+        segment_length = int(model.samplerate * segment)
+        stride = int((1 - overlap) * segment_length)
+        positions = range(0, shifted_length, stride)
+        weight = _transition_weight(segment_length, transition_power, device)
+    else:
+        segment_length = shifted_length
+        stride = shifted_length
+        positions = range(0, 1)
+        weight = th.ones(segment_length, device=device)
+    scale = float(format(stride / model.samplerate, ".2f"))
+
+    out = th.zeros(batch, len(model.sources), channels, length, device=mix.device)
+    sum_weight = th.zeros(length, device=mix.device)
+    futures = []
+    for group in _batch_positions(positions, segment_length, shifted_length, batch_size):
+        chunks = [TensorChunk(copy, position, segment_length)
+                  for position in group for copy in copies]
+        future = pool.submit(_run_model, model, chunks, device, segment, lock, callback,
+                             _replace_dict(callback_arg, ("segment_offset", group[0])),
+                             precision)
+        futures.append((future, group))
+    if progress:
+        futures = tqdm.tqdm(futures, unit_scale=scale * batch_size, ncols=120, unit='seconds')
+    for future, group in futures:
+        try:
+            chunk_out = future.result()  # type: th.Tensor
+        except Exception:
+            pool.shutdown(wait=True, cancel_futures=True)
+            raise
+        chunk_length = chunk_out.shape[-1]
+        chunk_out = chunk_out.reshape(len(group), len(offsets), batch, *chunk_out.shape[1:])
+        for position, position_out in zip(group, chunk_out):
+            for shifted_out, offset in zip(position_out, offsets):
+                # `position` in the shifted copy is `position + offset - max_shift` in `mix`.
+                start = position + offset - max_shift
+                begin = max(0, -start)
+                end = min(chunk_length, length - start)
+                if end <= begin:
+                    continue
+                out[..., start + begin:start + end] += (
+                    weight[begin:end] * shifted_out[..., begin:end]).to(mix.device)
+                sum_weight[start + begin:start + end] += weight[begin:end].to(mix.device)
+    assert sum_weight.min() > 0
+    out /= sum_weight
+    return out
+
+
 def apply_model(model: tp.Union[BagOfModels, Model],
                 mix: tp.Union[th.Tensor, TensorChunk],
                 shifts: int = 1, split: bool = True,
@@ -150,7 +329,11 @@ def apply_model(model: tp.Union[BagOfModels, Model],
                 num_workers: int = 0, segment: tp.Optional[float] = None,
                 pool=None, lock=None,
                 callback: tp.Optional[tp.Callable[[dict], None]] = None,
-                callback_arg: tp.Optional[dict] = None) -> th.Tensor:
+                callback_arg: tp.Optional[dict] = None,
+                sources: tp.Optional[tp.Sequence[str]] = None,
+                shift_mode: str = 'random',
+                shift_seed: tp.Optional[int] = None,
+                batch_size: int = 1, precision: str = 'fp32') -> th.Tensor:
     """
     Apply model to a given mixture.
 
@@ -159,6 +342,18 @@ def apply_model(model: tp.Union[BagOfModels, Model],
             and apply the oppositve shift to the output. This is repeated `shifts` time and
             all predictions are averaged. This effectively makes the model time equivariant
             and improves SDR by up to 0.2 points.
+        shift_mode (str): how the shifts are chosen. With 'random' (and no `shift_seed`),
+            a new random shift is drawn for each of the `shifts` passes, which run one
+            after the other. With 'even', the shifts are evenly spaced between 0 and 0.5 sec.
+        shift_seed (int or None): seed for the 'random' shift mode, the sub-models of
+            a bag each using their own seed derived from it.
+            With either 'even' or a seed, the output is reproducible, and all the shifted
+            copies of a given segment are evaluated by the model as a single batch.
+            With `split`, the estimates of all the segments of all the copies are then
+            overlap-added with their transition weights, while the sequential shifts
+            average uniformly the copies, each split and overlap-added on its own.
+            The segments are the same, only their weights differ, so that both agree
+            when the estimates do not depend on the segmentation.
         split (bool): if True, the input will be broken down in 8 seconds extracts
             and predictions will be performed individually on each and concatenated.
             Useful for model with large memory footprint like Tasnet.
@@ -170,6 +365,14 @@ def apply_model(model: tp.Union[BagOfModels, Model],
         num_workers (int): if non zero, device is 'cpu', how many threads to
             use in parallel.
         segment (float or None): override the model segment parameter.
+        batch_size (int): when `split` is True, how many consecutive segments are
+            evaluated by the model as a single batch.
+        precision (str): 'fp32' for full precision, 'bf16' or 'fp16' (CUDA only) to run
+            the model under autocast with that dtype. The STFT, Wiener filtering and
+            normalization are always done in float32, and so is the returned tensor.
+        sources (list[str] or None): if provided, only estimate those sources, and return
+            them in the given order along the second dimension. For a bag of models,
+            sub-models with a zero weight for all the requested sources are not evaluated.
     """
     if device is None:
         device = mix.device
@@ -195,6 +398,10 @@ def apply_model(model: tp.Union[BagOfModels, Model],
         'pool': pool,
         'segment': segment,
         'lock': lock,
+        'shift_mode': shift_mode,
+        'shift_seed': shift_seed,
+        'batch_size': batch_size,
+        'precision': precision,
     }
     out: tp.Union[float, th.Tensor]
     res: tp.Union[float, th.Tensor]
@@ -202,18 +409,32 @@ def apply_model(model: tp.Union[BagOfModels, Model],
         # Special treatment for bag of model.
         # We explicitely apply multiple times `apply_model` so that the random shifts
         # are different for each model.
+        indexes = _source_indexes(model, sources)
+        active = model.active_models(sources)
         estimates: tp.Union[float, th.Tensor] = 0.
-        totals = [0.] * len(model.sources)
-        callback_arg["models"] = len(model.models)
-        for sub_model, model_weights in zip(model.models, model.weights):
+        totals = [0.] * len(indexes)
+        # Progress is reported over the models actually run, so that
+        # `model_idx_in_bag` is always below `models`.
+        callback_arg["models"] = len(active)
+        for active_idx, model_idx in enumerate(active):
+            sub_model = model.models[model_idx]
+            model_weights = [model.weights[model_idx][k] for k in indexes]
+            callback_arg["model_idx_in_bag"] = active_idx
             kwargs["callback"] = ((
-                lambda d, i=callback_arg["model_idx_in_bag"]: callback(
+                lambda d, i=active_idx: callback(
                     _replace_dict(d, ("model_idx_in_bag", i))) if callback else None)
             )
-            original_model_device = next(iter(sub_model.parameters())).device
+            # Models running outside of PyTorch (e.g. ONNX Runtime) have no parameters.
+            parameter = next(iter(sub_model.parameters()), None)
+            original_model_device = device if parameter is None else parameter.device
             sub_model.to(device)
+            if shift_seed is not None:
+                # Derived from the index in the full bag, so that the shifts of a sub-model
+                # do not depend on which other sub-models are skipped.
+                kwargs['shift_seed'] = shift_seed + model_idx
 
-            res = apply_model(sub_model, mix, **kwargs, callback_arg=callback_arg)
+            res = apply_model(sub_model, mix, **kwargs, callback_arg=callback_arg,
+                              sources=sources)
             out = res
             sub_model.to(original_model_device)
             for k, inst_weight in enumerate(model_weights):
@@ -221,13 +442,17 @@ def apply_model(model: tp.Union[BagOfModels, Model],
                 totals[k] += inst_weight
             estimates += out
             del out
-            callback_arg["model_idx_in_bag"] += 1
 
         assert isinstance(estimates, th.Tensor)
         for k in range(estimates.shape[1]):
             estimates[:, k, :, :] /= totals[k]
         return estimates
 
+    if sources is not None:
+        indexes = _source_indexes(model, sources)
+        out = apply_model(model, mix, **kwargs, callback=callback, callback_arg=callback_arg)
+        return out[:, indexes]
+
     if "models" not in callback_arg:
         callback_arg["models"] = 1
     model.to(device)
@@ -239,6 +464,13 @@ def apply_model(model: tp.Union[BagOfModels, Model],
         max_shift = int(0.5 * model.samplerate)
         mix = tensor_chunk(mix)
         assert isinstance(mix, TensorChunk)
+        if shift_mode != 'random' or shift_seed is not None:
+            offsets = _shift_offsets(shifts, max_shift, shift_mode, shift_seed)
+            return _apply_batched_shifts(
+                model, mix, offsets, max_shift, split=split, overlap=overlap,
+                transition_power=transition_power, progress=progress, device=device,
+                pool=pool, segment=segment, lock=lock, callback=callback,
+                callback_arg=callback_arg, batch_size=batch_size, precision=precision)
         padded_mix = mix.padded(length + 2 * max_shift)
         out = 0.
         for shift_idx in range(shifts):
@@ -265,58 +497,33 @@ def apply_model(model: tp.Union[BagOfModels, Model],
         stride = int((1 - overlap) * segment_length)
         offsets = range(0, length, stride)
         scale = float(format(stride / model.samplerate, ".2f"))
-        # We start from a triangle shaped weight, with maximal weight in the middle
-        # of the segment. Then we normalize and take to the power `transition_power`.
-        # Large values of transition power will lead to sharper transitions.
-        weight = th.cat([th.arange(1, segment_length // 2 + 1, device=device),
-                         th.arange(segment_length - segment_length // 2, 0, -1, device=device)])
-        assert len(weight) == segment_length
-        # If the overlap < 50%, this will translate to linear transition when
-        # transition_power is 1.
-        weight = (weight / weight.max())**transition_power
+        weight = _transition_weight(segment_length, transition_power, device)
         futures = []
-        for offset in offsets:
-            chunk = TensorChunk(mix, offset, segment_length)
-            future = pool.submit(apply_model, model, chunk, **kwargs, callback_arg=callback_arg,
-                                 callback=(lambda d, i=offset:
-                                           callback(_replace_dict(d, ("segment_offset", i)))
-                                           if callback else None))
-            futures.append((future, offset))
-            offset += segment_length
+        for group in _batch_positions(offsets, segment_length, length, batch_size):
+            chunks = [TensorChunk(mix, offset, segment_length) for offset in group]
+            future = pool.submit(_run_model, model, chunks, device, kwargs['segment'], lock,
+                                 callback, _replace_dict(callback_arg, ("segment_offset", group[0])),
+                                 precision)
+            futures.append((future, group))
         if progress:
-            futures = tqdm.tqdm(futures, unit_scale=scale, ncols=120, unit='seconds')
-        for future, offset in futures:
+            futures = tqdm.tqdm(futures, unit_scale=scale * batch_size, ncols=120, unit='seconds')
+        for future, group in futures:
             try:
                 chunk_out = future.result()  # type: th.Tensor
             except Exception:
                 pool.shutdown(wait=True, cancel_futures=True)
                 raise
             chunk_length = chunk_out.shape[-1]
-            out[..., offset:offset + segment_length] += (
-                weight[:chunk_length] * chunk_out).to(mix.device)
-            sum_weight[offset:offset + segment_length] += weight[:chunk_length].to(mix.device)
+            chunk_out = chunk_out.reshape(len(group), batch, *chunk_out.shape[1:])
+            for offset, segment_out in zip(group, chunk_out):
+                out[..., offset:offset + segment_length] += (
+                    weight[:chunk_length] * segment_out).to(mix.device)
+                sum_weight[offset:offset + segment_length] += weight[:chunk_length].to(mix.device)
         assert sum_weight.min() > 0
         out /= sum_weight
         assert isinstance(out, th.Tensor)
         return out
     else:
-        valid_length: int
-        if isinstance(model, HTDemucs) and segment is not None:
-            valid_length = int(segment * model.samplerate)
-        elif hasattr(model, 'valid_length'):
-            valid_length = model.valid_length(length)  # type: ignore
-        else:
-            valid_length = length
         mix = tensor_chunk(mix)
         assert isinstance(mix, TensorChunk)
-        padded_mix = mix.padded(valid_length).to(device)
-        with lock:
-            if callback is not None:
-                callback(_replace_dict(callback_arg, ("state", "start")))  # type: ignore
-        with th.no_grad():
-            out = model(padded_mix)
-        with lock:
-            if callback is not None:
-                callback(_replace_dict(callback_arg, ("state", "end")))  # type: ignore
-        assert isinstance(out, th.Tensor)
-        return center_trim(out, length)
+        return _run_model(model, [mix], device, segment, lock, callback, callback_arg, precision)
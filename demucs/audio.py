@@ -3,18 +3,27 @@
 #
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
+import functools
+import io
 import json
+import os
+import struct
 import subprocess as sp
 import typing as tp
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
 
 import julius
-import lameenc
 import numpy as np
 import torch
-import torchaudio as ta
+from torch.nn import functional as F
 
-from .utils import temp_filenames
+from .utils import DummyPoolExecutor, temp_filenames
+
+# Where to save audio: a path, a binary file-like object, or a function called with each
+# block of encoded bytes.
+AudioOutput = tp.Union[str, Path, tp.BinaryIO, tp.Callable[[bytes], tp.Any]]
 
 
 def _read_info(path):
@@ -166,10 +175,88 @@ def convert_audio_channels(wav, channels=2):
     return wav
 
 
+@functools.lru_cache(maxsize=64)
+def get_resampler(from_samplerate: int, to_samplerate: int,
+                  device: tp.Optional[torch.device] = None,
+                  dtype: torch.dtype = torch.float32) -> julius.ResampleFrac:
+    """Resampler from `from_samplerate` to `to_samplerate`, with its filters on `device`
+    with `dtype`. It is cached, so that the filters are only built once per conversion,
+    rather than for every call as with `julius.resample_frac`. It holds no state and can be
+    shared between threads.
+    """
+    return julius.ResampleFrac(from_samplerate, to_samplerate).to(device=device, dtype=dtype)
+
+
+class StreamingResampler:
+    """
+    Resample audio given as successive chunks of shape `[*, T]`, with the same output as
+    resampling the whole audio at once with `get_resampler`. `push` returns the output
+    that can already be computed, the end of each chunk being kept until the next one arrives,
+    and `flush` returns the rest once the audio is over, after which the resampler
+    can be reused for another stream.
+    """
+    def __init__(self, from_samplerate: int, to_samplerate: int,
+                 device: tp.Optional[torch.device] = None, dtype: torch.dtype = torch.float32):
+        self.resampler = get_resampler(from_samplerate, to_samplerate, device, dtype)
+        self._buffer: tp.Optional[torch.Tensor] = None
+        self._length = 0
+        self._emitted = 0
+
+    def _resample(self, x: torch.Tensor) -> torch.Tensor:
+        # Same as `julius.ResampleFrac.forward`, without the padding.
+        resampler = self.resampler
+        *shape, length = x.shape
+        y = F.conv1d(x.reshape(-1, 1, length), resampler.kernel, stride=resampler.old_sr)
+        return y.transpose(1, 2).reshape(*shape, -1)
+
+    def push(self, chunk: torch.Tensor) -> torch.Tensor:
+        resampler = self.resampler
+        if chunk.shape[-1] == 0:
+            return chunk
+        if resampler.old_sr == resampler.new_sr:
+            self._buffer = chunk[..., :0]
+            return chunk
+        if self._buffer is None:
+            # The start is padded by repeating the first sample, as done by `ResampleFrac`.
+            self._buffer = chunk[..., :1].expand(*chunk.shape[:-1], resampler._width)
+        self._length += chunk.shape[-1]
+        buffer = torch.cat([self._buffer, chunk], dim=-1)
+        # Each block of `new_sr` output samples is computed from `window` input samples,
+        # successive blocks being `old_sr` input samples apart.
+        window = 2 * resampler._width + resampler.old_sr
+        blocks = max(0, (buffer.shape[-1] - window) // resampler.old_sr + 1)
+        self._buffer = buffer[..., blocks * resampler.old_sr:]
+        if blocks == 0:
+            return buffer[..., :0]
+        out = self._resample(buffer[..., :(blocks - 1) * resampler.old_sr + window])
+        self._emitted += out.shape[-1]
+        return out
+
+    def flush(self) -> tp.Optional[torch.Tensor]:
+        """Return the end of the output, None if nothing was pushed."""
+        resampler = self.resampler
+        buffer = self._buffer
+        if buffer is None or resampler.old_sr == resampler.new_sr:
+            out = buffer
+        else:
+            # The end is padded by repeating the last sample, as done by `ResampleFrac`.
+            *shape, length = buffer.shape
+            buffer = F.pad(buffer.reshape(-1, 1, length),
+                           (0, resampler._width + resampler.old_sr), mode='replicate')
+            out = self._resample(buffer.reshape(*shape, -1))
+            # Output length computed as in `ResampleFrac`.
+            total = torch.as_tensor(resampler.new_sr * self._length / resampler.old_sr)
+            out = out[..., :int(total.floor()) - self._emitted]
+        self._buffer = None
+        self._length = 0
+        self._emitted = 0
+        return out
+
+
 def convert_audio(wav, from_samplerate, to_samplerate, channels) -> torch.Tensor:
     """Convert audio from a given samplerate to a target one and target number of channels."""
     wav = convert_audio_channels(wav, channels)
-    return julius.resample_frac(wav, from_samplerate, to_samplerate)
+    return get_resampler(from_samplerate, to_samplerate, wav.device, wav.dtype)(wav)
 
 
 def i16_pcm(wav):
@@ -196,8 +283,39 @@ def as_dtype_pcm(wav, dtype):
         return i16_pcm(wav)
 
 
-def encode_mp3(wav, path, samplerate=44100, bitrate=320, quality=2, verbose=False):
-    """Save given audio as mp3. This should work on all OSes."""
+class _CallbackWriter:
+    # File-like wrapper around a function receiving the encoded bytes.
+    def __init__(self, callback: tp.Callable[[bytes], tp.Any]):
+        self.callback = callback
+
+    def write(self, data: bytes) -> int:
+        if data:
+            self.callback(data)
+        return len(data)
+
+
+@contextmanager
+def _open_output(path: AudioOutput):
+    # File-like objects are written to as is and left open, functions are called
+    # with each block of encoded bytes.
+    if hasattr(path, 'write'):
+        yield path
+    elif callable(path):
+        yield _CallbackWriter(path)
+    else:
+        with open(path, "wb") as f:
+            yield f
+
+
+def encode_mp3(wav, path, samplerate=44100, bitrate=320, quality=2, verbose=False,
+               chunk_size=2**20):
+    """Save given audio as mp3. This should work on all OSes.
+    `path` can also be a binary file-like object, e.g. a `io.BytesIO` or a pipe, or a function
+    taking bytes, to which the mp3 frames are written as they are encoded,
+    every `chunk_size` samples.
+    """
+    import lameenc
+
     C, T = wav.shape
     wav = i16_pcm(wav)
     encoder = lameenc.Encoder()
@@ -209,10 +327,10 @@ def encode_mp3(wav, path, samplerate=44100, bitrate=320, quality=2, verbose=Fals
         encoder.silence()
     wav = wav.data.cpu()
     wav = wav.transpose(0, 1).numpy()
-    mp3_data = encoder.encode(wav.tobytes())
-    mp3_data += encoder.flush()
-    with open(path, "wb") as f:
-        f.write(mp3_data)
+    with _open_output(path) as f:
+        for offset in range(0, T, chunk_size):
+            f.write(encoder.encode(wav[offset: offset + chunk_size].tobytes()))
+        f.write(encoder.flush())
 
 
 def prevent_clip(wav, mode='rescale'):
@@ -233,25 +351,93 @@ def prevent_clip(wav, mode='rescale'):
     return wav
 
 
+def _wav_header(channels: int, samplerate: int, length: int, bits_per_sample: int,
+                as_float: bool) -> bytes:
+    width = bits_per_sample // 8
+    data_size = length * channels * width
+    fmt = struct.pack('<HHIIHH', 3 if as_float else 1, channels, samplerate,
+                      samplerate * channels * width, channels * width, bits_per_sample)
+    chunks = b'fmt '
+    if as_float:
+        # Non PCM formats have an extension size in the fmt chunk, and a fact chunk
+        # with the number of samples per channel.
+        fmt += struct.pack('<H', 0)
+        chunks += struct.pack('<I', len(fmt)) + fmt + b'fact' + struct.pack('<II', 4, length)
+    else:
+        chunks += struct.pack('<I', len(fmt)) + fmt
+    riff_size = 4 + len(chunks) + 8 + data_size
+    return (b'RIFF' + struct.pack('<I', riff_size) + b'WAVE' + chunks +
+            b'data' + struct.pack('<I', data_size))
+
+
+def _pcm_bytes(wav: torch.Tensor, bits_per_sample: int, as_float: bool) -> bytes:
+    # Interleaved little endian PCM of `wav`, of shape `(channels, length)`.
+    wav = f32_pcm(wav).detach().cpu().float().t().numpy()
+    if as_float:
+        return wav.astype('<f4').tobytes()
+    scale = 2 ** (bits_per_sample - 1) - 1
+    pcm = np.ascontiguousarray(np.clip(wav, -1, 1).astype(np.float64) * scale, '<i4')
+    if bits_per_sample == 16:
+        return pcm.astype('<i2').tobytes()
+    elif bits_per_sample == 24:
+        return pcm.view(np.uint8).reshape(-1, 4)[:, :3].tobytes()
+    return pcm.tobytes()
+
+
+def write_wav(wav: torch.Tensor, path: AudioOutput, samplerate: int,
+              bits_per_sample: tp.Literal[16, 24, 32] = 16, as_float: bool = False,
+              chunk_size: int = 2**20):
+    """Write `wav` as a WAV file to `path`, a path, a binary file-like object or a function
+    taking bytes. The header is written first, then the samples `chunk_size` at a time,
+    so that nothing needs to be seeked back or buffered. With `as_float`, samples are
+    stored as 32 bits floats, otherwise as integers with `bits_per_sample` bits.
+    """
+    if as_float:
+        bits_per_sample = 32
+    C, T = wav.shape
+    with _open_output(path) as f:
+        f.write(_wav_header(C, samplerate, T, bits_per_sample, as_float))
+        for offset in range(0, T, chunk_size):
+            f.write(_pcm_bytes(wav[:, offset: offset + chunk_size], bits_per_sample, as_float))
+
+
 def save_audio(wav: torch.Tensor,
-               path: tp.Union[str, Path],
+               path: AudioOutput,
                samplerate: int,
                bitrate: int = 320,
                clip: tp.Literal["rescale", "clamp", "tanh", "none"] = 'rescale',
                bits_per_sample: tp.Literal[16, 24, 32] = 16,
                as_float: bool = False,
-               preset: tp.Literal[2, 3, 4, 5, 6, 7] = 2):
+               preset: tp.Literal[2, 3, 4, 5, 6, 7] = 2,
+               format: tp.Optional[str] = None):
     """Save audio file, automatically preventing clipping if necessary
     based on the given `clip` strategy. If the path ends in `.mp3`, this
     will save as mp3 with the given `bitrate`. Use `preset` to set mp3 quality:
     2 for highest quality, 7 for fastest speed
+
+    `path` can also be a binary file-like object, e.g. a `io.BytesIO` or an HTTP response,
+    or a function called with each block of encoded bytes, in which case `format` must be
+    given, unless the file-like object has a `name`. WAV and mp3 are written incrementally,
+    while FLAC is encoded in memory before being written.
     """
     wav = prevent_clip(wav, mode=clip)
-    path = Path(path)
-    suffix = path.suffix.lower()
-    if suffix == ".mp3":
+    is_path = isinstance(path, (str, Path))
+    if format is None:
+        suffix = Path(path if is_path else str(getattr(path, 'name', ''))).suffix.lower()
+        if not suffix:
+            raise ValueError("format must be given when saving to a file-like object "
+                             "or a function.")
+        if suffix not in ['.mp3', '.wav', '.flac']:
+            raise ValueError(f"Invalid suffix for path: {suffix}")
+        format = suffix[1:]
+    if format == "mp3":
         encode_mp3(wav, path, samplerate, bitrate, preset, verbose=True)
-    elif suffix == ".wav":
+    elif format == "wav":
+        if not is_path:
+            write_wav(wav, path, samplerate, bits_per_sample, as_float)
+            return
+        import torchaudio as ta
+
         if as_float:
             bits_per_sample = 32
             encoding = 'PCM_F'
@@ -259,7 +445,35 @@ def save_audio(wav: torch.Tensor,
             encoding = 'PCM_S'
         ta.save(str(path), wav, sample_rate=samplerate,
                 encoding=encoding, bits_per_sample=bits_per_sample)
-    elif suffix == ".flac":
-        ta.save(str(path), wav, sample_rate=samplerate, bits_per_sample=bits_per_sample)
+    elif format == "flac":
+        import torchaudio as ta
+
+        if is_path:
+            ta.save(str(path), wav, sample_rate=samplerate, bits_per_sample=bits_per_sample)
+            return
+        buffer = io.BytesIO()
+        ta.save(buffer, wav, sample_rate=samplerate, bits_per_sample=bits_per_sample,
+                format="flac")
+        with _open_output(path) as f:
+            f.write(buffer.getvalue())
     else:
-        raise ValueError(f"Invalid suffix for path: {suffix}")
+        raise ValueError(f"Invalid format: {format}")
+
+
+def save_stems(stems: tp.Mapping[AudioOutput, torch.Tensor],
+               samplerate: int,
+               jobs: tp.Optional[int] = None,
+               **kwargs):
+    """Save each of the `stems`, a mapping from output (see `save_audio`) to audio,
+    with `save_audio` and the given `kwargs`. `jobs` stems are encoded concurrently
+    in threads, default to one per stem, up to the number of cores. `lameenc` releases
+    the GIL while encoding, so that mp3 stems are encoded in parallel.
+    """
+    if jobs is None:
+        jobs = min(len(stems), os.cpu_count() or 1)
+    pool = ThreadPoolExecutor(jobs) if jobs > 1 else DummyPoolExecutor()
+    with pool:
+        futures = [pool.submit(save_audio, wav, path, samplerate, **kwargs)
+                   for path, wav in stems.items()]
+        for future in futures:
+            future.result()
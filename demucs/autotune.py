@@ -0,0 +1,297 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Pick the fastest `segment`, `overlap`, batch size and number of workers
+for `apply_model` on a given device, under an optional memory budget.
+
+A few candidate configurations are timed on a short, deterministic probe signal,
+and the winner is cached on disk per model, host, device and budget, so that
+the benchmark only runs once per node type.
+"""
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import time
+import typing as tp
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+import torch as th
+
+from .apply import BagOfModels, Model, apply_model
+from .export import FixedLengthModel
+from .htdemucs import HTDemucs
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None  # type: ignore
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZES = [1, 2, 4]
+CACHE_NAME = 'demucs_autotune.json'
+
+
+@dataclass
+class Plan:
+    """
+    Separation parameters found by `autotune`. A `segment` of None means
+    the default segment of the model.
+    """
+    segment: tp.Optional[float]
+    overlap: float
+    batch_size: int
+    num_workers: int
+    speed: float = 0.  # seconds of audio separated per second.
+    memory: tp.Optional[int] = None  # peak memory in bytes, None if unknown.
+
+
+def _models(model: tp.Union[BagOfModels, Model]) -> tp.List[Model]:
+    if isinstance(model, BagOfModels):
+        return list(model.models)
+    return [model]
+
+
+def _default_segment(model: tp.Union[BagOfModels, Model]) -> float:
+    segment = min(float(sub.segment) for sub in _models(model))
+    if isinstance(model, BagOfModels):
+        segment = min(segment, model.max_allowed_segment)
+    return segment
+
+
+def _segment_candidates(model: tp.Union[BagOfModels, Model]) -> tp.List[tp.Optional[float]]:
+    if any(isinstance(sub, (HTDemucs, FixedLengthModel)) for sub in _models(model)):
+        # HTDemucs always pads its input up to its training length,
+        # so shorter segments would only waste computations.
+        return [None]
+    segment = _default_segment(model)
+    return [segment / 2, None, segment * 2]
+
+
+def _workers_candidates(device: th.device) -> tp.List[int]:
+    if device.type != 'cpu':
+        # Workers are only used on CPU by `apply_model`.
+        return [0]
+    cpus = os.cpu_count() or 1
+    if cpus >= 4:
+        return [0, 2]
+    return [0]
+
+
+def candidate_plans(model: tp.Union[BagOfModels, Model], device: th.device,
+                    overlap: float = 0.25,
+                    num_workers: tp.Optional[int] = None) -> tp.List[Plan]:
+    """
+    Return the candidate plans, sorted by increasing expected memory usage.
+    The overlap of each candidate is chosen so that the overlapping duration between
+    two segments stays the same as with the default segment and `overlap`.
+    If `num_workers` is given, all the candidates use it.
+    """
+    default = _default_segment(model)
+    if num_workers is None:
+        workers = _workers_candidates(device)
+    else:
+        workers = [num_workers]
+    plans = []
+    for segment in _segment_candidates(model):
+        ratio = 1. if segment is None else default / segment
+        for batch_size in BATCH_SIZES:
+            for num_workers in workers:
+                plans.append(Plan(segment, min(0.5, overlap * ratio), batch_size, num_workers))
+
+    def _size(plan: Plan):
+        segment = default if plan.segment is None else plan.segment
+        return segment * plan.batch_size * max(1, plan.num_workers)
+    plans.sort(key=_size)
+    return plans
+
+
+def _proc_status(field: str) -> tp.Optional[int]:
+    # Value in bytes of a memory `field` of /proc/self/status, None if not available.
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def _reset_peak_rss() -> tp.Optional[int]:
+    # On Linux, reset the peak RSS (VmHWM) of the process to its current RSS, which is
+    # returned, so that each candidate is measured from a fresh baseline.
+    # Returns None if not supported.
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        return None
+    return _proc_status('VmRSS')
+
+
+def _peak_rss() -> tp.Optional[int]:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak
+    return peak * 1024
+
+
+def _measure(model: tp.Union[BagOfModels, Model], probe: th.Tensor, plan: Plan,
+             device: th.device, rss_baseline: tp.Optional[int], precision: str,
+             **kwargs) -> Plan:
+    # `kwargs` are the shift trick and source parameters given to `apply_model`.
+    cuda = device.type == 'cuda'
+    rss_reset = None
+    if cuda:
+        th.cuda.synchronize(device)
+        th.cuda.reset_peak_memory_stats(device)
+    else:
+        rss_reset = _reset_peak_rss()
+    begin = time.time()
+    apply_model(model, probe, split=True, segment=plan.segment, overlap=plan.overlap,
+                batch_size=plan.batch_size, num_workers=plan.num_workers, device=device,
+                precision=precision, **kwargs)
+    if cuda:
+        th.cuda.synchronize(device)
+    duration = time.time() - begin
+    memory: tp.Optional[int]
+    if cuda:
+        memory = th.cuda.max_memory_allocated(device)
+    elif rss_reset is not None:
+        peak = _proc_status('VmHWM')
+        memory = None if peak is None else peak - rss_reset
+    else:
+        # The peak RSS of `getrusage` never goes down: once a candidate exceeded
+        # the budget, the later ones are only given an upper bound of their usage.
+        peak = _peak_rss()
+        memory = None if peak is None or rss_baseline is None else peak - rss_baseline
+    speed = probe.shape[-1] / model.samplerate / duration
+    return Plan(plan.segment, plan.overlap, plan.batch_size, plan.num_workers, speed, memory)
+
+
+def _cache_path() -> Path:
+    return Path(th.hub.get_dir()) / CACHE_NAME
+
+
+def _cache_key(name: str, device: th.device, memory_budget: tp.Optional[float],
+               overlap: float, precision: str, num_workers: tp.Optional[int], shifts: int,
+               shift_mode: str, shift_seed: tp.Optional[int],
+               sources: tp.Optional[tp.Sequence[str]]) -> str:
+    # Only whether there is a seed matters, as it changes how the shifts are batched.
+    seeded = shift_seed is not None
+    sources_key = None if sources is None else ','.join(sources)
+    return (f"{name}|{platform.node()}|{device}|{memory_budget}|{overlap}|{precision}|"
+            f"{num_workers}|{shifts}|{shift_mode}|{seeded}|{sources_key}")
+
+
+def _load_cache() -> tp.Dict[str, dict]:
+    path = _cache_path()
+    if not path.exists():
+        return {}
+    try:
+        return json.loads(path.read_text())
+    except (OSError, ValueError):
+        logger.warning("Could not read autotune cache %s, ignoring it.", path)
+        return {}
+
+
+def _save_cache(cache: tp.Dict[str, dict]):
+    path = _cache_path()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Several processes might tune at once, each through its own temporary file.
+    with tempfile.NamedTemporaryFile('w', dir=path.parent, prefix=path.name,
+                                     suffix='.tmp', delete=False) as tmp:
+        tmp.write(json.dumps(cache, indent=2))
+    os.replace(tmp.name, path)
+
+
+def autotune(model: tp.Union[BagOfModels, Model], device: tp.Union[str, th.device, None] = None,
+             memory_budget: tp.Optional[float] = None, name: tp.Optional[str] = None,
+             overlap: float = 0.25, precision: str = 'fp32', probe_segments: int = 4,
+             use_cache: bool = True, num_workers: tp.Optional[int] = None,
+             shifts: int = 0, shift_mode: str = 'random', shift_seed: tp.Optional[int] = None,
+             sources: tp.Optional[tp.Sequence[str]] = None) -> Plan:
+    """
+    Find the fastest plan for `model` on `device`.
+
+    Args:
+        model (BagOfModels or Model): model to tune.
+        device (torch.device, str or None): device used for the separation, default to
+            the device of the model.
+        memory_budget (float or None): maximum memory in GB used by the separation,
+            excluding the memory needed by the model and the input and output tracks.
+            On CPU, this is the growth of the peak resident memory, reset before each
+            candidate on Linux. Elsewhere, the peak never goes down and is only an upper
+            bound for the candidates measured after a larger one.
+        name (str or None): name of the model, used to cache the result.
+            If None, the result is not cached.
+        overlap (float): overlap to use with the default segment of the model.
+        precision (str): inference precision, see `apply_model`.
+        probe_segments (int): length of the probe signal, in number of (default) segments.
+        use_cache (bool): if False, always run the benchmark, and do not update the cache.
+        num_workers (int or None): if given, only the other parameters are tuned.
+        shifts, shift_mode, shift_seed, sources: used for the separation, see `apply_model`.
+            Each candidate is measured with them, as with 'even' or seeded shifts,
+            the shifted copies of a segment are evaluated in a single batch.
+    """
+    if device is None:
+        parameter = next(iter(model.parameters()), None)
+        device = 'cpu' if parameter is None else parameter.device
+    device = th.device(device)
+    key = None
+    if name is not None and use_cache:
+        key = _cache_key(name, device, memory_budget, overlap, precision, num_workers,
+                         shifts, shift_mode, shift_seed, sources)
+        cached = _load_cache().get(key)
+        if cached is not None:
+            return Plan(**cached)
+
+    length = int(probe_segments * _default_segment(model) * model.samplerate)
+    generator = th.Generator().manual_seed(1234)
+    probe = th.randn(1, model.audio_channels, length, generator=generator)
+    # Warmup, to avoid timing one time initializations.
+    candidates = candidate_plans(model, device, overlap, num_workers)
+    warmup = candidates[0]
+    apply_model(model, probe[..., :length // probe_segments], shifts=0, split=True,
+                segment=warmup.segment, overlap=warmup.overlap, device=device, precision=precision)
+    rss_baseline = _peak_rss()
+
+    budget = None if memory_budget is None else memory_budget * 2**30
+    best: tp.Optional[Plan] = None
+    too_large: tp.List[Plan] = []
+    for candidate in candidates:
+        if any(candidate.segment == other.segment and
+               candidate.num_workers == other.num_workers and
+               candidate.batch_size >= other.batch_size for other in too_large):
+            # Larger batch than a plan already over budget.
+            continue
+        plan = _measure(model, probe, candidate, device, rss_baseline, precision,
+                        shifts=shifts, shift_mode=shift_mode, shift_seed=shift_seed,
+                        sources=sources)
+        logger.debug("Autotune %r", plan)
+        if budget is not None and plan.memory is not None and plan.memory > budget:
+            too_large.append(plan)
+            continue
+        if best is None or plan.speed > best.speed:
+            best = plan
+    if best is None:
+        # Nothing fits, fall back to the smallest plan.
+        logger.warning("No plan fits within a memory budget of %.2f GB, "
+                       "using the smallest one.", memory_budget)
+        best = too_large[0]
+
+    if key is not None:
+        cache = _load_cache()
+        cache[key] = asdict(best)
+        _save_cache(cache)
+    return best
@@ -7,11 +7,11 @@
 import math
 import typing as tp
 
-import julius
 import torch
 from torch import nn
 from torch.nn import functional as F
 
+from .audio import get_resampler
 from .states import capture_init
 from .transformer import LayerScale
 from .utils import center_trim, unfold
@@ -22,11 +22,14 @@ class BLSTM(nn.Module):
     BiLSTM with same hidden units as input dim.
     If `max_steps` is not None, input will be splitting in overlapping
     chunks and the LSTM applied separately on each chunk.
+    If `max_batch` is not None, at most `max_batch` chunks are given to the LSTM at once,
+    which bounds the memory used at inference time, see `set_blstm_max_batch`.
     """
-    def __init__(self, dim, layers=1, max_steps=None, skip=False):
+    def __init__(self, dim, layers=1, max_steps=None, skip=False, max_batch=None):
         super().__init__()
         assert max_steps is None or max_steps % 4 == 0
         self.max_steps = max_steps
+        self.max_batch = max_batch
         self.lstm = nn.LSTM(bidirectional=True, num_layers=layers, hidden_size=dim, input_size=dim)
         self.linear = nn.Linear(2 * dim, dim)
         self.skip = skip
@@ -34,38 +37,60 @@ class BLSTM(nn.Module):
     def forward(self, x):
         B, C, T = x.shape
         y = x
-        framed = False
         if self.max_steps is not None and T > self.max_steps:
-            width = self.max_steps
-            stride = width // 2
-            frames = unfold(x, width, stride)
-            nframes = frames.shape[2]
-            framed = True
-            x = frames.permute(0, 2, 1, 3).reshape(-1, C, width)
-
-        x = x.permute(2, 0, 1)
-
-        x = self.lstm(x)[0]
-        x = self.linear(x)
-        x = x.permute(1, 2, 0)
-        if framed:
-            out = []
-            frames = x.reshape(B, -1, C, width)
-            limit = stride // 2
-            for k in range(nframes):
-                if k == 0:
-                    out.append(frames[:, k, :, :-limit])
-                elif k == nframes - 1:
-                    out.append(frames[:, k, :, limit:])
-                else:
-                    out.append(frames[:, k, :, limit:-limit])
-            out = torch.cat(out, -1)
-            out = out[..., :T]
-            x = out
+            x = self._forward_framed(x)
+        else:
+            x = x.permute(2, 0, 1)
+            x = self.lstm(x)[0]
+            x = self.linear(x)
+            x = x.permute(1, 2, 0)
         if self.skip:
             x = x + y
         return x
 
+    def _forward_framed(self, x):
+        B, C, T = x.shape
+        width = self.max_steps
+        stride = width // 2
+        limit = stride // 2
+        frames = unfold(x, width, stride)
+        nframes = frames.shape[2]
+        # Frames are kept from `limit` to `limit + stride`, except for the first one,
+        # which also covers the start of the signal, and the last one, its end.
+        out = x.new_empty(B, C, (nframes + 1) * stride)
+        max_batch = self.max_batch or B * nframes
+        if max_batch >= nframes:
+            items = max(1, max_batch // nframes)
+            blocks = [(b, min(B, b + items), 0, nframes) for b in range(0, B, items)]
+        else:
+            blocks = [(b, b + 1, k, min(nframes, k + max_batch))
+                      for b in range(B) for k in range(0, nframes, max_batch)]
+        for b0, b1, k0, k1 in blocks:
+            # Frames `k0` to `k1` of the items `b0` to `b1`, with shape `(width, N, C)`.
+            z = frames[b0:b1, :, k0:k1].permute(3, 0, 2, 1).reshape(width, -1, C)
+            z = self.linear(self.lstm(z)[0]).view(width, b1 - b0, k1 - k0, C)
+            start = limit + k0 * stride
+            central = out[b0:b1, :, start:start + (k1 - k0) * stride]
+            central.view(b1 - b0, C, k1 - k0, stride).copy_(
+                z[limit:limit + stride].permute(1, 3, 2, 0))
+            if k0 == 0:
+                out[b0:b1, :, :limit] = z[:limit, :, 0].permute(1, 2, 0)
+            if k1 == nframes:
+                end = limit + nframes * stride
+                out[b0:b1, :, end:] = z[limit + stride:, :, -1].permute(1, 2, 0)
+        return out[..., :T]
+
+
+def set_blstm_max_batch(model: nn.Module, max_batch: tp.Optional[int]):
+    """
+    Set the maximum number of chunks processed at once by the `BLSTM` layers of `model`
+    that split their input, so that their memory usage no longer grows with the length
+    of the input. None to process all the chunks at once.
+    """
+    for module in model.modules():
+        if isinstance(module, BLSTM):
+            module.max_batch = max_batch
+
 
 def rescale_conv(conv, reference):
     """Rescale initial weight scale. It is unclear why it helps but it certainly does.
@@ -154,6 +179,159 @@ class DConv(nn.Module):
         return x
 
 
+def _group_norm_(x: torch.Tensor, weight: tp.Optional[torch.Tensor],
+                 bias: tp.Optional[torch.Tensor], eps: float) -> torch.Tensor:
+    # In place equivalent of `nn.GroupNorm(1, C)` for `x` of shape `(N, T, C)`.
+    flat = x.view(x.shape[0], -1)
+    flat.sub_(flat.mean(dim=1, keepdim=True))
+    var = torch.linalg.vector_norm(flat, dim=1, keepdim=True) ** 2 / flat.shape[1]
+    scale = (var + eps).rsqrt()[:, :, None]
+    if weight is not None:
+        scale = scale * weight
+    if bias is None:
+        return x.mul_(scale)
+    return torch.addcmul(bias, x, scale, out=x)
+
+
+class _FusedDConvLayer(nn.Module):
+    # One layer of a `FusedDConv`, built from the matching `nn.Sequential` of a `DConv`.
+    def __init__(self, layer: nn.Sequential):
+        super().__init__()
+        conv1, norm1, act, conv2, norm2, glu, scale = layer
+        channels = conv2.out_channels // 2
+        self.dilation = conv1.dilation[0]
+        self.padding = conv1.padding[0]
+        self.gelu = isinstance(act, nn.GELU)
+        # Convolution weights are stored as (in, out) matrices, one per tap.
+        self.register_buffer('weight1', conv1.weight.detach().permute(2, 1, 0).contiguous())
+        self.register_buffer('bias1', conv1.bias.detach().clone())
+        self.register_buffer('weight2', conv2.weight.detach()[:, :, 0].t().contiguous())
+        self.register_buffer('bias2', conv2.bias.detach().clone())
+        self.eps1 = self.eps2 = 0.
+        for name in ['norm1_weight', 'norm1_bias', 'norm2_weight', 'norm2_bias']:
+            self.register_buffer(name, None)
+        # The LayerScale is applied to the first half of the GLU input, so that it can be
+        # folded into the affine parameters of the last norm, or into the last convolution.
+        layer_scale = torch.cat([scale.scale.detach(), scale.scale.new_ones(channels)])
+        if isinstance(norm1, nn.GroupNorm):
+            self.eps1 = norm1.eps
+            self.norm1_weight = norm1.weight.detach().clone()
+            self.norm1_bias = norm1.bias.detach().clone()
+        if isinstance(norm2, nn.GroupNorm):
+            self.eps2 = norm2.eps
+            self.norm2_weight = norm2.weight.detach() * layer_scale
+            self.norm2_bias = norm2.bias.detach() * layer_scale
+        else:
+            self.weight2 *= layer_scale
+            self.bias2 *= layer_scale
+
+    def _conv1(self, padded: torch.Tensor, offset: int, out: torch.Tensor) -> torch.Tensor:
+        # Dilated convolution of the sequences of `padded`, of shape `(N, T + 2 * offset, C)`,
+        # zero padded by `offset` on each side, as one batched matrix product per tap
+        # into `out` of shape `(N, T, hidden)`. As each sequence has its own padding,
+        # no tap ever reads from a neighbouring sequence.
+        N, T, hidden = out.shape
+        kernel = len(self.weight1)
+        out.copy_(self.bias1.expand(N, T, hidden))
+        for tap in range(kernel):
+            start = offset + (tap - kernel // 2) * self.dilation
+            out.baddbmm_(padded[:, start:start + T], self.weight1[tap].expand(N, -1, -1))
+        return out
+
+    def forward(self, padded: torch.Tensor, offset: int, buffers: tp.Dict[str, torch.Tensor]):
+        # Adds the output of the layer in place to the sequences of `padded`,
+        # of shape `(N, T + 2 * offset, C)`, whose padding is left untouched.
+        N, _, C = padded.shape
+        T = padded.shape[1] - 2 * offset
+        x = padded[:, offset:offset + T]
+        hidden = self.weight1.shape[-1]
+        z = _buffer(buffers, 'hidden', (N, T, hidden), x)
+        z = self._conv1(padded, offset, z)
+        if self.norm1_weight is not None:
+            _group_norm_(z, self.norm1_weight, self.norm1_bias, self.eps1)
+        if self.gelu:
+            z = F.gelu(z)
+        else:
+            z = F.relu_(z)
+        u = _buffer(buffers, 'glu', (N * T, 2 * C), x)
+        torch.addmm(self.bias2, z.view(N * T, hidden), self.weight2, out=u)
+        u = u.view(N, T, 2 * C)
+        if self.norm2_weight is not None:
+            _group_norm_(u, self.norm2_weight, self.norm2_bias, self.eps2)
+        a, b = u.chunk(2, dim=-1)
+        x.addcmul_(a, b.sigmoid_())
+
+
+def _buffer(buffers: tp.Dict[str, torch.Tensor], name: str, shape: tp.Tuple[int, ...],
+            like: torch.Tensor) -> torch.Tensor:
+    # Intermediate buffer shared by the layers of a `FusedDConv` during one call.
+    if name not in buffers:
+        buffers[name] = like.new_empty(shape)
+    return buffers[name]
+
+
+class FusedDConv(nn.Module):
+    """
+    Inference only version of a `DConv`, with the same output up to the rounding of
+    the reordered sums, see `fuse_dconv`.
+    Only `DConv` without LSTM nor attention are supported, see `FusedDConv.can_fuse`.
+
+    The computation is done in a channel last layout, each sequence being zero padded
+    once in a buffer shared by all the layers, with the convolutions computed
+    as matrix products, the LayerScale folded into the last norm, the GLU and residual
+    connection fused, and intermediate buffers reused across layers.
+    Takes either a `(B, C, T)` input, like `DConv`, or a `(B, C, Fr, T)` input,
+    in which case each frequency is processed independently, without having to move it
+    into the batch dimension first, and the output is in the channels last memory format.
+    """
+    def __init__(self, dconv: DConv):
+        super().__init__()
+        if not self.can_fuse(dconv):
+            raise ValueError("Only DConv without LSTM nor attention can be fused.")
+        self.channels = dconv.channels
+        self.layers = nn.ModuleList([_FusedDConvLayer(layer) for layer in dconv.layers])
+
+    @staticmethod
+    def can_fuse(dconv: DConv) -> bool:
+        return all(len(layer) == 7 for layer in dconv.layers)
+
+    def forward(self, x):
+        if torch.is_grad_enabled() and x.requires_grad:
+            raise RuntimeError("FusedDConv only supports inference.")
+        if x.dim() == 4:
+            B, C, Fr, T = x.shape
+            seqs = x.permute(0, 2, 3, 1)
+        else:
+            B, C, T = x.shape
+            seqs = x.transpose(1, 2)
+        offset = max(layer.padding for layer in self.layers)
+        padded = x.new_zeros(seqs.shape[:-2].numel(), T + 2 * offset, C)
+        out = padded[:, offset:offset + T]
+        out.view(seqs.shape).copy_(seqs)
+        buffers: tp.Dict[str, torch.Tensor] = {}
+        for layer in self.layers:
+            layer(padded, offset, buffers)
+        if x.dim() == 4:
+            out = out.view(B, Fr, T, C).permute(0, 3, 1, 2)
+            return out.contiguous(memory_format=torch.channels_last)
+        return out.transpose(1, 2)
+
+
+def fuse_dconv(model: nn.Module) -> int:
+    """
+    Replace in place the `DConv` residual branches of `model` with `FusedDConv`
+    when possible, for faster inference on CPU. The model can no longer be trained.
+    Returns the number of branches replaced.
+    """
+    count = 0
+    for module in list(model.modules()):
+        for name, child in module.named_children():
+            if isinstance(child, DConv) and FusedDConv.can_fuse(child):
+                setattr(module, name, FusedDConv(child))
+                count += 1
+    return count
+
+
 class LocalState(nn.Module):
     """Local state allows to have attention based only on data (no positional embedding),
     but while setting a constraint on the time window (e.g. decaying penalty term).
@@ -413,7 +591,7 @@ class Demucs(nn.Module):
         x = F.pad(x, (delta // 2, delta - delta // 2))
 
         if self.resample:
-            x = julius.resample_frac(x, 1, 2)
+            x = get_resampler(1, 2, x.device, x.dtype)(x)
 
         saved = []
         for encode in self.encoder:
@@ -429,13 +607,13 @@ class Demucs(nn.Module):
             x = decode(x + skip)
 
         if self.resample:
-            x = julius.resample_frac(x, 2, 1)
+            x = get_resampler(2, 1, x.device, x.dtype)(x)
         x = x * std + mean
         x = center_trim(x, length)
         x = x.view(x.size(0), len(self.sources), self.audio_channels, x.size(-1))
         return x
 
-    def load_state_dict(self, state, strict=True):
+    def load_state_dict(self, state, strict=True, assign=False):
         # fix a mismatch with previous generation Demucs models.
         for idx in range(self.depth):
             for a in ['encoder', 'decoder']:
@@ -444,4 +622,4 @@ class Demucs(nn.Module):
                     old = f'{a}.{idx}.2.{b}'
                     if old in state and new not in state:
                         state[new] = state.pop(old)
-        super().load_state_dict(state, strict=strict)
+        super().load_state_dict(state, strict=strict, assign=assign)
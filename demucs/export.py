@@ -0,0 +1,206 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Inference only version of `HTDemucs`, with a static graph that can be traced
+with TorchScript or compiled with `torch.compile`, see `demucs.states.export_model`.
+
+The model is split in two: `HTDemucsCore` contains the normalization, the encoders,
+the cross transformer and the decoders, only manipulates real tensors of fixed shapes
+and is the part that gets compiled, while `FrozenHTDemucs` handles the padding,
+the STFT, the masking and the iSTFT around it, in eager mode.
+"""
+import typing as tp
+
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+from .filtering import wiener
+from .htdemucs import HTDemucs
+from .utils import full_precision
+
+EXPORT_METHODS = ['torchscript', 'compile', 'eager']
+
+
+class HTDemucsCore(nn.Module):
+    """
+    Encoders, cross transformer and decoders of `model`, sharing its parameters.
+    Compared with `HTDemucs.forward`, the training and variable length logic is gone,
+    the frequency embedding is precomputed and the positional embeddings of the
+    transformer must have been frozen with `HTDemucs.freeze_embeddings`.
+
+    Takes the magnitude of the spectrogram of the mixture, of shape `(B, C, Fr, T)`,
+    and the mixture, of shape `(B, audio_channels, length)`, and returns the
+    estimates of both branches, de-normalized, with shapes `(B, S, C, Fr, T)` and
+    `(B, S, audio_channels, length)`.
+    """
+    def __init__(self, model: HTDemucs):
+        super().__init__()
+        self.sources = len(model.sources)
+        self.encoder = model.encoder
+        self.decoder = model.decoder
+        self.tencoder = model.tencoder
+        self.tdecoder = model.tdecoder
+        self.crosstransformer = model.crosstransformer
+        self.bottom_channels = model.bottom_channels
+        if self.bottom_channels:
+            self.channel_upsampler = model.channel_upsampler
+            self.channel_downsampler = model.channel_downsampler
+            self.channel_upsampler_t = model.channel_upsampler_t
+            self.channel_downsampler_t = model.channel_downsampler_t
+        self.freq_emb: tp.Optional[torch.Tensor]
+        if model.freq_emb is None:
+            self.freq_emb = None
+        else:
+            parameter = next(iter(model.freq_emb.parameters()))
+            frs = torch.arange(model.freq_emb.embedding.num_embeddings, device=parameter.device)
+            with torch.no_grad():
+                emb = model.freq_emb(frs).t()[None, :, :, None]
+            self.register_buffer('freq_emb', model.freq_emb_scale * emb, persistent=False)
+
+    def forward(self, mag: torch.Tensor, mix: torch.Tensor):
+        B, C, Fq, T = mag.shape
+        length = mix.shape[-1]
+        mean = mag.mean(dim=(1, 2, 3), keepdim=True)
+        std = mag.std(dim=(1, 2, 3), keepdim=True)
+        x = (mag - mean) / (1e-5 + std)
+        meant = mix.mean(dim=(1, 2), keepdim=True)
+        stdt = mix.std(dim=(1, 2), keepdim=True)
+        xt = (mix - meant) / (1e-5 + stdt)
+
+        saved = []
+        saved_t = []
+        lengths = []
+        lengths_t = []
+        for idx, encode in enumerate(self.encoder):
+            lengths.append(x.shape[-1])
+            inject = None
+            if idx < len(self.tencoder):
+                lengths_t.append(xt.shape[-1])
+                tenc = self.tencoder[idx]
+                xt = tenc(xt)
+                if not tenc.empty:
+                    saved_t.append(xt)
+                else:
+                    inject = xt
+            x = encode(x, inject)
+            if idx == 0 and self.freq_emb is not None:
+                x = x + self.freq_emb
+            saved.append(x)
+
+        if self.crosstransformer is not None:
+            if self.bottom_channels:
+                b, c, f, t = x.shape
+                x = self.channel_upsampler(x.reshape(b, c, f * t)).view(b, -1, f, t)
+                xt = self.channel_upsampler_t(xt)
+            x, xt = self.crosstransformer(x, xt)
+            if self.bottom_channels:
+                b, c, f, t = x.shape
+                x = self.channel_downsampler(x.reshape(b, c, f * t)).view(b, -1, f, t)
+                xt = self.channel_downsampler_t(xt)
+
+        offset = len(self.decoder) - len(self.tdecoder)
+        for idx, decode in enumerate(self.decoder):
+            x, pre = decode(x, saved.pop(-1), lengths.pop(-1))
+            if idx >= offset:
+                tdec = self.tdecoder[idx - offset]
+                length_t = lengths_t.pop(-1)
+                if tdec.empty:
+                    xt, _ = tdec(pre[:, :, 0], None, length_t)
+                else:
+                    xt, _ = tdec(xt, saved_t.pop(-1), length_t)
+
+        S = self.sources
+        # The de-normalization is always done in float32.
+        x = x.view(B, S, -1, Fq, T).float() * std[:, None] + mean[:, None]
+        xt = xt.view(B, S, -1, length).float() * stdt[:, None] + meant[:, None]
+        return x, xt
+
+
+class FixedLengthModel(nn.Module):
+    """
+    Base class of the exported models, which handle inputs of at most `length` samples,
+    with `length` the training length (`segment * samplerate`), shorter inputs being
+    padded as done by `HTDemucs`. They can be used with `apply_model` and `BagOfModels`,
+    which never change their segment.
+    """
+    def __init__(self, sources: tp.List[str], samplerate: int, audio_channels: int,
+                 segment: float):
+        super().__init__()
+        self.sources = sources
+        self.samplerate = samplerate
+        self.audio_channels = audio_channels
+        self.segment = segment
+        self.length = int(segment * samplerate)
+
+    def valid_length(self, length: int):
+        if length > self.length:
+            raise ValueError(
+                f"Given length {length} is longer than the exported length {self.length}")
+        return self.length
+
+
+class FrozenHTDemucs(FixedLengthModel):
+    """
+    Inference only `HTDemucs`, whose output is the same as the one of `model` in eval mode.
+
+    The `core` attribute is a `HTDemucsCore`, which can be replaced by a traced or
+    compiled version of itself, see `demucs.states.export_model`.
+    Note that `model` is put in eval mode and its positional embeddings are frozen.
+    """
+    def __init__(self, model: HTDemucs):
+        if not model.use_train_segment:
+            raise ValueError("Only models with use_train_segment=True can be exported.")
+        super().__init__(model.sources, model.samplerate, model.audio_channels, model.segment)
+        model.eval()
+        self.cac = model.cac
+        self.wiener_iters = model.wiener_iters
+        self.wiener_residual = model.wiener_residual
+        self.spectro = model.spectro
+        model.freeze_embeddings()
+        self.core: nn.Module = HTDemucsCore(model)
+        self.eval()
+
+    @full_precision
+    def _spec(self, x):
+        return self.spectro.stft(x)
+
+    @full_precision
+    def _ispec(self, z, length):
+        return self.spectro.istft(z, length)
+
+    def _magnitude(self, z):
+        if self.cac:
+            B, C, Fr, T = z.shape
+            return torch.view_as_real(z).permute(0, 1, 4, 2, 3).reshape(B, C * 2, Fr, T)
+        return z.abs()
+
+    @full_precision
+    def _mask(self, z, m):
+        if self.cac:
+            B, S, C, Fr, T = m.shape
+            out = m.view(B, S, -1, 2, Fr, T).permute(0, 1, 2, 4, 5, 3)
+            return torch.view_as_complex(out.contiguous())
+        if self.wiener_iters < 0:
+            z = z[:, None]
+            return z / (1e-8 + z.abs()) * m
+        return wiener(m, z, self.wiener_iters, residual=self.wiener_residual).to(z.dtype)
+
+    def example_inputs(self, batch_size: int = 1, device=None) -> tp.Tuple[torch.Tensor, ...]:
+        """Inputs of `core` for a batch of silent mixtures, used for tracing."""
+        mix = torch.zeros(batch_size, self.audio_channels, self.length, device=device)
+        return self._magnitude(self._spec(mix)), mix
+
+    def forward(self, mix):
+        length = mix.shape[-1]
+        if length < self.length:
+            mix = F.pad(mix, (0, self.length - length))
+        elif length > self.length:
+            self.valid_length(length)
+        z = self._spec(mix)
+        x, xt = self.core(self._magnitude(z), mix)
+        x = self._ispec(self._mask(z, x), self.length)
+        return (xt + x)[..., :length]
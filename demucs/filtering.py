@@ -0,0 +1,106 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Batched multichannel Wiener filtering, with expectation maximization (EM).
+
+This follows `openunmix.filtering.wiener`, which processes a single window of frames
+of a single example at a time, but here all the examples and all the windows
+are processed at once, using native complex tensors.
+"""
+import math
+
+import torch
+from torch.nn import functional as F
+
+
+def _invert(M: torch.Tensor) -> torch.Tensor:
+    # Inverse of a batch of CxC complex matrices, with a closed form for C <= 2.
+    C = M.shape[-1]
+    if C == 1:
+        return 1 / M
+    elif C == 2:
+        a, b = M[..., 0, 0], M[..., 0, 1]
+        c, d = M[..., 1, 0], M[..., 1, 1]
+        inv_det = 1 / (a * d - b * c)
+        return torch.stack([
+            torch.stack([d, -b], dim=-1),
+            torch.stack([-c, a], dim=-1),
+        ], dim=-2) * inv_det[..., None, None]
+    else:
+        return torch.linalg.inv(M)
+
+
+def _to_windows(x: torch.Tensor, window: int) -> torch.Tensor:
+    # (B, *OTHER, T) -> (B * windows, *OTHER, window), zero padding the last window.
+    B, *other, T = x.shape
+    windows = math.ceil(T / window)
+    x = F.pad(x, (0, windows * window - T))
+    x = x.view(B, *other, windows, window)
+    dims = len(other)
+    x = x.permute(0, dims + 1, *range(1, dims + 1), dims + 2)
+    return x.reshape(B * windows, *other, window)
+
+
+def wiener(mag_out: torch.Tensor, mix_stft: torch.Tensor, niters: int,
+           residual: bool = False, window: int = 300, eps: float = 1e-10,
+           scale_factor: float = 10.) -> torch.Tensor:
+    """
+    Wiener filtering of `mix_stft` given the magnitude estimates `mag_out`, followed
+    by `niters` iterations of EM. The frames are split into independent windows of
+    `window` frames, as done by the original HDemucs implementation.
+
+    Args:
+        mag_out (Tensor): magnitudes of the sources, shape `(B, S, C, Fr, T)`.
+        mix_stft (Tensor): complex spectrogram of the mixture, shape `(B, C, Fr, T)`.
+        niters (int): number of EM iterations.
+        residual (bool): if True, an extra source equal to the mixture minus
+            the other sources is used during the EM, and then dropped.
+        window (int): number of frames processed together.
+        eps (float): regularization, see `openunmix.filtering.wiener`.
+        scale_factor (float): the spectrograms of each window are scaled down so that
+            the maximum magnitude of the mixture is at most `scale_factor`.
+
+    Returns:
+        Complex spectrograms of the sources, with shape `(B, S, C, Fr, T)`.
+    """
+    B, S, C, Fr, T = mag_out.shape
+    # Each of the P = B * windows problems is independent. Layouts are (P, Fr, C, W)
+    # for the mixture and (P, S, Fr, C, W) for the sources, with W the window size.
+    x = _to_windows(mix_stft.transpose(1, 2), window)
+    mag = _to_windows(mag_out.transpose(2, 3), window)
+    P = x.shape[0]
+
+    # Initial estimate, using the phase of the mixture.
+    phase = torch.angle(x)
+    y = torch.polar(mag, phase[:, None].expand_as(mag))
+    if residual:
+        y = torch.cat([y, x[:, None] - y.sum(dim=1, keepdim=True)], dim=1)
+
+    if niters > 0:
+        # Scale down each problem for numerical stability.
+        max_abs = (x.abs().amax(dim=(1, 2, 3)) / scale_factor).clamp(min=1.)
+        x = x / max_abs[:, None, None, None]
+        y = y / max_abs[:, None, None, None, None]
+        regularization = math.sqrt(eps) * torch.eye(C, dtype=x.dtype, device=x.device)
+        for _ in range(niters):
+            # Power spectral densities, shape (P, S, Fr, W).
+            v = (y.real ** 2 + y.imag ** 2).mean(dim=-2)
+            # Spatial covariance matrices, shape (P, S, Fr, C, C).
+            R = y @ y.transpose(-1, -2).conj()
+            R = R / (eps + v.sum(dim=-1))[..., None, None]
+            # Covariance of the mixture, shape (P, Fr, W, C, C).
+            Cxx = torch.einsum("psfw,psfcd->pfwcd", v.to(R.dtype), R) + regularization
+            # The Wiener gain of each source is v_j R_j inv(Cxx), so that we can
+            # compute inv(Cxx) x only once for all the sources.
+            z = (_invert(Cxx) @ x.transpose(-1, -2)[..., None])[..., 0].transpose(-1, -2)
+            y = (R @ z[:, None]) * v[:, :, :, None]
+        y = y * max_abs[:, None, None, None, None]
+
+    if residual:
+        y = y[:, :S]
+    # Back to (B, S, C, Fr, T).
+    y = y.reshape(B, P // B, S, Fr, C, window).permute(0, 2, 4, 3, 1, 5)
+    return y.reshape(B, S, C, Fr, -1)[..., :T].contiguous()
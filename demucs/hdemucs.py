@@ -7,17 +7,21 @@
 This code contains the spectrogram and Hybrid version of Demucs.
 """
 import math
+import threading
 import typing as tp
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
+from functools import partial
 
 import torch
-from openunmix.filtering import wiener
 from torch import nn
 from torch.nn import functional as F
 
-from .demucs import DConv, rescale_module
-from .spec import ispectro, spectro
+from .demucs import DConv, FusedDConv, rescale_module
+from .filtering import wiener
+from .spec import HybridSpectro, ispectro, spectro
 from .states import capture_init
+from .utils import full_precision
 
 
 def pad1d(x: torch.Tensor, paddings: tp.Tuple[int, int], mode: str = 'constant', value: float = 0.):
@@ -66,6 +70,16 @@ class ScaledEmbedding(nn.Module):
         return out
 
 
+def _apply_dconv(dconv: nn.Module, y: torch.Tensor, freq: bool) -> torch.Tensor:
+    # For frequency layers, each frequency goes through the `DConv` independently.
+    if not freq or isinstance(dconv, FusedDConv):
+        return dconv(y)
+    B, C, Fr, T = y.shape
+    y = y.permute(0, 2, 1, 3).reshape(-1, C, T)
+    y = dconv(y)
+    return y.view(B, Fr, C, T).permute(0, 2, 1, 3)
+
+
 class HEncLayer(nn.Module):
     def __init__(self, chin, chout, kernel_size=8, stride=4, norm_groups=1, empty=False,
                  freq=True, dconv=True, norm=True, context=0, dconv_kw={}, pad=True,
@@ -143,12 +157,7 @@ class HEncLayer(nn.Module):
             y = y + inject
         y = F.gelu(self.norm1(y))
         if self.dconv:
-            if self.freq:
-                B, C, Fr, T = y.shape
-                y = y.permute(0, 2, 1, 3).reshape(-1, C, T)
-            y = self.dconv(y)
-            if self.freq:
-                y = y.view(B, Fr, C, T).permute(0, 2, 1, 3)
+            y = _apply_dconv(self.dconv, y, self.freq)
         if self.rewrite:
             z = self.norm2(self.rewrite(y))
             z = F.glu(z, dim=1)
@@ -157,6 +166,39 @@ class HEncLayer(nn.Module):
         return z
 
 
+def _autocast_enabled() -> bool:
+    try:
+        return any(torch.is_autocast_enabled(device) for device in ['cpu', 'cuda'])
+    except TypeError:
+        # PyTorch < 2.4
+        return torch.is_autocast_enabled() or torch.is_autocast_cpu_enabled()
+
+
+# Thread pools shared by all the `MultiWrap` layers, per number of workers.
+_pools: tp.Dict[int, ThreadPoolExecutor] = {}
+_pools_lock = threading.Lock()
+
+
+def _get_pool(workers: int) -> ThreadPoolExecutor:
+    # Created on first use, then kept for the lifetime of the process, rather than
+    # starting new threads for every forward of every layer.
+    with _pools_lock:
+        if workers not in _pools:
+            _pools[workers] = ThreadPoolExecutor(workers, thread_name_prefix='multiwrap')
+        return _pools[workers]
+
+
+def set_multiwrap_workers(model: nn.Module, workers: int):
+    """
+    Process the frequency bands of the `MultiWrap` layers of `model` concurrently,
+    with `workers` threads, at inference time. Use 0 to process them one after the other.
+    Autocast being thread local, the bands are always processed sequentially under autocast.
+    """
+    for module in model.modules():
+        if isinstance(module, MultiWrap):
+            module.workers = workers
+
+
 class MultiWrap(nn.Module):
     """
     Takes one layer and replicate it N times. each replica will act
@@ -174,6 +216,9 @@ class MultiWrap(nn.Module):
         """
         super().__init__()
         self.split_ratios = split_ratios
+        # Number of threads used to run the replicas concurrently at inference time,
+        # see `set_multiwrap_workers`.
+        self.workers = 0
         self.layers = nn.ModuleList()
         self.conv = isinstance(layer, HEncLayer)
         assert not layer.norm
@@ -192,12 +237,11 @@ class MultiWrap(nn.Module):
                     m.reset_parameters()
             self.layers.append(lay)
 
-    def forward(self, x, skip=None, length=None):
-        B, C, Fr, T = x.shape
-
+    def _bands(self, Fr: int) -> tp.List[tp.Tuple[int, int]]:
+        # Frequency range `[start, limit)` of the input given to each replica.
         ratios = list(self.split_ratios) + [1]
         start = 0
-        outs = []
+        bands = []
         for ratio, layer in zip(ratios, self.layers):
             if self.conv:
                 pad = layer.kernel_size // 4
@@ -215,18 +259,35 @@ class MultiWrap(nn.Module):
                         limit -= pad
                 assert limit - start > 0, (limit, start)
                 assert limit <= Fr, (limit, Fr)
-                y = x[:, :, start:limit, :]
-                if start == 0:
-                    y = F.pad(y, (0, 0, pad, 0))
-                if ratio == 1:
-                    y = F.pad(y, (0, 0, 0, pad))
-                outs.append(layer(y))
+                bands.append((start, limit))
                 start = limit - layer.kernel_size + layer.stride
             else:
                 if ratio == 1:
                     limit = Fr
                 else:
                     limit = int(round(Fr * ratio))
+                bands.append((start, limit))
+                start = limit
+        return bands
+
+    def forward(self, x, skip=None, length=None):
+        if not self.training and not torch.is_grad_enabled():
+            return self._forward_inference(x, skip)
+        B, C, Fr, T = x.shape
+
+        outs = []
+        bands = self._bands(Fr)
+        for index, ((start, limit), layer) in enumerate(zip(bands, self.layers)):
+            is_last = index == len(bands) - 1
+            if self.conv:
+                pad = layer.kernel_size // 4
+                y = x[:, :, start:limit, :]
+                if start == 0:
+                    y = F.pad(y, (0, 0, pad, 0))
+                if is_last:
+                    y = F.pad(y, (0, 0, 0, pad))
+                outs.append(layer(y))
+            else:
                 last = layer.last
                 layer.last = True
 
@@ -237,13 +298,12 @@ class MultiWrap(nn.Module):
                     outs[-1][:, :, -layer.stride:] += (
                         out[:, :, :layer.stride] - layer.conv_tr.bias.view(1, -1, 1, 1))
                     out = out[:, :, layer.stride:]
-                if ratio == 1:
+                if is_last:
                     out = out[:, :, :-layer.stride // 2, :]
                 if start == 0:
                     out = out[:, :, layer.stride // 2:, :]
                 outs.append(out)
                 layer.last = last
-                start = limit
         out = torch.cat(outs, dim=2)
         if not self.conv and not last:
             out = F.gelu(out)
@@ -252,6 +312,72 @@ class MultiWrap(nn.Module):
         else:
             return out, None
 
+    def _run_replicas(self, calls: tp.List[tp.Callable[[], torch.Tensor]]) -> tp.List[torch.Tensor]:
+        if self.workers <= 1 or _autocast_enabled():
+            return [call() for call in calls]
+
+        def run(call):
+            # Grad mode is thread local.
+            with torch.no_grad():
+                return call()
+        futures = [_get_pool(self.workers).submit(run, call) for call in calls]
+        return [future.result() for future in futures]
+
+    def _forward_inference(self, x, skip):
+        # Same as `forward`, but the input is padded only once, the replicas can run
+        # concurrently, see `workers`, and their outputs, along with the corrections
+        # for the overlap between bands, are written directly into the final output.
+        B, C, Fr, T = x.shape
+        bands = self._bands(Fr)
+        calls = []
+        if self.conv:
+            pad = self.layers[0].kernel_size // 4
+            x = F.pad(x, (0, 0, pad, pad))
+            for index, ((start, limit), layer) in enumerate(zip(bands, self.layers)):
+                begin = start + pad if start else 0
+                end = limit + pad + (pad if index == len(bands) - 1 else 0)
+                calls.append(partial(layer, x[:, :, begin:end]))
+        else:
+            for (start, limit), layer in zip(bands, self.layers):
+                calls.append(partial(self._decode_band, layer, x[:, :, start:limit],
+                                     skip[:, :, start:limit]))
+        outs = self._run_replicas(calls)
+        if self.conv:
+            out = outs[0].new_empty(B, outs[0].shape[1], sum(o.shape[2] for o in outs), T)
+            offset = 0
+            for band in outs:
+                out[:, :, offset:offset + band.shape[2]] = band
+                offset += band.shape[2]
+            return out
+
+        stride = self.layers[0].stride
+        sizes = [band.shape[2] - stride for band in outs]
+        sizes[0] += stride - stride // 2
+        sizes[-1] -= stride // 2
+        out = outs[0].new_empty(B, outs[0].shape[1], sum(sizes), T)
+        offset = 0
+        for index, (band, layer) in enumerate(zip(outs, self.layers)):
+            if index:
+                out[:, :, offset - stride:offset] += (
+                    band[:, :, :stride] - layer.conv_tr.bias.view(1, -1, 1, 1))
+                band = band[:, :, stride:]
+            else:
+                band = band[:, :, stride // 2:]
+            out[:, :, offset:offset + sizes[index]] = band[:, :, :sizes[index]]
+            offset += sizes[index]
+        if not self.layers[-1].last:
+            out = F.gelu(out)
+        return out, None
+
+    def _decode_band(self, layer, x, skip):
+        last = layer.last
+        layer.last = True
+        try:
+            out, _ = layer(x, skip, None)
+        finally:
+            layer.last = last
+        return out
+
 
 class HDecLayer(nn.Module):
     def __init__(self, chin, chout, last=False, kernel_size=8, stride=4, norm_groups=1, empty=False,
@@ -314,12 +440,7 @@ class HDecLayer(nn.Module):
             else:
                 y = x
             if self.dconv:
-                if self.freq:
-                    B, C, Fr, T = y.shape
-                    y = y.permute(0, 2, 1, 3).reshape(-1, C, T)
-                y = self.dconv(y)
-                if self.freq:
-                    y = y.view(B, Fr, C, T).permute(0, 2, 1, 3)
+                y = _apply_dconv(self.dconv, y, self.freq)
         else:
             y = x
             assert skip is None
@@ -466,6 +587,7 @@ class HDemucs(nn.Module):
 
         self.nfft = nfft
         self.hop_length = nfft // 4
+        self.spectro = HybridSpectro(nfft, self.hop_length)
         self.wiener_iters = wiener_iters
         self.end_iters = end_iters
         self.freq_emb = None
@@ -584,11 +706,17 @@ class HDemucs(nn.Module):
         if rescale:
             rescale_module(self, reference=rescale)
 
+    @full_precision
     def _spec(self, x):
         hl = self.hop_length
         nfft = self.nfft
         x0 = x  # noqa
 
+        if self.hybrid and not self.hybrid_old:
+            # `HybridSpectro` pads the signal and trims the spectrogram in a single pass,
+            # with the same result as below.
+            return self.spectro.stft(x)
+
         if self.hybrid:
             # We re-pad the signal in order to keep the property
             # that the size of the output is exactly the size of the input
@@ -600,10 +728,8 @@ class HDemucs(nn.Module):
             assert hl == nfft // 4
             le = int(math.ceil(x.shape[-1] / hl))
             pad = hl // 2 * 3
-            if not self.hybrid_old:
-                x = pad1d(x, (pad, pad + le * hl - x.shape[-1]), mode='reflect')
-            else:
-                x = pad1d(x, (pad, pad + le * hl - x.shape[-1]))
+            # Only reached with `hybrid_old`, which used zero padding.
+            x = pad1d(x, (pad, pad + le * hl - x.shape[-1]))
 
         z = spectro(x, nfft, hl)[..., :-1, :]
         if self.hybrid:
@@ -611,7 +737,10 @@ class HDemucs(nn.Module):
             z = z[..., 2:2 + le]
         return z
 
+    @full_precision
     def _ispec(self, z, length=None, scale=0):
+        if self.hybrid and not self.hybrid_old and scale == 0:
+            return self.spectro.istft(z, length)
         hl = self.hop_length // (4 ** scale)
         z = F.pad(z, (0, 0, 0, 1))
         if self.hybrid:
@@ -641,6 +770,7 @@ class HDemucs(nn.Module):
             m = z.abs()
         return m
 
+    @full_precision
     def _mask(self, z, m):
         # Apply masking given the mixture spectrogram `z` and the estimated mask `m`.
         # If `cac` is True, `m` is actually a full spectrogram and `z` is ignored.
@@ -658,32 +788,14 @@ class HDemucs(nn.Module):
         else:
             return self._wiener(m, z, niters)
 
+    @full_precision
     def _wiener(self, mag_out, mix_stft, niters):
-        # apply wiener filtering from OpenUnmix.
+        # apply wiener filtering, following OpenUnmix, over windows of 300 frames.
         init = mix_stft.dtype
         wiener_win_len = 300
         residual = self.wiener_residual
-
-        B, S, C, Fq, T = mag_out.shape
-        mag_out = mag_out.permute(0, 4, 3, 2, 1)
-        mix_stft = torch.view_as_real(mix_stft.permute(0, 3, 2, 1))
-
-        outs = []
-        for sample in range(B):
-            pos = 0
-            out = []
-            for pos in range(0, T, wiener_win_len):
-                frame = slice(pos, pos + wiener_win_len)
-                z_out = wiener(
-                    mag_out[sample, frame], mix_stft[sample, frame], niters,
-                    residual=residual)
-                out.append(z_out.transpose(-1, -2))
-            outs.append(torch.cat(out, dim=0))
-        out = torch.view_as_complex(torch.stack(outs, 0))
-        out = out.permute(0, 4, 3, 2, 1).contiguous()
-        if residual:
-            out = out[:, :-1]
-        assert list(out.shape) == [B, S, C, Fq, T]
+        out = wiener(mag_out, mix_stft, niters, residual=residual, window=wiener_win_len)
+        assert list(out.shape) == list(mag_out.shape)
         return out.to(init)
 
     def forward(self, mix):
@@ -769,7 +881,8 @@ class HDemucs(nn.Module):
         assert len(saved_t) == 0
 
         S = len(self.sources)
-        x = x.view(B, S, -1, Fq, T)
+        # The de-normalization is always done in float32.
+        x = x.view(B, S, -1, Fq, T).float()
         x = x * std[:, None] + mean[:, None]
 
         # to cpu as mps doesnt support complex numbers
@@ -789,7 +902,7 @@ class HDemucs(nn.Module):
             x = x.to(x_device)
 
         if self.hybrid:
-            xt = xt.view(B, S, -1, length)
+            xt = xt.view(B, S, -1, length).float()
             xt = xt * stdt[:, None] + meant[:, None]
             x = xt + x
         return x
@@ -12,15 +12,16 @@ from fractions import Fraction
 
 import torch
 from einops import rearrange
-from openunmix.filtering import wiener
 from torch import nn
 from torch.nn import functional as F
 
 from .demucs import rescale_module
-from .hdemucs import HDecLayer, HEncLayer, MultiWrap, ScaledEmbedding, pad1d
-from .spec import ispectro, spectro
+from .filtering import wiener
+from .hdemucs import HDecLayer, HEncLayer, MultiWrap, ScaledEmbedding
+from .spec import HybridSpectro, ispectro
 from .states import capture_init
 from .transformer import CrossTransformerEncoder
+from .utils import full_precision
 
 
 class HTDemucs(nn.Module):
@@ -235,6 +236,7 @@ class HTDemucs(nn.Module):
         self.use_train_segment = use_train_segment
         self.nfft = nfft
         self.hop_length = nfft // 4
+        self.spectro = HybridSpectro(nfft, self.hop_length)
         self.wiener_iters = wiener_iters
         self.end_iters = end_iters
         self.freq_emb = None
@@ -416,11 +418,8 @@ class HTDemucs(nn.Module):
         else:
             self.crosstransformer = None
 
+    @full_precision
     def _spec(self, x):
-        hl = self.hop_length
-        nfft = self.nfft
-        x0 = x  # noqa
-
         # We re-pad the signal in order to keep the property
         # that the size of the output is exactly the size of the input
         # divided by the stride (here hop_length), when divisible.
@@ -428,17 +427,13 @@ class HTDemucs(nn.Module):
         # which is not supported by torch.stft.
         # Having all convolution operations follow this convention allow to easily
         # align the time and frequency branches later on.
-        assert hl == nfft // 4
-        le = int(math.ceil(x.shape[-1] / hl))
-        pad = hl // 2 * 3
-        x = pad1d(x, (pad, pad + le * hl - x.shape[-1]), mode="reflect")
-
-        z = spectro(x, nfft, hl)[..., :-1, :]
-        assert z.shape[-1] == le + 4, (z.shape, x.shape, le)
-        z = z[..., 2: 2 + le]
-        return z
+        # `HybridSpectro` does the padding and the trimming in a single pass.
+        return self.spectro.stft(x)
 
+    @full_precision
     def _ispec(self, z, length=None, scale=0):
+        if scale == 0:
+            return self.spectro.istft(z, length)
         hl = self.hop_length // (4**scale)
         z = F.pad(z, (0, 0, 0, 1))
         z = F.pad(z, (2, 2))
@@ -459,6 +454,7 @@ class HTDemucs(nn.Module):
             m = z.abs()
         return m
 
+    @full_precision
     def _mask(self, z, m):
         # Apply masking given the mixture spectrogram `z` and the estimated mask `m`.
         # If `cac` is True, `m` is actually a full spectrogram and `z` is ignored.
@@ -476,35 +472,14 @@ class HTDemucs(nn.Module):
         else:
             return self._wiener(m, z, niters)
 
+    @full_precision
     def _wiener(self, mag_out, mix_stft, niters):
-        # apply wiener filtering from OpenUnmix.
+        # apply wiener filtering, following OpenUnmix, over windows of 300 frames.
         init = mix_stft.dtype
         wiener_win_len = 300
         residual = self.wiener_residual
-
-        B, S, C, Fq, T = mag_out.shape
-        mag_out = mag_out.permute(0, 4, 3, 2, 1)
-        mix_stft = torch.view_as_real(mix_stft.permute(0, 3, 2, 1))
-
-        outs = []
-        for sample in range(B):
-            pos = 0
-            out = []
-            for pos in range(0, T, wiener_win_len):
-                frame = slice(pos, pos + wiener_win_len)
-                z_out = wiener(
-                    mag_out[sample, frame],
-                    mix_stft[sample, frame],
-                    niters,
-                    residual=residual,
-                )
-                out.append(z_out.transpose(-1, -2))
-            outs.append(torch.cat(out, dim=0))
-        out = torch.view_as_complex(torch.stack(outs, 0))
-        out = out.permute(0, 4, 3, 2, 1).contiguous()
-        if residual:
-            out = out[:, :-1]
-        assert list(out.shape) == [B, S, C, Fq, T]
+        out = wiener(mag_out, mix_stft, niters, residual=residual, window=wiener_win_len)
+        assert list(out.shape) == list(mag_out.shape)
         return out.to(init)
 
     def valid_length(self, length: int):
@@ -523,6 +498,31 @@ class HTDemucs(nn.Module):
                     f"training length {training_length}")
         return training_length
 
+    def freeze_embeddings(self):
+        """
+        Precompute the positional embeddings of the cross transformer for inputs
+        of the training length, e.g. before serving the model. The shapes
+        are obtained by running the model once on silence.
+        """
+        if self.crosstransformer is None:
+            return
+        assert not self.training, "Embeddings can only be frozen in eval mode."
+        shapes = []
+
+        def _hook(module, inputs):
+            shapes.append((inputs[0].shape, inputs[1].shape))
+
+        parameter = next(iter(self.parameters()))
+        handle = self.crosstransformer.register_forward_pre_hook(_hook)
+        try:
+            with torch.no_grad():
+                self(torch.zeros(1, self.audio_channels, self.valid_length(1),
+                                 device=parameter.device))
+        finally:
+            handle.remove()
+        (_, C, Fr, T1), (_, _, T2) = shapes[0]
+        self.crosstransformer.freeze_embeddings(C, Fr, T1, T2, parameter.device, parameter.dtype)
+
     def forward(self, mix):
         length = mix.shape[-1]
         length_pre_pad = None
@@ -621,7 +621,8 @@ class HTDemucs(nn.Module):
         assert len(saved_t) == 0
 
         S = len(self.sources)
-        x = x.view(B, S, -1, Fq, T)
+        # The de-normalization is always done in float32.
+        x = x.view(B, S, -1, Fq, T).float()
         x = x * std[:, None] + mean[:, None]
 
         # to cpu as mps doesnt support complex numbers
@@ -653,7 +654,7 @@ class HTDemucs(nn.Module):
                 xt = xt.view(B, S, -1, training_length)
         else:
             xt = xt.view(B, S, -1, length)
-        xt = xt * stdt[:, None] + meant[:, None]
+        xt = xt.float() * stdt[:, None] + meant[:, None]
         x = xt + x
         if length_pre_pad:
             x = x[..., :length_pre_pad]
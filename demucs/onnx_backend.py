@@ -0,0 +1,257 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+ONNX Runtime backend for `HTDemucs`, for CPU inference without building the model
+and loading its weights with PyTorch.
+
+`export_onnx` exports the core of the model (see `demucs.export.HTDemucsCore`),
+for inputs of the training length, along with the parameters needed to run it.
+`load_onnx` loads it as a `OnnxHTDemucs`, which runs the core with ONNX Runtime,
+while the STFT, the Wiener filtering and the iSTFT are done with NumPy. The result
+can be used with `apply_model`, which handles the chunking and overlap-add as usual.
+
+Requires `onnx` for exporting, and `onnxruntime` for inference.
+"""
+import inspect
+import json
+import math
+import os
+import shutil
+import tempfile
+import typing as tp
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from .apply import BagOfModels, Model
+from .export import FixedLengthModel, FrozenHTDemucs
+from .htdemucs import HTDemucs
+
+METADATA_KEY = 'demucs'
+MANIFEST = 'model.json'
+
+
+def _exporter_kwargs(opset: int) -> dict:
+    kwargs: tp.Dict[str, tp.Any] = {'opset_version': opset}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        # Recent versions of PyTorch default to the dynamo based exporter.
+        kwargs['dynamo'] = False
+    return kwargs
+
+
+@contextmanager
+def _no_mha_fastpath():
+    # The fused attention kernels used by `nn.MultiheadAttention` in eval mode
+    # cannot be exported to ONNX.
+    fastpath = torch.backends.mha.get_fastpath_enabled()
+    torch.backends.mha.set_fastpath_enabled(False)
+    try:
+        yield
+    finally:
+        torch.backends.mha.set_fastpath_enabled(fastpath)
+
+
+def _export_htdemucs(model: HTDemucs, path: Path, opset: int):
+    import onnx
+
+    frozen = FrozenHTDemucs(model.cpu())
+    names = ['mag', 'mix', 'x', 'xt']
+    with torch.no_grad(), _no_mha_fastpath():
+        torch.onnx.export(frozen.core, frozen.example_inputs(), str(path),
+                          input_names=names[:2], output_names=names[2:],
+                          dynamic_axes={name: {0: 'batch'} for name in names},
+                          **_exporter_kwargs(opset))
+    metadata = {
+        'sources': list(frozen.sources),
+        'samplerate': frozen.samplerate,
+        'audio_channels': frozen.audio_channels,
+        'segment': float(frozen.segment),
+        'length': frozen.length,
+        'nfft': model.nfft,
+        'hop_length': model.hop_length,
+        'cac': frozen.cac,
+        'wiener_iters': frozen.wiener_iters,
+        'wiener_residual': frozen.wiener_residual,
+    }
+    proto = onnx.load(str(path))
+    entry = proto.metadata_props.add()
+    entry.key = METADATA_KEY
+    entry.value = json.dumps(metadata)
+    onnx.save(proto, str(path))
+
+
+def export_onnx(model: tp.Union[BagOfModels, Model], folder: tp.Union[str, Path],
+                opset: int = 17):
+    """
+    Export `model`, either a `HTDemucs` or a bag of them, to `folder`, with one ONNX file
+    per model, and a manifest describing the bag. The models are moved to CPU.
+    The files are exported to a temporary folder, then moved to `folder`, the manifest last,
+    so that processes exporting the same model at once never see a partial export.
+    """
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    if isinstance(model, BagOfModels):
+        models = list(model.models)
+        weights: tp.Optional[tp.List[tp.List[float]]] = model.weights
+    else:
+        models = [model]
+        weights = None
+    for sub in models:
+        if not isinstance(sub, HTDemucs):
+            raise ValueError(f"Only HTDemucs models can be exported to ONNX, "
+                             f"got {sub.__class__.__name__}.")
+    files = [f"{index}.onnx" for index in range(len(models))]
+    tmp = Path(tempfile.mkdtemp(dir=folder, prefix='.export-'))
+    try:
+        for sub, name in zip(models, files):
+            _export_htdemucs(sub, tmp / name, opset)
+        manifest = {'bag': isinstance(model, BagOfModels), 'models': files, 'weights': weights}
+        (tmp / MANIFEST).write_text(json.dumps(manifest, indent=2))
+        for name in files + [MANIFEST]:
+            os.replace(tmp / name, folder / name)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def has_onnx(folder: tp.Union[str, Path]) -> bool:
+    """Return True if `folder` contains a model exported with `export_onnx`."""
+    return (Path(folder) / MANIFEST).exists()
+
+
+def load_onnx(folder: tp.Union[str, Path], num_threads: tp.Optional[int] = None):
+    """
+    Load a model exported with `export_onnx` from `folder`, returning either a `OnnxHTDemucs`
+    or a `BagOfModels` of them. `num_threads` is the number of threads used by
+    ONNX Runtime for each model, default to the number of cores.
+    """
+    folder = Path(folder)
+    manifest = json.loads((folder / MANIFEST).read_text())
+    models = [OnnxHTDemucs(folder / name, num_threads) for name in manifest['models']]
+    if manifest['bag']:
+        return BagOfModels(models, manifest['weights'])
+    return models[0]
+
+
+def _wiener(mag_out: np.ndarray, mix_stft: np.ndarray, niters: int, residual: bool,
+            window: int = 300, eps: float = 1e-10, scale_factor: float = 10.) -> np.ndarray:
+    # NumPy version of `demucs.filtering.wiener`.
+    B, S, C, Fr, T = mag_out.shape
+    windows = math.ceil(T / window)
+    pad = windows * window - T
+    x = np.pad(mix_stft, [(0, 0)] * 3 + [(0, pad)])
+    mag = np.pad(mag_out, [(0, 0)] * 4 + [(0, pad)])
+    # Layouts are (P, Fr, C, W) and (P, S, Fr, C, W), with P = B * windows.
+    x = x.reshape(B, C, Fr, windows, window).transpose(0, 3, 2, 1, 4)
+    x = x.reshape(-1, Fr, C, window)
+    mag = mag.reshape(B, S, C, Fr, windows, window).transpose(0, 4, 1, 3, 2, 5)
+    mag = mag.reshape(-1, S, Fr, C, window)
+    P = x.shape[0]
+
+    y = mag * np.exp(1j * np.angle(x))[:, None]
+    if residual:
+        y = np.concatenate([y, x[:, None] - y.sum(axis=1, keepdims=True)], axis=1)
+    if niters > 0:
+        max_abs = np.maximum(np.abs(x).max(axis=(1, 2, 3)) / scale_factor, 1.)
+        x = x / max_abs[:, None, None, None]
+        y = y / max_abs[:, None, None, None, None]
+        regularization = math.sqrt(eps) * np.eye(C)
+        for _ in range(niters):
+            v = (np.abs(y) ** 2).mean(axis=-2)
+            R = y @ np.conj(y.swapaxes(-1, -2))
+            R = R / (eps + v.sum(axis=-1))[..., None, None]
+            Cxx = np.einsum("psfw,psfcd->pfwcd", v, R) + regularization
+            z = (np.linalg.inv(Cxx) @ x.swapaxes(-1, -2)[..., None])[..., 0].swapaxes(-1, -2)
+            y = (R @ z[:, None]) * v[:, :, :, None]
+        y = y * max_abs[:, None, None, None, None]
+    if residual:
+        y = y[:, :S]
+    y = y.reshape(B, P // B, S, Fr, C, window).transpose(0, 2, 4, 3, 1, 5)
+    return y.reshape(B, S, C, Fr, -1)[..., :T]
+
+
+class OnnxHTDemucs(FixedLengthModel):
+    """
+    `HTDemucs` exported with `export_onnx`, running on CPU with ONNX Runtime.
+    Inputs and outputs are PyTorch tensors, so that it can be used with `apply_model`.
+    """
+    def __init__(self, path: tp.Union[str, Path], num_threads: tp.Optional[int] = None):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        session = onnxruntime.InferenceSession(
+            str(path), options, providers=['CPUExecutionProvider'])
+        meta = json.loads(session.get_modelmeta().custom_metadata_map[METADATA_KEY])
+        super().__init__(meta['sources'], meta['samplerate'], meta['audio_channels'],
+                         meta['segment'])
+        self.session = session
+        self.length = meta['length']
+        self.nfft = meta['nfft']
+        self.hop_length = meta['hop_length']
+        self.cac = meta['cac']
+        self.wiener_iters = meta['wiener_iters']
+        self.wiener_residual = meta['wiener_residual']
+        # Same framing as `demucs.spec.HybridSpectro`.
+        self.pad = self.hop_length // 2 * 3
+        n = np.arange(self.nfft)
+        self.window = (0.5 - 0.5 * np.cos(2 * np.pi * n / self.nfft)).astype(np.float32)
+        overlap = self.nfft // self.hop_length
+        envelope = (self.window ** 2).reshape(overlap, self.hop_length).sum(axis=0)
+        self.synthesis_window = self.window / np.tile(envelope, overlap)
+
+    def _spec(self, x: np.ndarray) -> np.ndarray:
+        *other, length = x.shape
+        le = int(math.ceil(length / self.hop_length))
+        x = x.reshape(-1, length)
+        x = np.pad(x, [(0, 0), (self.pad, self.pad + le * self.hop_length - length)],
+                   mode='reflect')
+        frames = np.lib.stride_tricks.sliding_window_view(x, self.nfft, axis=-1)
+        frames = frames[:, ::self.hop_length] * self.window
+        z = np.fft.rfft(frames, axis=-1, norm='ortho')[..., :-1].astype(np.complex64)
+        return z.swapaxes(-1, -2).reshape(*other, self.nfft // 2, le)
+
+    def _ispec(self, z: np.ndarray, length: int) -> np.ndarray:
+        *other, freqs, frames = z.shape
+        z = z.reshape(-1, freqs, frames).swapaxes(-1, -2)
+        signals = np.fft.irfft(z, self.nfft, axis=-1, norm='ortho') * self.synthesis_window
+        overlap = self.nfft // self.hop_length
+        signals = signals.reshape(-1, frames, overlap, self.hop_length)
+        x = np.zeros((signals.shape[0], frames + overlap - 1, self.hop_length), np.float32)
+        for chunk in range(overlap):
+            x[:, chunk: chunk + frames] += signals[:, :, chunk]
+        x = x.reshape(x.shape[0], -1)[:, self.pad: self.pad + length]
+        return x.reshape(*other, length)
+
+    def _magnitude(self, z: np.ndarray) -> np.ndarray:
+        if self.cac:
+            B, C, Fr, T = z.shape
+            m = np.stack([z.real, z.imag], axis=2)
+            return m.reshape(B, C * 2, Fr, T)
+        return np.abs(z)
+
+    def _mask(self, z: np.ndarray, m: np.ndarray) -> np.ndarray:
+        if self.cac:
+            B, S, C, Fr, T = m.shape
+            m = m.reshape(B, S, -1, 2, Fr, T)
+            return m[:, :, :, 0] + 1j * m[:, :, :, 1]
+        if self.wiener_iters < 0:
+            z = z[:, None]
+            return z / (1e-8 + np.abs(z)) * m
+        return _wiener(m, z, self.wiener_iters, self.wiener_residual)
+
+    def forward(self, mix: torch.Tensor) -> torch.Tensor:
+        length = mix.shape[-1]
+        self.valid_length(length)
+        x = mix.detach().cpu().float().numpy()
+        x = np.pad(x, [(0, 0), (0, 0), (0, self.length - length)])
+        z = self._spec(x)
+        mag = np.ascontiguousarray(self._magnitude(z), dtype=np.float32)
+        out, out_t = self.session.run(['x', 'xt'], {'mag': mag, 'mix': x})
+        out = self._ispec(self._mask(z, out), self.length) + out_t
+        return torch.from_numpy(np.ascontiguousarray(out[..., :length])).to(mix.device)
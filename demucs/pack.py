@@ -0,0 +1,142 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Pack a dataset of tracks into memory mapped shards, for training.
+
+`Wavset` opens, decodes and resamples one file per source for each example. Once packed,
+all the sources of a track are stored interleaved as a float32 array of shape
+`[time, sources, channels]`, at the training sample rate and number of channels, in large
+`.npy` shards along with a `shards.json` index, so that `ShardedWavset` reads each example
+as a single contiguous slice of one file. Pack the `train` and `valid` folders with
+
+    python -m demucs.pack /path/to/dataset /path/to/packed --sources drums bass other vocals
+
+then use `dset.wav=/path/to/packed`: `get_wav_datasets` picks the shards automatically.
+"""
+
+import argparse
+import json
+import math
+import typing as tp
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import torch as th
+import torchaudio as ta
+import tqdm
+from torch.nn import functional as F
+
+from .audio import convert_audio_channels, get_resampler
+from .utils import atomic_write
+from .wav import EXT, MIXTURE, SHARD_INDEX, build_metadata
+
+
+def _load_track(root: Path, meta: dict, sources: tp.List[str], samplerate: int,
+                channels: int, length: int) -> np.ndarray:
+    wavs = []
+    for source in sources:
+        wav, _ = ta.load(str(root / f"{source}{EXT}"))
+        wavs.append(convert_audio_channels(wav, channels))
+    example = get_resampler(meta['samplerate'], samplerate)(th.stack(wavs))
+    example = example[..., :length]
+    example = F.pad(example, (0, length - example.shape[-1]))
+    return example.permute(2, 0, 1).numpy()
+
+
+def _write_track(data: np.ndarray, tracks: dict, name: str, pending: Future):
+    offset = tracks[name]['offset']
+    data[offset: offset + tracks[name]['length']] = pending.result()
+
+
+def pack_wavset(root: tp.Union[str, Path], out: tp.Union[str, Path], sources: tp.List[str],
+                samplerate: int = 44100, channels: int = 2, shard_size: float = 4.,
+                metadata: tp.Optional[dict] = None, workers: int = 4) -> dict:
+    """
+    Pack the tracks of `root`, in the layout expected by `Wavset`, into shards of about
+    `shard_size` GB in the `out` folder, and return the index, also saved in `out`.
+    `metadata` is the output of `build_metadata`, built if not provided, whose mean and
+    std are used for the normalization. `workers` tracks are decoded in parallel.
+    """
+    root = Path(root)
+    out = Path(out)
+    out.mkdir(parents=True, exist_ok=True)
+    if metadata is None:
+        metadata = build_metadata(root, [source for source in sources if source != MIXTURE])
+    frame_size = len(sources) * channels * 4
+    max_length = max(1, int(shard_size * 2**30 / frame_size))
+
+    # Tracks are assigned to shards first, so that each shard is allocated at its final size.
+    shards: tp.List[tp.List[str]] = [[]]
+    shard_lengths = [0]
+    tracks = {}
+    for name, meta in metadata.items():
+        length = int(math.floor(meta['length'] * samplerate / meta['samplerate']))
+        if shard_lengths[-1] and shard_lengths[-1] + length > max_length:
+            shards.append([])
+            shard_lengths.append(0)
+        tracks[name] = {'shard': len(shards) - 1, 'offset': shard_lengths[-1],
+                        'length': length, 'mean': meta['mean'], 'std': meta['std']}
+        shards[-1].append(name)
+        shard_lengths[-1] += length
+
+    shard_files = []
+    with ThreadPoolExecutor(workers) as pool:
+        for idx, (names, shard_length) in enumerate(zip(shards, shard_lengths)):
+            shard_file = f"shard{idx:04d}.npy"
+            shard_files.append(shard_file)
+            data = np.lib.format.open_memmap(
+                out / shard_file, mode='w+', dtype=np.float32,
+                shape=(shard_length, len(sources), channels))
+            # Only a few tracks are decoded ahead, and each is dropped once written,
+            # so that the memory used does not grow with the size of the shard.
+            pendings: tp.Deque[tp.Tuple[str, Future]] = deque()
+            for name in tqdm.tqdm(names, ncols=120, desc=shard_file):
+                pendings.append((name, pool.submit(
+                    _load_track, root / name, metadata[name], sources, samplerate,
+                    channels, tracks[name]['length'])))
+                if len(pendings) > workers:
+                    _write_track(data, tracks, *pendings.popleft())
+            while pendings:
+                _write_track(data, tracks, *pendings.popleft())
+            data.flush()
+            del data
+
+    index = {'samplerate': samplerate, 'channels': channels, 'sources': list(sources),
+             'shards': shard_files, 'tracks': tracks}
+    # Packers writing the same output at once each write their own temporary index.
+    with atomic_write(out / SHARD_INDEX) as tmp:
+        tmp.write_text(json.dumps(index))
+    return index
+
+
+def get_parser():
+    parser = argparse.ArgumentParser("demucs.pack", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('root', type=Path, help="Dataset with `train` and `valid` folders.")
+    parser.add_argument('out', type=Path, help="Where to write the shards.")
+    parser.add_argument('--sources', nargs='+', default=["drums", "bass", "other", "vocals"])
+    parser.add_argument('--samplerate', type=int, default=44100)
+    parser.add_argument('--channels', type=int, default=2)
+    parser.add_argument('--shard-size', type=float, default=4.,
+                        help="Approximate size of each shard, in GB.")
+    parser.add_argument('-j', '--workers', type=int, default=4,
+                        help="Number of tracks decoded in parallel.")
+    return parser
+
+
+def main(opts=None):
+    args = get_parser().parse_args(opts)
+    # The mixture is only needed for the validation set.
+    for split, sources in [('train', args.sources), ('valid', [MIXTURE] + args.sources)]:
+        print(f"Packing {args.root / split}")
+        index = pack_wavset(args.root / split, args.out / split, sources, args.samplerate,
+                            args.channels, args.shard_size, workers=args.workers)
+        print(f"Packed {len(index['tracks'])} tracks in {len(index['shards'])} shards")
+
+
+if __name__ == '__main__':
+    main()
@@ -6,14 +6,14 @@
 """Loading pretrained models.
 """
 
+import functools
 import logging
+import os
 import typing as tp
 from pathlib import Path
 
-from dora.log import bold, fatal
-
 from .hdemucs import HDemucs
-from .repo import AnyModelRepo, BagOnlyRepo, LocalRepo, ModelLoadingError, ModelOnlyRepo, RemoteRepo  # noqa
+from .repo import AnyModelRepo, BagOnlyRepo, LocalRepo, ModelLoadingError, ModelOnlyRepo, RemoteRepo, StoreRepo  # noqa
 from .states import _check_diffq
 
 logger = logging.getLogger(__name__)
@@ -22,6 +22,8 @@ REMOTE_ROOT = Path(__file__).parent / 'remote'
 
 SOURCES = ["drums", "bass", "other", "vocals"]
 DEFAULT_MODEL = 'htdemucs'
+STORE_ENV = 'DEMUCS_MODEL_STORE'
+MMAP_ENV = 'DEMUCS_MMAP'
 
 
 def demucs_unittest():
@@ -39,6 +41,11 @@ def add_model_flags(parser):
 
 
 def _parse_remote_files(remote_file_list) -> tp.Dict[str, str]:
+    return dict(_read_remote_files(remote_file_list))
+
+
+@functools.lru_cache()
+def _read_remote_files(remote_file_list) -> tp.Dict[str, str]:
     root: str = ''
     models: tp.Dict[str, str] = {}
     for line in remote_file_list.read_text().split('\n'):
@@ -56,24 +63,50 @@ def _parse_remote_files(remote_file_list) -> tp.Dict[str, str]:
     return models
 
 
+def get_store() -> tp.Optional[StoreRepo]:
+    """Offline model store given by the `DEMUCS_MODEL_STORE` environment variable, if any,
+    see `demucs.store`."""
+    root = os.environ.get(STORE_ENV)
+    if root:
+        return StoreRepo(Path(root))
+    return None
+
+
 def get_model(name: str,
-              repo: tp.Optional[Path] = None):
+              repo: tp.Optional[Path] = None,
+              mmap: tp.Optional[bool] = None):
     """`name` must be a bag of models name or a pretrained signature
     from the remote AWS model repo or the specified local repo if `repo` is not None.
+    When `repo` is None, models in the offline model store (see `get_store`) are loaded
+    from it, without network access.
+
+    If `mmap` is True, the weights are memory mapped, see `demucs.states.load_model`.
+    Half precision checkpoints are then converted once to a float32 copy, cached in
+    the `demucs_mmap` folder of the torch hub folder. Default to the `DEMUCS_MMAP`
+    environment variable, off if unset. Models from the offline store are always mapped.
     """
     if name == 'demucs_unittest':
         return demucs_unittest()
+    if mmap is None:
+        mmap = os.environ.get(MMAP_ENV, '0').lower() in ['1', 'true', 'yes']
     model_repo: ModelOnlyRepo
-    if repo is None:
+    any_repo: tp.Union[AnyModelRepo, StoreRepo]
+    store = get_store()
+    if repo is None and store is not None and store.has_model(name):
+        any_repo = store
+    elif repo is None:
         models = _parse_remote_files(REMOTE_ROOT / 'files.txt')
-        model_repo = RemoteRepo(models)
+        model_repo = RemoteRepo(models, mmap=mmap)
         bag_repo = BagOnlyRepo(REMOTE_ROOT, model_repo)
+        any_repo = AnyModelRepo(model_repo, bag_repo)
     else:
         if not repo.is_dir():
+            from dora.log import fatal
+
             fatal(f"{repo} must exist and be a directory.")
-        model_repo = LocalRepo(repo)
+        model_repo = LocalRepo(repo, mmap=mmap)
         bag_repo = BagOnlyRepo(repo, model_repo)
-    any_repo = AnyModelRepo(model_repo, bag_repo)
+        any_repo = AnyModelRepo(model_repo, bag_repo)
     try:
         model = any_repo.get_model(name)
     except ImportError as exc:
@@ -90,6 +123,8 @@ def get_model_from_args(args):
     Load local model package or pre-trained model.
     """
     if args.name is None:
+        from dora.log import bold
+
         args.name = DEFAULT_MODEL
         print(bold("Important: the default model was recently changed to `htdemucs`"),
               "the latest Hybrid Transformer Demucs model. In some cases, this model can "
@@ -0,0 +1,98 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Int8 inference on CPU, with PyTorch eager mode quantization.
+
+The `nn.Linear` layers, i.e. the feed forward and attention projections of the
+transformer layers, are quantized dynamically. Optionally, the convolutions of
+the `HEncLayer` and `HDecLayer` are quantized statically, after observing the range of
+their inputs and outputs while separating a few calibration tracks.
+The first encoder layers, which see the raw input, and the transposed convolutions,
+which produce the output of each layer, are kept in float32.
+
+Note that this is different from the DiffQ quantization supported in `demucs.states`,
+which is only used for storing the weights.
+"""
+import copy
+import typing as tp
+
+import torch
+from torch import nn
+from torch.ao import quantization as tq
+
+from .apply import BagOfModels, Model, apply_model
+from .demucs import DConv
+from .hdemucs import HDecLayer, HEncLayer
+
+
+def _models(model: tp.Union[BagOfModels, Model]) -> tp.List[nn.Module]:
+    if isinstance(model, BagOfModels):
+        return list(model.models)
+    return [model]
+
+
+def _static_convs(model: nn.Module) -> tp.List[tp.Tuple[nn.Module, str]]:
+    # Return the (parent, name) of the convolutions to quantize statically.
+    skipped = set()
+    for name in ['encoder', 'tencoder']:
+        layers = getattr(model, name, None)
+        if layers:
+            skipped |= {id(module) for module in layers[0].modules()}
+    convs = []
+    for module in model.modules():
+        if id(module) in skipped:
+            continue
+        if isinstance(module, HEncLayer):
+            names = ['conv', 'rewrite']
+        elif isinstance(module, HDecLayer):
+            names = ['rewrite']
+        elif isinstance(module, DConv):
+            for layer in module.layers:
+                convs += [(layer, name) for name, child in layer.named_children()
+                          if isinstance(child, nn.Conv1d)]
+            continue
+        else:
+            continue
+        convs += [(module, name) for name in names
+                  if isinstance(getattr(module, name, None), (nn.Conv1d, nn.Conv2d))]
+    return convs
+
+
+def _normalize(mix: torch.Tensor) -> torch.Tensor:
+    ref = mix.mean(0)
+    return (mix - ref.mean()) / (ref.std() + 1e-8)
+
+
+def quantize_int8(model: tp.Union[BagOfModels, Model],
+                  calibration: tp.Optional[tp.Sequence[torch.Tensor]] = None,
+                  **kwargs) -> tp.Union[BagOfModels, Model]:
+    """
+    Return a copy of `model` for int8 inference on CPU.
+
+    Args:
+        model (BagOfModels or Model): model to quantize, left unchanged.
+        calibration (list of Tensor or None): mixtures of shape `(channels, length)`,
+            at the samplerate of the model. If provided, the convolutions are quantized
+            statically, with the activation ranges observed on those mixtures, otherwise
+            only the linear layers are quantized.
+        kwargs: extra arguments for `apply_model` during the calibration.
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    if calibration:
+        qconfig = tq.get_default_qconfig(torch.backends.quantized.engine)
+        for sub in _models(model):
+            for parent, name in _static_convs(sub):
+                wrapper = tq.QuantWrapper(getattr(parent, name))
+                wrapper.qconfig = qconfig
+                setattr(parent, name, wrapper)
+        tq.prepare(model, inplace=True)
+        kwargs.setdefault('shifts', 0)
+        with torch.no_grad():
+            for mix in calibration:
+                apply_model(model, _normalize(mix)[None], device='cpu', **kwargs)
+        tq.convert(model, inplace=True)
+    tq.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    return model
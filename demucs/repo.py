@@ -8,17 +8,21 @@ A repo can either be the main remote repository stored in AWS, or a local reposi
 with your own models.
 """
 
+import json
+import logging
 import typing as tp
 from hashlib import sha256
 from pathlib import Path
+from urllib.parse import urlparse
 
 import torch
-import yaml
 
 from .apply import BagOfModels, Model
 from .states import load_model
+from .utils import atomic_write
 
 AnyModel = tp.Union[Model, BagOfModels]
+logger = logging.getLogger(__name__)
 
 
 class ModelLoadingError(RuntimeError):
@@ -39,6 +43,38 @@ def check_checksum(path: Path, checksum: str):
                                 f'expected {checksum} but got {actual_checksum}')
 
 
+def verify_checksum(path: Path, checksum: str, stamp_file: Path):
+    """Check the checksum of `path`, unless it was already verified with the same size
+    and modification time, as recorded in `stamp_file`."""
+    stat = path.stat()
+    stamp = [str(path.resolve()), stat.st_size, stat.st_mtime_ns, checksum]
+    try:
+        verified = json.loads(stamp_file.read_text())
+    except (OSError, ValueError):
+        # Missing or unreadable, the file is verified again.
+        verified = None
+    if verified != stamp:
+        check_checksum(path, checksum)
+        try:
+            with atomic_write(stamp_file) as tmp:
+                tmp.write_text(json.dumps(stamp))
+        except OSError as error:
+            logger.warning("Could not record the verification of %s: %s", path, error)
+
+
+def _download(url: str) -> Path:
+    # Same cache and checks as `torch.hub.load_state_dict_from_url`, but returns
+    # the path of the checkpoint, so that it can be memory mapped.
+    filename = Path(urlparse(url).path).name
+    path = Path(torch.hub.get_dir()) / 'checkpoints' / filename
+    if not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        match = torch.hub.HASH_REGEX.search(filename)
+        hash_prefix = match.group(1) if match else None
+        torch.hub.download_url_to_file(url, str(path), hash_prefix, progress=True)
+    return path
+
+
 class ModelOnlyRepo:
     """Base class for all model only repos.
     """
@@ -53,8 +89,9 @@ class ModelOnlyRepo:
 
 
 class RemoteRepo(ModelOnlyRepo):
-    def __init__(self, models: tp.Dict[str, str]):
+    def __init__(self, models: tp.Dict[str, str], mmap: bool = False):
         self._models = models
+        self.mmap = mmap
 
     def has_model(self, sig: str) -> bool:
         return sig in self._models
@@ -64,17 +101,16 @@ class RemoteRepo(ModelOnlyRepo):
             url = self._models[sig]
         except KeyError:
             raise ModelLoadingError(f'Could not find a pre-trained model with signature {sig}.')
-        pkg = torch.hub.load_state_dict_from_url(
-            url, map_location='cpu', check_hash=True)  # type: ignore
-        return load_model(pkg)
+        return load_model(_download(url), mmap=self.mmap)
 
     def list_model(self) -> tp.Dict[str, tp.Union[str, Path]]:
         return self._models  # type: ignore
 
 
 class LocalRepo(ModelOnlyRepo):
-    def __init__(self, root: Path):
+    def __init__(self, root: Path, mmap: bool = False):
         self.root = root
+        self.mmap = mmap
         self.scan()
 
     def scan(self):
@@ -102,8 +138,11 @@ class LocalRepo(ModelOnlyRepo):
         except KeyError:
             raise ModelLoadingError(f'Could not find pre-trained model with signature {sig}.')
         if sig in self._checksums:
-            check_checksum(file, self._checksums[sig])
-        return load_model(file)
+            # The repo might be read only, the stamps are kept in the torch hub folder.
+            key = sha256(str(file.resolve()).encode()).hexdigest()[:16]
+            stamp_file = Path(torch.hub.get_dir()) / 'demucs_verified' / f'{sig}-{key}.json'
+            verify_checksum(file, self._checksums[sig], stamp_file)
+        return load_model(file, mmap=self.mmap)
 
     def list_model(self) -> tp.Dict[str, tp.Union[str, Path]]:
         return self._models
@@ -133,6 +172,8 @@ class BagOnlyRepo:
         except KeyError:
             raise ModelLoadingError(f'{name} is neither a single pre-trained model or '
                                     'a bag of models.')
+        import yaml
+
         bag = yaml.safe_load(open(yaml_file))
         signatures = bag['models']
         models = [self.model_repo.get_model(sig) for sig in signatures]
@@ -163,3 +204,64 @@ class AnyModelRepo:
         for key, value in self.bag_repo.list_model().items():
             models[key] = value
         return models
+
+
+class StoreRepo:
+    """Offline store of single models and bags of models, populated with
+    `python -m demucs.store prefetch`. Everything is resolved from `index.json`,
+    without network access. The checksum of a model file is only computed again
+    when its size or modification time changed since it was last verified, see
+    `verify_checksum`. Those are recorded in one file per model in the `verified` folder, so that the
+    index is only written when populating the store, not by the workers.
+    """
+    def __init__(self, root: Path):
+        self.root = root
+        self.index_file = root / 'index.json'
+        self.index: tp.Dict[str, tp.Dict[str, tp.Any]] = {'models': {}, 'bags': {}}
+        if self.index_file.exists():
+            try:
+                self.index = json.loads(self.index_file.read_text())
+            except ValueError:
+                raise ModelLoadingError(f'The model store index {self.index_file} is corrupted, '
+                                        'populate the store again.')
+
+    def save(self):
+        with atomic_write(self.index_file) as tmp:
+            tmp.write_text(json.dumps(self.index, indent=2))
+
+    def add_model(self, sig: str, file: str, checksum: str):
+        """Add the model with signature `sig`, stored in `file` relative to the store."""
+        self.index['models'][sig] = {'file': file, 'checksum': checksum}
+
+    def add_bag(self, name: str, signatures: tp.List[str], weights=None, segment=None):
+        self.index['bags'][name] = {'models': signatures, 'weights': weights, 'segment': segment}
+
+    def verify(self, sig: str) -> Path:
+        """Return the path of the model `sig`, checking its checksum if it changed."""
+        entry = self.index['models'][sig]
+        path = self.root / entry['file']
+        if not path.exists():
+            raise ModelLoadingError(f'Model file {path} is missing from the store.')
+        verify_checksum(path, entry['checksum'], self.root / 'verified' / f'{sig}.json')
+        return path
+
+    def has_model(self, name_or_sig: str) -> bool:
+        return name_or_sig in self.index['models'] or name_or_sig in self.index['bags']
+
+    def get_model(self, name_or_sig: str) -> AnyModel:
+        if name_or_sig in self.index['models']:
+            return load_model(self.verify(name_or_sig), mmap=True,
+                              cache_dir=self.root / 'float32')
+        try:
+            bag = self.index['bags'][name_or_sig]
+        except KeyError:
+            raise ModelLoadingError(f'{name_or_sig} is not in the model store {self.root}.')
+        models = [self.get_model(sig) for sig in bag['models']]
+        return BagOfModels(models, bag['weights'], bag['segment'])
+
+    def list_model(self) -> tp.Dict[str, tp.Union[str, Path]]:
+        models: tp.Dict[str, tp.Union[str, Path]] = {
+            sig: self.root / entry['file'] for sig, entry in self.index['models'].items()}
+        for name in self.index['bags']:
+            models[name] = self.index_file
+        return models
@@ -6,15 +6,22 @@
 
 import argparse
 import sys
+import time
+import typing as tp
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from queue import Queue
+from threading import Thread
 
 import torch as th
-from dora.log import fatal
 
 from .api import Separator, list_models, save_audio
 from .apply import BagOfModels
+from .export import FixedLengthModel
 from .htdemucs import HTDemucs
 from .pretrained import ModelLoadingError, add_model_flags
+from .utils import DummyPoolExecutor
 
 
 def get_parser():
@@ -54,6 +61,15 @@ def get_parser():
                         help="Number of random shifts for equivariant stabilization."
                         "Increase separation time but improves quality for Demucs. 10 was used "
                         "in the original paper.")
+    parser.add_argument("--shift-mode",
+                        default="random",
+                        choices=["random", "even"],
+                        help="How to choose the shifts. With \"even\" or with --shift-seed, "
+                        "the output is reproducible and the shifted copies of each chunk "
+                        "are separated in a single batch.")
+    parser.add_argument("--shift-seed",
+                        type=int,
+                        help="Seed for the random shifts.")
     parser.add_argument("--overlap",
                         default=0.25,
                         type=float,
@@ -68,6 +84,50 @@ def get_parser():
     split_group.add_argument("--segment", type=int,
                              help="Set split size of each chunk. "
                              "This can help save memory of graphic card. ")
+    parser.add_argument("--no-autotune",
+                        action="store_false",
+                        dest="autotune",
+                        default=True,
+                        help="Don't benchmark the segment, overlap and jobs to find the fastest "
+                        "configuration, when --segment is not given. The result of the benchmark "
+                        "is cached per model and host.")
+    parser.add_argument("--memory-budget",
+                        type=float,
+                        help="Maximum memory (in GB) to use for the separation when autotuning.")
+    parser.add_argument("--attention-backend",
+                        default="auto",
+                        choices=["auto", "xformers", "sdpa"],
+                        help="Implementation of the sparse attention layers. sdpa does not "
+                        "require xformers. auto uses xformers when installed.")
+    parser.add_argument("--backend",
+                        default="torch",
+                        choices=["torch", "onnx"],
+                        help="Inference backend. onnx exports the model to ONNX the first time "
+                        "and runs it with ONNX Runtime on CPU, requires onnx and onnxruntime.")
+    parser.add_argument("--precision",
+                        default="fp32",
+                        choices=["fp32", "bf16", "fp16", "int8"],
+                        help="Inference precision. bf16 runs the model with bfloat16 autocast, "
+                        "which is faster on CPUs supporting it, fp16 is only available on CUDA. "
+                        "int8 quantizes the model for CPU inference, see --calibrate.")
+    parser.add_argument("--blstm-max-batch",
+                        type=int,
+                        help="For demucs and mdx models, maximum number of chunks processed "
+                        "at once by the BLSTM layers, which bounds their memory usage without "
+                        "changing the output.")
+    parser.add_argument("--fuse",
+                        action="store_true",
+                        help="Use the inference only version of the residual branches, "
+                        "faster on CPU with the same output. CPU only, fp32 or int8 precision.")
+    parser.add_argument("--multiwrap-workers",
+                        type=int,
+                        help="For hdemucs models with frequency bands processed by separate "
+                        "layers, number of threads processing the bands concurrently, "
+                        "without changing the output.")
+    parser.add_argument("--calibrate",
+                        action="store_true",
+                        help="With --precision int8, also quantize the convolutions, "
+                        "calibrated on an excerpt of each of the tracks to separate.")
     parser.add_argument("--two-stems",
                         dest="stem", metavar="STEM",
                         help="Only separate audio into {STEM} and no_{STEM}. ")
@@ -96,15 +156,93 @@ def get_parser():
                         help="Encoder preset of MP3, 2 for highest quality, 7 for "
                         "fastest speed. Default is 2")
     parser.add_argument("-j", "--jobs",
-                        default=0,
                         type=int,
                         help="Number of jobs. This can increase memory usage but will "
-                             "be much faster when multiple cores are available.")
+                             "be much faster when multiple cores are available. "
+                             "Default is picked by the autotuner, or 0 with --no-autotune.")
+    parser.add_argument("--prefetch",
+                        default=2,
+                        type=int,
+                        help="Number of tracks decoded ahead of the separation, in a "
+                        "background thread, 0 to decode each track just before separating it.")
+    parser.add_argument("--encode-jobs",
+                        default=2,
+                        type=int,
+                        help="Number of threads saving the stems while the next tracks are "
+                        "separated, 0 to save them before moving to the next track.")
 
     return parser
 
 
+def _decoded(separator: Separator, tracks: tp.List[Path],
+             prefetch: int) -> tp.Iterator[tp.Tuple[Path, th.Tensor]]:
+    # Yield the tracks along with their audio, decoded by a background thread up to
+    # `prefetch` tracks ahead when `prefetch > 0`.
+    if prefetch <= 0:
+        for track in tracks:
+            yield track, separator._load_audio(track)
+        return
+
+    queue: Queue = Queue(maxsize=prefetch)
+
+    def _worker():
+        for track in tracks:
+            try:
+                queue.put((track, separator._load_audio(track), None))
+            except Exception as error:
+                queue.put((track, None, error))
+                return
+        queue.put(None)
+
+    Thread(target=_worker, daemon=True).start()
+    while True:
+        item = queue.get()
+        if item is None:
+            return
+        track, wav, error = item
+        if error is not None:
+            raise error
+        yield track, wav
+
+
+def _stems(args, out: Path, track: Path, origin: th.Tensor,
+           res: tp.Dict[str, th.Tensor]) -> tp.List[tp.Tuple[Path, th.Tensor]]:
+    # Paths and audio of the stems to save for `track`, the parent folders are created.
+    if args.mp3:
+        ext = "mp3"
+    elif args.flac:
+        ext = "flac"
+    else:
+        ext = "wav"
+
+    def _path(stem):
+        path = out / args.filename.format(
+            track=track.name.rsplit(".", 1)[0],
+            trackext=track.name.rsplit(".", 1)[-1],
+            stem=stem,
+            ext=ext,
+        )
+        path.parent.mkdir(parents=True, exist_ok=True)
+        return path
+
+    if args.stem is None:
+        return [(_path(name), source) for name, source in res.items()]
+    stems = []
+    if args.other_method == "minus":
+        stems.append((_path("minus_" + args.stem), origin - res[args.stem]))
+    stems.append((_path(args.stem), res.pop(args.stem)))
+    # Warning : after poping the stem, selected stem is no longer in the dict 'res'
+    if args.other_method == "add":
+        other_stem = th.zeros_like(next(iter(res.values())))
+        for i in res.values():
+            other_stem += i
+        stems.append((_path("no_" + args.stem), other_stem))
+    return stems
+
+
 def main(opts=None):
+    from dora.log import fatal
+
     parser = get_parser()
     args = parser.parse_args(opts)
     if args.list_models:
@@ -127,12 +265,22 @@ def main(opts=None):
                               overlap=args.overlap,
                               progress=True,
                               jobs=args.jobs,
-                              segment=args.segment)
+                              segment=args.segment,
+                              shift_mode=args.shift_mode,
+                              shift_seed=args.shift_seed,
+                              autotune=args.autotune,
+                              memory_budget=args.memory_budget,
+                              precision=args.precision,
+                              attention_backend=args.attention_backend,
+                              backend=args.backend,
+                              blstm_max_batch=args.blstm_max_batch,
+                              fuse=args.fuse,
+                              multiwrap_workers=args.multiwrap_workers)
     except ModelLoadingError as error:
         fatal(error.args[0])
 
     max_allowed_segment = float('inf')
-    if isinstance(separator.model, HTDemucs):
+    if isinstance(separator.model, (HTDemucs, FixedLengthModel)):
         max_allowed_segment = float(separator.model.segment)
     elif isinstance(separator.model, BagOfModels):
         max_allowed_segment = separator.model.max_allowed_segment
@@ -140,11 +288,11 @@ def main(opts=None):
         fatal("Cannot use a Transformer model with a longer segment "
               f"than it was trained for. Maximum segment is: {max_allowed_segment}")
 
-    if isinstance(separator.model, BagOfModels):
-        print(
-            f"Selected model is a bag of {len(separator.model.models)} models. "
-            "You will see that many progress bars per track."
-        )
+    if args.calibrate:
+        if args.precision != "int8":
+            fatal("--calibrate can only be used with --precision int8.")
+        print("Calibrating the int8 quantization")
+        separator.calibrate([track for track in args.tracks if track.exists()])
 
     if args.stem is not None and args.stem not in separator.model.sources:
         fatal(
@@ -153,74 +301,63 @@ def main(opts=None):
                 stem=args.stem, sources=", ".join(separator.model.sources)
             )
         )
+    if args.stem is not None and args.other_method != "add":
+        # The other stems are not needed, which allows to skip part of a bag of models.
+        separator.update_parameter(stems=[args.stem])
+
+    if isinstance(separator.model, BagOfModels):
+        active_models = separator.model.active_models(separator.stems)
+        print(
+            f"Selected model is a bag of {len(separator.model.models)} models. "
+            f"You will see {len(active_models)} progress bars per track."
+        )
     out = args.out / args.name
     out.mkdir(parents=True, exist_ok=True)
     print(f"Separated tracks will be stored in {out.resolve()}")
+    tracks = []
     for track in args.tracks:
         if not track.exists():
             print(f"File {track} does not exist. If the path contains spaces, "
                   'please try again after surrounding the entire path with quotes "".',
                   file=sys.stderr)
             continue
-        print(f"Separating track {track}")
-
-        origin, res = separator.separate_audio_file(track)
-
-        if args.mp3:
-            ext = "mp3"
-        elif args.flac:
-            ext = "flac"
-        else:
-            ext = "wav"
-        kwargs = {
-            "samplerate": separator.samplerate,
-            "bitrate": args.mp3_bitrate,
-            "preset": args.mp3_preset,
-            "clip": args.clip_mode,
-            "as_float": args.float32,
-            "bits_per_sample": 24 if args.int24 else 16,
-        }
-        if args.stem is None:
-            for name, source in res.items():
-                stem = out / args.filename.format(
-                    track=track.name.rsplit(".", 1)[0],
-                    trackext=track.name.rsplit(".", 1)[-1],
-                    stem=name,
-                    ext=ext,
-                )
-                stem.parent.mkdir(parents=True, exist_ok=True)
-                save_audio(source, str(stem), **kwargs)
-        else:
-            stem = out / args.filename.format(
-                track=track.name.rsplit(".", 1)[0],
-                trackext=track.name.rsplit(".", 1)[-1],
-                stem="minus_" + args.stem,
-                ext=ext,
-            )
-            if args.other_method == "minus":
-                stem.parent.mkdir(parents=True, exist_ok=True)
-                save_audio(origin - res[args.stem], str(stem), **kwargs)
-            stem = out / args.filename.format(
-                track=track.name.rsplit(".", 1)[0],
-                trackext=track.name.rsplit(".", 1)[-1],
-                stem=args.stem,
-                ext=ext,
-            )
-            stem.parent.mkdir(parents=True, exist_ok=True)
-            save_audio(res.pop(args.stem), str(stem), **kwargs)
-            # Warning : after poping the stem, selected stem is no longer in the dict 'res'
-            if args.other_method == "add":
-                other_stem = th.zeros_like(next(iter(res.values())))
-                for i in res.values():
-                    other_stem += i
-                stem = out / args.filename.format(
-                    track=track.name.rsplit(".", 1)[0],
-                    trackext=track.name.rsplit(".", 1)[-1],
-                    stem="no_" + args.stem,
-                    ext=ext,
-                )
-                stem.parent.mkdir(parents=True, exist_ok=True)
-                save_audio(other_stem, str(stem), **kwargs)
+        tracks.append(track)
+
+    kwargs = {
+        "samplerate": separator.samplerate,
+        "bitrate": args.mp3_bitrate,
+        "preset": args.mp3_preset,
+        "clip": args.clip_mode,
+        "as_float": args.float32,
+        "bits_per_sample": 24 if args.int24 else 16,
+    }
+    # Decoding, separation and encoding overlap: while a track is separated, the next ones
+    # are decoded and the stems of the previous ones are saved. At most `prefetch` tracks
+    # wait for their stems to be saved, so that memory usage stays bounded.
+    if args.encode_jobs > 0:
+        pool = ThreadPoolExecutor(args.encode_jobs)
+        pending_tracks = max(1, args.prefetch)
+    else:
+        pool = DummyPoolExecutor()
+        pending_tracks = 0
+    pending: tp.Deque[list] = deque()
+    begin = time.time()
+    with pool:
+        for track, wav in _decoded(separator, tracks, args.prefetch):
+            print(f"Separating track {track}")
+            origin, res = separator.separate_tensor(wav, separator.samplerate)
+            pending.append([pool.submit(save_audio, source, str(stem), **kwargs)
+                            for stem, source in _stems(args, out, track, origin, res)])
+            while len(pending) > pending_tracks:
+                for future in pending.popleft():
+                    future.result()
+        while pending:
+            for future in pending.popleft():
+                future.result()
+    elapsed = time.time() - begin
+    if tracks:
+        print(f"Separated {len(tracks)} tracks in {elapsed:.1f}s, "
+              f"{3600 * len(tracks) / elapsed:.1f} tracks/hour")
 
 
 if __name__ == "__main__":
@@ -5,7 +5,28 @@
 # LICENSE file in the root directory of this source tree.
 """Conveniance wrapper to perform STFT and iSTFT"""
 
+import functools
+import math
+
 import torch as th
+from torch.nn import functional as F
+
+
+@functools.lru_cache(maxsize=32)
+def hann_window(n_fft: int, device: th.device, dtype: th.dtype) -> th.Tensor:
+    """Hann window, cached per `(n_fft, device, dtype)`. Must not be modified in place."""
+    return th.hann_window(n_fft, device=device, dtype=dtype)
+
+
+@functools.lru_cache(maxsize=32)
+def _synthesis_window(n_fft: int, hop_length: int, device: th.device,
+                      dtype: th.dtype) -> th.Tensor:
+    # Away from the edges, the overlap-add of the squared Hann windows is periodic
+    # with period `hop_length`. Dividing the window by it once lets the iSTFT skip
+    # the normalization by the window envelope.
+    window = hann_window(n_fft, device, dtype)
+    envelope = (window ** 2).view(n_fft // hop_length, hop_length).sum(dim=0)
+    return window / envelope.repeat(n_fft // hop_length)
 
 
 def spectro(x, n_fft=512, hop_length=None, pad=0):
@@ -17,7 +38,7 @@ def spectro(x, n_fft=512, hop_length=None, pad=0):
     z = th.stft(x,
                 n_fft * (1 + pad),
                 hop_length or n_fft // 4,
-                window=th.hann_window(n_fft).to(x),
+                window=hann_window(n_fft, x.device, x.dtype),
                 win_length=n_fft,
                 normalized=True,
                 center=True,
@@ -38,10 +59,95 @@ def ispectro(z, hop_length=None, length=None, pad=0):
     x = th.istft(z,
                  n_fft,
                  hop_length,
-                 window=th.hann_window(win_length).to(z.real),
+                 window=hann_window(win_length, z.device, z.real.dtype),
                  win_length=win_length,
                  normalized=True,
                  length=length,
                  center=True)
     _, length = x.shape
     return x.view(*other, length)
+
+
+def _reflect_pad(x: th.Tensor, padding_left: int, padding_right: int) -> th.Tensor:
+    # Same as `demucs.hdemucs.pad1d` in reflect mode, which inserts extra zeros
+    # to the right when the input is too short to be reflected.
+    length = x.shape[-1]
+    max_pad = max(padding_left, padding_right)
+    if length <= max_pad:
+        extra_pad = max_pad - length + 1
+        extra_pad_right = min(padding_right, extra_pad)
+        extra_pad_left = extra_pad - extra_pad_right
+        padding_left -= extra_pad_left
+        padding_right -= extra_pad_right
+        x = F.pad(x, (extra_pad_left, extra_pad_right))
+    return F.pad(x, (padding_left, padding_right), mode='reflect')
+
+
+class HybridSpectro:
+    """
+    STFT and iSTFT with the framing used by the hybrid models (`HDemucs` and `HTDemucs`):
+    the spectrogram of an input of length `L` has exactly `ceil(L / hop_length)` frames,
+    aligned with the time branch, and its last frequency bin is dropped.
+
+    Compared with padding the input, calling `spectro` and then trimming, the input
+    is padded only once and only the frames that are kept are computed.
+    Likewise, `istft` only overlap-adds the frames it is given, directly into
+    its output, with the window normalization folded into a cached synthesis window.
+
+    Args:
+        n_fft (int): size of the FFT, must be 4 times `hop_length`.
+        hop_length (int): stride between frames.
+    """
+    def __init__(self, n_fft: int, hop_length: int):
+        assert hop_length == n_fft // 4 and n_fft % 4 == 0, (n_fft, hop_length)
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        # Padding so that frame `i` is centered on sample `(i + 1/2) * hop_length`.
+        self.pad = hop_length // 2 * 3
+
+    def frames(self, length: int) -> int:
+        """Number of frames of the spectrogram of an input of size `length`."""
+        return int(math.ceil(length / self.hop_length))
+
+    def stft(self, x: th.Tensor) -> th.Tensor:
+        """Complex spectrogram of `x` of shape `(*, L)`, with shape
+        `(*, n_fft // 2, ceil(L / hop_length))`."""
+        *other, length = x.shape
+        le = self.frames(length)
+        x = x.reshape(-1, length)
+        is_mps_xpu = x.device.type in ['mps', 'xpu']
+        if is_mps_xpu:
+            x = x.cpu()
+        x = _reflect_pad(x, self.pad, self.pad + le * self.hop_length - length)
+        z = th.stft(x,
+                    self.n_fft,
+                    self.hop_length,
+                    window=hann_window(self.n_fft, x.device, x.dtype),
+                    normalized=True,
+                    center=False,
+                    return_complex=True)
+        assert z.shape[-1] == le, (z.shape, le)
+        return z[:, :-1].view(*other, self.n_fft // 2, le)
+
+    def istft(self, z: th.Tensor, length: int) -> th.Tensor:
+        """Inverse of `stft`, with `z` of shape `(*, n_fft // 2, ceil(length / hop_length))`."""
+        *other, freqs, frames = z.shape
+        assert freqs == self.n_fft // 2, (freqs, self.n_fft)
+        z = z.reshape(-1, freqs, frames)
+        is_mps_xpu = z.device.type in ['mps', 'xpu']
+        if is_mps_xpu:
+            z = z.cpu()
+        # The missing last frequency bin is implicitly zero.
+        frame_signals = th.fft.irfft(z.transpose(1, 2), self.n_fft, dim=-1, norm='ortho')
+        window = _synthesis_window(self.n_fft, self.hop_length, z.device, frame_signals.dtype)
+        frame_signals = frame_signals * window
+        # Overlap-add, as `n_fft` is a multiple of `hop_length`, each frame is made of
+        # `overlap` chunks of `hop_length` samples, added to consecutive output chunks.
+        overlap = self.n_fft // self.hop_length
+        frame_signals = frame_signals.view(-1, frames, overlap, self.hop_length)
+        x = frame_signals.new_zeros(frame_signals.shape[0], frames + overlap - 1, self.hop_length)
+        for chunk in range(overlap):
+            x[:, chunk: chunk + frames] += frame_signals[:, :, chunk]
+        # The first frame starts `pad` samples before the start of the signal.
+        x = x.view(x.shape[0], -1)[:, self.pad: self.pad + length]
+        return x.reshape(*other, length)
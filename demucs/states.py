@@ -10,19 +10,25 @@ import functools
 import hashlib
 import inspect
 import io
+import logging
+import typing as tp
 import warnings
-from contextlib import contextmanager
+from contextlib import contextmanager, nullcontext
 from pathlib import Path
 
 import torch
-from dora.log import fatal
-from omegaconf import OmegaConf
+
+from .utils import atomic_write
+
+logger = logging.getLogger(__name__)
 
 
 def _check_diffq():
     try:
         import diffq  # noqa
     except ImportError:
+        from dora.log import fatal
+
         fatal('Trying to use DiffQ, but diffq is not installed.\n'
               'On Windows run: python.exe -m pip install diffq \n'
               'On Linux/Mac, run: python3 -m pip install diffq')
@@ -46,16 +52,56 @@ def get_quantizer(model, args, optimizer=None):
     return quantizer
 
 
-def load_model(path_or_package, strict=False):
+def _load_package(path: Path, mmap: bool) -> dict:
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        if mmap:
+            try:
+                return torch.load(path, 'cpu', mmap=True, weights_only=False)
+            except RuntimeError:
+                # Only the zipfile format, the default since PyTorch 1.6, can be memory mapped.
+                logger.info("Could not memory map %s, loading it in memory.", path)
+        return torch.load(path, 'cpu', weights_only=False)
+
+
+def _float_checkpoint(path: Path, package: dict, cache_dir: Path) -> Path:
+    # Path of a copy of the checkpoint at `path` with the half precision tensors
+    # converted to float32, so that they can be used by the model without a copy.
+    stat = path.stat()
+    key = hashlib.sha256(f"{path.resolve()}|{stat.st_size}|{stat.st_mtime_ns}".encode())
+    converted = cache_dir / f"{path.stem}-{key.hexdigest()[:8]}.th"
+    if not converted.exists():
+        state = {name: tensor.float() if tensor.dtype == torch.half else tensor
+                 for name, tensor in package["state"].items()}
+        # Processes loading the same model at once each write their own copy.
+        with atomic_write(converted) as tmp:
+            torch.save(dict(package, state=state), tmp)
+    return converted
+
+
+def load_model(path_or_package, strict=False, mmap=False, cache_dir: tp.Optional[Path] = None):
     """Load a model from the given serialized model, either given as a dict (already loaded)
-    or a path to a file on disk."""
+    or a path to a file on disk.
+
+    If `mmap` is True and a path is given, the weights are memory mapped from the file
+    and used by the model as is, so that processes loading the same model share its
+    weights through the page cache. Half precision checkpoints are converted once
+    to a float32 copy in `cache_dir`, default to `demucs_mmap` in the torch hub folder.
+    """
     if isinstance(path_or_package, dict):
         package = path_or_package
+        mmap = False
     elif isinstance(path_or_package, (str, Path)):
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-            path = path_or_package
-            package = torch.load(path, 'cpu')
+        path = Path(path_or_package)
+        package = _load_package(path, mmap)
+        state = package["state"]
+        if mmap and not state.get('__quantized'):
+            if any(tensor.dtype == torch.half for tensor in state.values()):
+                if cache_dir is None:
+                    cache_dir = Path(torch.hub.get_dir()) / 'demucs_mmap'
+                package = _load_package(_float_checkpoint(path, package, cache_dir), mmap)
+        else:
+            mmap = False
     else:
         raise ValueError(f"Invalid type for {path_or_package}.")
 
@@ -63,19 +109,19 @@ def load_model(path_or_package, strict=False):
     args = package["args"]
     kwargs = package["kwargs"]
 
-    if strict:
-        model = klass(*args, **kwargs)
-    else:
+    if not strict:
         sig = inspect.signature(klass)
         for key in list(kwargs):
             if key not in sig.parameters:
                 warnings.warn("Dropping inexistant parameter " + key)
                 del kwargs[key]
+    # When the weights are assigned, there is no need to initialize them first.
+    with torch.device('meta') if mmap else nullcontext():
         model = klass(*args, **kwargs)
 
     state = package["state"]
 
-    set_state(model, state)
+    set_state(model, state, assign=mmap)
     return model
 
 
@@ -92,8 +138,9 @@ def get_state(model, quantizer, half=False):
     return state
 
 
-def set_state(model, state, quantizer=None):
-    """Set the state on a given model."""
+def set_state(model, state, quantizer=None, assign=False):
+    """Set the state on a given model. If `assign` is True, the tensors in `state`
+    are used by the model instead of being copied."""
     if state.get('__quantized'):
         if quantizer is not None:
             quantizer.restore_quantized_state(model, state['quantized'])
@@ -102,7 +149,7 @@ def set_state(model, state, quantizer=None):
             from diffq import restore_quantized_state
             restore_quantized_state(model, state)
     else:
-        model.load_state_dict(state)
+        model.load_state_dict(state, assign=assign)
     return state
 
 
@@ -118,6 +165,8 @@ def save_with_checksum(content, path):
 
 
 def serialize_model(model, training_args, quantizer=None, half=True):
+    from omegaconf import OmegaConf
+
     args, kwargs = model._init_args_kwargs
     klass = model.__class__
 
@@ -160,3 +209,108 @@ def capture_init(init):
         init(self, *args, **kwargs)
 
     return __init__
+
+
+def model_signature(model):
+    """Short hash of the class, init arguments and state of `model`."""
+    hasher = hashlib.sha256()
+    args, kwargs = getattr(model, '_init_args_kwargs', ((), {}))
+    hasher.update(f"{model.__class__.__qualname__}|{args!r}|{sorted(kwargs.items())!r}".encode())
+    for name, tensor in model.state_dict().items():
+        hasher.update(name.encode())
+        hasher.update(tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy())
+    return hasher.hexdigest()[:8]
+
+
+def _check_traced_batch(frozen, traced, device: torch.device, batch_size: int = 3):
+    # The graph is traced with a batch of 2, any shape baked into it as a constant
+    # would break `apply_model` with another batch size, so it is checked on another one.
+    generator = torch.Generator().manual_seed(1234)
+    mix = torch.randn(batch_size, frozen.audio_channels, frozen.length, generator=generator)
+    mix = mix.to(device)
+    inputs = (frozen._magnitude(frozen._spec(mix)), mix)
+    try:
+        outputs = traced(*inputs)
+    except RuntimeError as error:
+        raise RuntimeError("The traced model does not support other batch sizes, "
+                           "use the 'compile' or 'eager' export method.") from error
+    for out, ref in zip(outputs, frozen.core(*inputs)):
+        if out.shape != ref.shape or not torch.allclose(out, ref, rtol=1e-4, atol=1e-4):
+            raise RuntimeError("The traced model gives a different output for other batch "
+                               "sizes, use the 'compile' or 'eager' export method.")
+
+
+def _export_htdemucs(model, method: str, device: torch.device, cache_dir: tp.Optional[Path],
+                     compile_mode: tp.Optional[str]):
+    from .export import FrozenHTDemucs
+
+    frozen = FrozenHTDemucs(model.to(device))
+    if method == 'compile':
+        frozen.core = torch.compile(frozen.core, mode=compile_mode, dynamic=False)
+    elif method == 'torchscript':
+        path = None
+        if cache_dir is not None:
+            version = torch.__version__.replace('+', '_')
+            name = f"{model_signature(model)}-{frozen.length}-{device.type}-{version}.ts"
+            path = cache_dir / name
+        if path is not None and path.exists():
+            frozen.core = torch.jit.load(str(path), map_location=device)
+        else:
+            with torch.no_grad():
+                traced = torch.jit.freeze(torch.jit.trace(
+                    frozen.core, frozen.example_inputs(batch_size=2, device=device),
+                    check_trace=False))
+                _check_traced_batch(frozen, traced, device)
+            frozen.core = traced
+            if path is not None:
+                with atomic_write(path) as tmp:
+                    torch.jit.save(frozen.core, str(tmp))
+    return frozen
+
+
+def export_model(model, method: str = 'torchscript', device=None, use_cache: bool = True,
+                 cache_dir: tp.Optional[Path] = None, compile_mode: tp.Optional[str] = None):
+    """
+    Export `model` for inference, replacing each `HTDemucs` (either `model` itself or
+    the models in a bag) with a `demucs.export.FrozenHTDemucs`, which handles inputs of
+    the training length of the model, and gives the same output as the original model.
+    Other models are kept as is. The result can be used with `apply_model`.
+
+    Args:
+        model (BagOfModels or Model): model to export, will be put in eval mode.
+        method (str): one of `demucs.export.EXPORT_METHODS`. 'torchscript' traces and
+            freezes the core of the model, 'compile' uses `torch.compile`,
+            and 'eager' uses the static graph without compilation.
+            Mixed precision is only supported with 'compile' and 'eager'.
+        device (torch.device, str or None): device the model will be used on,
+            default to the device of the model. The traced graphs are device specific.
+        use_cache (bool): if True, traced graphs are cached on disk per model signature,
+            length, device type and PyTorch version. With 'compile', kernels are cached by `torch.compile`.
+        cache_dir (Path or None): cache folder, default to `demucs_export` in
+            the torch hub folder.
+        compile_mode (str or None): `mode` given to `torch.compile`.
+    """
+    from .apply import BagOfModels
+    from .export import EXPORT_METHODS
+    from .htdemucs import HTDemucs
+
+    if method not in EXPORT_METHODS:
+        raise ValueError(f"Invalid export method {method}, must be one of {EXPORT_METHODS}.")
+    if device is None:
+        device = next(iter(model.parameters())).device
+    device = torch.device(device)
+    if not use_cache:
+        cache_dir = None
+    elif cache_dir is None:
+        cache_dir = Path(torch.hub.get_dir()) / 'demucs_export'
+    model.eval()
+    if isinstance(model, BagOfModels):
+        models = [
+            _export_htdemucs(sub, method, device, cache_dir, compile_mode)
+            if isinstance(sub, HTDemucs) else sub for sub in model.models]
+        return BagOfModels(models, model.weights)
+    elif isinstance(model, HTDemucs):
+        return _export_htdemucs(model, method, device, cache_dir, compile_mode)
+    logger.warning("Only HTDemucs models can be exported, returning %s as is.",
+                   model.__class__.__name__)
+    return model
@@ -0,0 +1,98 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Offline model store, for workers without network access.
+
+The store is a folder with the model files and an `index.json`, giving for each
+signature its file and checksum, and for each bag of models its signatures, weights
+and segment, so that loading a model needs neither the network nor parsing the remote
+files list and bag YAML files. Populate it with
+
+    python -m demucs.store prefetch htdemucs mdx_extra --store /path/to/store
+
+then set `DEMUCS_MODEL_STORE=/path/to/store` on the workers.
+"""
+
+import argparse
+import sys
+import typing as tp
+from pathlib import Path
+from urllib.parse import urlparse
+
+import torch
+
+from .pretrained import REMOTE_ROOT, STORE_ENV, _parse_remote_files, get_store
+from .repo import ModelLoadingError, StoreRepo
+
+
+def _resolve(name: str, models: tp.Dict[str, str]) -> tp.Optional[dict]:
+    # Bag manifest for `name`, None for a single model.
+    import yaml
+
+    if name in models:
+        return None
+    yaml_file = REMOTE_ROOT / f'{name}.yaml'
+    if not yaml_file.exists():
+        raise ModelLoadingError(f'{name} is neither a single pre-trained model or '
+                                'a bag of models.')
+    return yaml.safe_load(yaml_file.read_text())
+
+
+def prefetch(names: tp.List[str], store: StoreRepo):
+    """Download the given pretrained models or bags of models into `store`."""
+    models = _parse_remote_files(REMOTE_ROOT / 'files.txt')
+    for name in names:
+        bag = _resolve(name, models)
+        signatures = [name] if bag is None else bag['models']
+        for sig in signatures:
+            url = models[sig]
+            filename = Path(urlparse(url).path).name
+            match = torch.hub.HASH_REGEX.search(filename)
+            assert match is not None, filename
+            path = store.root / filename
+            if not path.exists():
+                print(f"Downloading {sig} to {path}")
+                store.root.mkdir(parents=True, exist_ok=True)
+                torch.hub.download_url_to_file(url, str(path), match.group(1), progress=True)
+            store.add_model(sig, filename, match.group(1))
+        if bag is not None:
+            store.add_bag(name, signatures, bag.get('weights'), bag.get('segment'))
+        store.save()
+        # Verifies the files and prepares the float32 copies used for memory mapping.
+        store.get_model(name)
+        print(f"Stored {name}")
+
+
+def get_parser():
+    parser = argparse.ArgumentParser("demucs.store", description=__doc__)
+    # Shared by the subcommands, so that `--store` can be given after them.
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--store', type=Path,
+                        help=f"Store folder, default to the {STORE_ENV} environment variable.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    sub = subparsers.add_parser('prefetch', parents=[common],
+                                help="Download models into the store.")
+    sub.add_argument('names', nargs='+', help="Pretrained model names or signatures.")
+    subparsers.add_parser('list', parents=[common], help="List the models in the store.")
+    return parser
+
+
+def main(opts=None):
+    args = get_parser().parse_args(opts)
+    store = StoreRepo(args.store) if args.store is not None else get_store()
+    if store is None:
+        print(f"error: use --store or set {STORE_ENV}.", file=sys.stderr)
+        sys.exit(1)
+    if args.command == 'prefetch':
+        prefetch(args.names, store)
+    else:
+        for name, bag in store.index['bags'].items():
+            print(f"{name}: {', '.join(bag['models'])}")
+        for sig, entry in store.index['models'].items():
+            print(f"{sig}: {entry['file']}")
+
+
+if __name__ == '__main__':
+    main()
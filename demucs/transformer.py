@@ -5,9 +5,13 @@
 # LICENSE file in the root directory of this source tree.
 # First author is Simon Rouard.
 
+import functools
+import importlib.util
 import math
 import random
+import threading
 import typing as tp
+from collections import OrderedDict
 
 import numpy as np
 import torch
@@ -46,28 +50,21 @@ def create_2d_sin_embedding(d_model, height, width, device="cpu", max_period=100
             "Cannot use sin/cos positional encoding with "
             "odd dimension (got dim={:d})".format(d_model)
         )
-    pe = torch.zeros(d_model, height, width)
+    pe = torch.empty(d_model, height, width, device=device)
     # Each dimension use half of d_model
     d_model = int(d_model / 2)
     div_term = torch.exp(
-        torch.arange(0.0, d_model, 2) * -(math.log(max_period) / d_model)
-    )
-    pos_w = torch.arange(0.0, width).unsqueeze(1)
-    pos_h = torch.arange(0.0, height).unsqueeze(1)
-    pe[0:d_model:2, :, :] = (
-        torch.sin(pos_w * div_term).transpose(0, 1).unsqueeze(1).repeat(1, height, 1)
-    )
-    pe[1:d_model:2, :, :] = (
-        torch.cos(pos_w * div_term).transpose(0, 1).unsqueeze(1).repeat(1, height, 1)
-    )
-    pe[d_model::2, :, :] = (
-        torch.sin(pos_h * div_term).transpose(0, 1).unsqueeze(2).repeat(1, 1, width)
-    )
-    pe[d_model + 1:: 2, :, :] = (
-        torch.cos(pos_h * div_term).transpose(0, 1).unsqueeze(2).repeat(1, 1, width)
+        torch.arange(0.0, d_model, 2, device=device) * -(math.log(max_period) / d_model)
     )
+    pos_w = torch.arange(0.0, width, device=device).unsqueeze(1)
+    pos_h = torch.arange(0.0, height, device=device).unsqueeze(1)
+    # The embeddings are broadcasted over the other axis when assigned.
+    pe[0:d_model:2, :, :] = torch.sin(pos_w * div_term).transpose(0, 1).unsqueeze(1)
+    pe[1:d_model:2, :, :] = torch.cos(pos_w * div_term).transpose(0, 1).unsqueeze(1)
+    pe[d_model::2, :, :] = torch.sin(pos_h * div_term).transpose(0, 1).unsqueeze(2)
+    pe[d_model + 1:: 2, :, :] = torch.cos(pos_h * div_term).transpose(0, 1).unsqueeze(2)
 
-    return pe[None, :].to(device)
+    return pe[None, :]
 
 
 def create_sin_embedding_cape(
@@ -175,7 +172,7 @@ def get_elementary_mask(
     return mask
 
 
-def get_mask(
+def get_dense_mask(
     T1,
     T2,
     mask_type,
@@ -186,11 +183,9 @@ def get_mask(
     device,
 ):
     """
-    Return a SparseCSRTensor mask that is a combination of elementary masks
+    Return a boolean mask of shape (T2, T1) that is a combination of elementary masks
     mask_type can be a combination of multiple masks: for instance "diag_jmask_random"
     """
-    from xformers.sparse import SparseCSRTensor
-
     # create a list
     mask_types = mask_type.split("_")
 
@@ -208,9 +203,256 @@ def get_mask(
         for mask in mask_types
     ]
 
-    final_mask = torch.stack(all_masks).sum(axis=0) > 0
+    return torch.stack(all_masks).sum(axis=0) > 0
+
+
+def get_elementary_mask_indices(
+    T1,
+    T2,
+    mask_type,
+    sparse_attn_window,
+    global_window,
+    mask_random_seed,
+    sparsity,
+    device,
+):
+    """
+    Same as `get_elementary_mask` but returns the (rows, cols) indices of the non zero
+    entries, without building the dense (T2, T1) matrix, except for the random mask.
+    """
+    assert mask_type in ["diag", "jmask", "random", "global"]
+
+    if mask_type == "global":
+        line_window = min(int(global_window * T2 / T1), T2)
+        global_window = min(global_window, T1)
+        rows = torch.cat([
+            torch.arange(T2).repeat_interleave(global_window),
+            torch.arange(line_window).repeat_interleave(T1),
+        ])
+        cols = torch.cat([
+            torch.arange(global_window).repeat(T2),
+            torch.arange(T1).repeat(line_window),
+        ])
+
+    elif mask_type == "diag":
+        rows = torch.arange(T2)[:, None]
+        cols = (
+            (T1 / T2 * rows + torch.arange(-sparse_attn_window, sparse_attn_window + 1))
+            .long()
+            .clamp(0, T1 - 1)
+        )
+        rows = rows.expand_as(cols).reshape(-1)
+        cols = cols.reshape(-1)
+
+    elif mask_type == "jmask":
+        rows = torch.arange(T2 + 2)[:, None]
+        t = torch.arange(0, int((2 * T1) ** 0.5 + 1))
+        t = (t * (t + 1) / 2).int()
+        t = torch.cat([-t.flip(0)[:-1], t])
+        cols = (T1 / T2 * rows + t).long().clamp(0, T1 + 1)
+        rows = rows.expand_as(cols).reshape(-1)
+        cols = cols.reshape(-1)
+        # The mask is built with one extra row and column on each side, then cropped.
+        keep = (rows >= 1) & (rows <= T2) & (cols >= 1) & (cols <= T1)
+        rows = rows[keep] - 1
+        cols = cols[keep] - 1
+
+    elif mask_type == "random":
+        mask = get_elementary_mask(
+            T1, T2, mask_type, sparse_attn_window, global_window, mask_random_seed,
+            sparsity, device)
+        rows, cols = mask.nonzero().t()
 
-    return SparseCSRTensor.from_dense(final_mask[None])
+    return rows.to(device), cols.to(device)
+
+
+def get_mask_indices(
+    T1,
+    T2,
+    mask_type,
+    sparse_attn_window,
+    global_window,
+    mask_random_seed,
+    sparsity,
+    device,
+):
+    """
+    Return the (rows, cols) indices of the non zero entries of the combination
+    of elementary masks, sorted by row then column, without duplicates.
+    """
+    all_rows = []
+    all_cols = []
+    for mask in mask_type.split("_"):
+        rows, cols = get_elementary_mask_indices(
+            T1, T2, mask, sparse_attn_window, global_window, mask_random_seed, sparsity, device)
+        all_rows.append(rows)
+        all_cols.append(cols)
+    flat = torch.unique(torch.cat(all_rows) * T1 + torch.cat(all_cols))
+    return flat // T1, flat % T1
+
+
+def get_mask(
+    T1,
+    T2,
+    mask_type,
+    sparse_attn_window,
+    global_window,
+    mask_random_seed,
+    sparsity,
+    device,
+):
+    """
+    Return a SparseCSRTensor mask that is a combination of elementary masks
+    mask_type can be a combination of multiple masks: for instance "diag_jmask_random"
+    """
+    from xformers.sparse import SparseCSRTensor
+
+    rows, cols = get_mask_indices(
+        T1, T2, mask_type, sparse_attn_window, global_window, mask_random_seed, sparsity, device)
+    row_offsets = F.pad(torch.bincount(rows, minlength=T2).cumsum(0), (1, 0))
+    values = torch.ones(1, len(cols), dtype=torch.bool, device=cols.device)
+    return SparseCSRTensor(row_offsets.int(), cols.int(), values, (1, T2, T1))
+
+
+class BlockSparseMask:
+    """
+    Attention mask for the "sdpa" backend. The queries are split into blocks of
+    `block_size` rows, and for each block we only keep the keys that are attended
+    by at least one of its rows, along with the mask restricted to those keys.
+    """
+    def __init__(self, shape: tp.Tuple[int, int, int],
+                 blocks: tp.List[tp.Tuple[slice, tp.Optional[torch.Tensor], torch.Tensor]]):
+        self.shape = shape
+        self.blocks = blocks
+
+    @classmethod
+    def from_indices(cls, rows: torch.Tensor, cols: torch.Tensor, T1: int, T2: int,
+                     block_size: int = 64):
+        """Build from the indices of the non zero entries, sorted by row."""
+        blocks: tp.List[tp.Tuple[slice, tp.Optional[torch.Tensor], torch.Tensor]] = []
+        bounds = torch.searchsorted(
+            rows, torch.arange(0, T2 + block_size, block_size, device=rows.device)).tolist()
+        for idx, start in enumerate(range(0, T2, block_size)):
+            stop = min(start + block_size, T2)
+            block_rows = rows[bounds[idx]:bounds[idx + 1]] - start
+            block_cols = cols[bounds[idx]:bounds[idx + 1]]
+            keys, inverse = torch.unique(block_cols, return_inverse=True)
+            if 2 * len(keys) > T1:
+                # Gathering the keys would cost more than it saves.
+                block = torch.zeros(stop - start, T1, dtype=torch.bool, device=rows.device)
+                block[block_rows, block_cols] = True
+                if blocks and blocks[-1][1] is None:
+                    # Merge with the previous block, which also uses all the keys.
+                    previous = blocks.pop(-1)
+                    start = previous[0].start
+                    block = torch.cat([previous[2], block])
+                blocks.append((slice(start, stop), None, block))
+            else:
+                block = torch.zeros(stop - start, len(keys), dtype=torch.bool, device=rows.device)
+                block[block_rows, inverse] = True
+                blocks.append((slice(start, stop), keys, block))
+        return cls((1, T2, T1), blocks)
+
+    @classmethod
+    def from_dense(cls, mask: torch.Tensor, block_size: int = 64):
+        T2, T1 = mask.shape
+        rows, cols = mask.nonzero().t()
+        return cls.from_indices(rows, cols, T1, T2, block_size)
+
+
+def get_block_sparse_mask(
+    T1,
+    T2,
+    mask_type,
+    sparse_attn_window,
+    global_window,
+    mask_random_seed,
+    sparsity,
+    device,
+):
+    """
+    Same as `get_mask` but returns a `BlockSparseMask`, which does not require xformers.
+    """
+    rows, cols = get_mask_indices(
+        T1, T2, mask_type, sparse_attn_window, global_window, mask_random_seed, sparsity, device)
+    return BlockSparseMask.from_indices(rows, cols, T1, T2)
+
+
+ATTENTION_BACKENDS = ["auto", "xformers", "sdpa"]
+# Masks shared by all the layers, see `get_cached_mask`.
+MASK_CACHE_SIZE = 16
+_mask_cache: tp.OrderedDict[tuple, tp.Any] = OrderedDict()
+_mask_cache_lock = threading.Lock()
+# Guards the embedding caches of all the `CrossTransformerEncoder`, as apply_model
+# might run them from several threads. Kept out of the modules so that they can be copied.
+_emb_cache_lock = threading.Lock()
+
+
+@functools.lru_cache(None)
+def _has_xformers() -> bool:
+    # Looked up once, as this is needed for every attention layer forward.
+    return importlib.util.find_spec("xformers") is not None
+
+
+def _resolve_backend(backend: str) -> str:
+    if backend == "auto":
+        return "xformers" if _has_xformers() else "sdpa"
+    return backend
+
+
+def get_cached_mask(
+    backend,
+    T1,
+    T2,
+    mask_type,
+    sparse_attn_window,
+    global_window,
+    mask_random_seed,
+    sparsity,
+    device,
+):
+    """
+    Return the mask for the given attention backend, either a SparseCSRTensor
+    or a `BlockSparseMask`. The last `MASK_CACHE_SIZE` masks are cached.
+    """
+    backend = _resolve_backend(backend)
+    key = (backend, T1, T2, mask_type, sparse_attn_window, global_window,
+           mask_random_seed, sparsity, torch.device(device))
+    with _mask_cache_lock:
+        mask = _mask_cache.get(key)
+        if mask is not None:
+            _mask_cache.move_to_end(key)
+            return mask
+    args = (T1, T2, mask_type, sparse_attn_window, global_window,
+            mask_random_seed, sparsity, device)
+    if backend == "sdpa":
+        mask = get_block_sparse_mask(*args)
+    else:
+        mask = get_mask(*args)
+    with _mask_cache_lock:
+        _mask_cache[key] = mask
+        while len(_mask_cache) > MASK_CACHE_SIZE:
+            _mask_cache.popitem(last=False)
+    return mask
+
+
+def set_attention_backend(model: nn.Module, backend: str):
+    """
+    Select the implementation used by the sparse attention layers of `model`.
+    "xformers" relies on the xformers sparse kernels, "sdpa" on
+    `torch.nn.functional.scaled_dot_product_attention`, with a pure PyTorch block sparse
+    implementation of the fixed masks. "auto" uses xformers when installed.
+    Dense attention layers always use `nn.MultiheadAttention`, which relies on
+    `scaled_dot_product_attention` at inference time.
+    """
+    if backend not in ATTENTION_BACKENDS:
+        raise ValueError(f"Invalid attention backend {backend}, "
+                         f"must be one of {', '.join(ATTENTION_BACKENDS)}.")
+    for module in model.modules():
+        if isinstance(module, MultiheadAttention):
+            if module.auto_sparsity and _resolve_backend(backend) != "xformers":
+                raise ValueError("Attention with auto sparsity requires xformers.")
+            module.attention_backend = backend
 
 
 class ScaledEmbedding(nn.Module):
@@ -334,7 +576,6 @@ class MyTransformerEncoderLayer(nn.TransformerEncoderLayer):
                 d_model, nhead, dropout=dropout, batch_first=batch_first,
                 auto_sparsity=sparsity if auto_sparsity else 0,
             )
-            self.__setattr__("src_mask", torch.zeros(1, 1))
             self.mask_random_seed = mask_random_seed
 
     def forward(self, src, src_mask=None, src_key_padding_mask=None):
@@ -345,21 +586,21 @@ class MyTransformerEncoderLayer(nn.TransformerEncoderLayer):
         device = src.device
         x = src
         T, B, C = x.shape
+        if self.self_attn.batch_first:
+            B, T, C = x.shape
         if self.sparse and not self.auto_sparsity:
             assert src_mask is None
-            src_mask = self.src_mask
-            if src_mask.shape[-1] != T:
-                src_mask = get_mask(
-                    T,
-                    T,
-                    self.mask_type,
-                    self.sparse_attn_window,
-                    self.global_window,
-                    self.mask_random_seed,
-                    self.sparsity,
-                    device,
-                )
-                self.__setattr__("src_mask", src_mask)
+            src_mask = get_cached_mask(
+                self.self_attn.attention_backend,
+                T,
+                T,
+                self.mask_type,
+                self.sparse_attn_window,
+                self.global_window,
+                self.mask_random_seed,
+                self.sparsity,
+                device,
+            )
 
         if self.norm_first:
             x = x + self.gamma_1(
@@ -461,7 +702,6 @@ class CrossTransformerEncoderLayer(nn.Module):
                 d_model, nhead, dropout=dropout, batch_first=batch_first,
                 auto_sparsity=sparsity if auto_sparsity else 0)
             if not auto_sparsity:
-                self.__setattr__("mask", torch.zeros(1, 1))
                 self.mask_random_seed = mask_random_seed
 
     def forward(self, q, k, mask=None):
@@ -475,21 +715,22 @@ class CrossTransformerEncoderLayer(nn.Module):
         device = q.device
         T, B, C = q.shape
         S, B, C = k.shape
+        if self.cross_attn.batch_first:
+            B, T, C = q.shape
+            B, S, C = k.shape
         if self.sparse and not self.auto_sparsity:
             assert mask is None
-            mask = self.mask
-            if mask.shape[-1] != S or mask.shape[-2] != T:
-                mask = get_mask(
-                    S,
-                    T,
-                    self.mask_type,
-                    self.sparse_attn_window,
-                    self.global_window,
-                    self.mask_random_seed,
-                    self.sparsity,
-                    device,
-                )
-                self.__setattr__("mask", mask)
+            mask = get_cached_mask(
+                self.cross_attn.attention_backend,
+                S,
+                T,
+                self.mask_type,
+                self.sparse_attn_window,
+                self.global_window,
+                self.mask_random_seed,
+                self.sparsity,
+                device,
+            )
 
         if self.norm_first:
             x = q + self.gamma_1(self._ca_block(self.norm1(q), self.norm2(k), mask))
@@ -525,6 +766,9 @@ class CrossTransformerEncoderLayer(nn.Module):
 
 
 class CrossTransformerEncoder(nn.Module):
+    # Maximum number of positional embeddings cached in eval mode.
+    max_cached_embeddings: int = 8
+
     def __init__(
         self,
         dim: int,
@@ -646,22 +890,92 @@ class CrossTransformerEncoder(nn.Module):
                     CrossTransformerEncoderLayer(**kwargs_cross_encoder)
                 )
 
+        # In eval mode, the positional embeddings only depend on the shapes,
+        # so we keep the most recently used ones, already weighted.
+        self._emb_cache: tp.OrderedDict[tuple, torch.Tensor] = OrderedDict()
+        # Embeddings precomputed by `freeze_embeddings`.
+        self.register_buffer("frozen_emb", None, persistent=False)
+        self.register_buffer("frozen_emb_t", None, persistent=False)
+        self._frozen_shape: tp.Optional[tuple] = None
+
+    def _cached_embedding(self, key: tuple, compute: tp.Callable[[], torch.Tensor]):
+        if self.training:
+            return compute()
+        cache = self._emb_cache
+        with _emb_cache_lock:
+            emb = cache.get(key)
+            if emb is not None:
+                cache.move_to_end(key)
+                return emb
+        emb = compute()
+        with _emb_cache_lock:
+            cache[key] = emb
+            while len(cache) > self.max_cached_embeddings:
+                cache.popitem(last=False)
+        return emb
+
+    def _pos_embedding_2d(self, C, Fr, T1, device, dtype):
+        # Weighted 2d embedding, with shape (1, T1 * Fr, C).
+        def _compute():
+            pos_emb_2d = create_2d_sin_embedding(
+                C, Fr, T1, device, self.max_period
+            )  # (1, C, Fr, T1)
+            pos_emb_2d = rearrange(pos_emb_2d, "b c fr t1 -> b (t1 fr) c")
+            return (self.weight_pos_embed * pos_emb_2d).to(dtype).contiguous()
+        return self._cached_embedding(("2d", C, Fr, T1, device, dtype), _compute)
+
+    def _pos_embedding_1d(self, T2, B, C, device, dtype):
+        # Weighted 1d embedding, with shape (B, T2, C) or (1, T2, C).
+        def _compute(batch_size):
+            pos_emb = self._get_pos_embedding(T2, batch_size, C, device)
+            pos_emb = rearrange(pos_emb, "t2 b c -> b t2 c")
+            return (self.weight_pos_embed * pos_emb).to(dtype).contiguous()
+        deterministic = (
+            (self.emb == "sin" and self.sin_random_shift == 0) or self.emb == "cape")
+        if not deterministic or self.training:
+            return _compute(B)
+        # In eval mode, the embedding is the same for all the items in the batch.
+        return self._cached_embedding(
+            (self.emb, C, 1, T2, device, dtype), lambda: _compute(1))
+
+    def freeze_embeddings(self, C: int, Fr: int, T1: int, T2: int,
+                          device=None, dtype=torch.float32):
+        """
+        Precompute the positional embeddings for inputs of shape `(B, C, Fr, T1)`
+        and `(B, C, T2)` into buffers, that are used instead of the cache in eval mode.
+        """
+        if device is None:
+            device = next(iter(self.parameters())).device
+        with torch.no_grad():
+            was_training = self.training
+            self.eval()
+            try:
+                self.frozen_emb = self._pos_embedding_2d(C, Fr, T1, device, dtype)
+                self.frozen_emb_t = self._pos_embedding_1d(T2, 1, C, device, dtype)
+            finally:
+                self.train(was_training)
+        self._frozen_shape = (C, Fr, T1, T2)
+
     def forward(self, x, xt):
         B, C, Fr, T1 = x.shape
-        pos_emb_2d = create_2d_sin_embedding(
-            C, Fr, T1, x.device, self.max_period
-        )  # (1, C, Fr, T1)
-        pos_emb_2d = rearrange(pos_emb_2d, "b c fr t1 -> b (t1 fr) c")
+        T2 = xt.shape[-1]
+        frozen = not self.training and self._frozen_shape == (C, Fr, T1, T2)
+        if frozen:
+            pos_emb_2d = self.frozen_emb.to(x.dtype)
+        else:
+            pos_emb_2d = self._pos_embedding_2d(C, Fr, T1, x.device, x.dtype)
         x = rearrange(x, "b c fr t1 -> b (t1 fr) c")
         x = self.norm_in(x)
-        x = x + self.weight_pos_embed * pos_emb_2d
+        x = x + pos_emb_2d
 
         B, C, T2 = xt.shape
         xt = rearrange(xt, "b c t2 -> b t2 c")  # now T2, B, C
-        pos_emb = self._get_pos_embedding(T2, B, C, x.device)
-        pos_emb = rearrange(pos_emb, "t2 b c -> b t2 c")
+        if frozen:
+            pos_emb = self.frozen_emb_t.to(xt.dtype)
+        else:
+            pos_emb = self._pos_embedding_1d(T2, B, C, x.device, xt.dtype)
         xt = self.norm_in_t(xt)
-        xt = xt + self.weight_pos_embed * pos_emb
+        xt = xt + pos_emb
 
         for idx in range(self.num_layers):
             if idx % 2 == self.classic_parity:
@@ -748,6 +1062,8 @@ class MultiheadAttention(nn.Module):
         self.proj_drop = torch.nn.Dropout(dropout)
         self.batch_first = batch_first
         self.auto_sparsity = auto_sparsity
+        # See `set_attention_backend`.
+        self.attention_backend = "auto"
 
     def forward(
         self,
@@ -758,7 +1074,9 @@ class MultiheadAttention(nn.Module):
         need_weights=True,
         attn_mask=None,
         average_attn_weights=True,
+        is_causal=False,
     ):
+        assert not is_causal, "Causal attention is not supported."
 
         if not self.batch_first:  # N, B, C
             query = query.permute(1, 0, 2)  # B, N_q, C
@@ -789,6 +1107,9 @@ class MultiheadAttention(nn.Module):
         if self.auto_sparsity:
             assert attn_mask is None
             x = dynamic_sparse_attention(q, k, v, sparsity=self.auto_sparsity)
+        elif _resolve_backend(self.attention_backend) == "sdpa":
+            dropout_p = self.attn_drop.p if self.training else 0.
+            x = block_sparse_attention(q, k, v, attn_mask, dropout_p=dropout_p)
         else:
             x = scaled_dot_product_attention(q, k, v, attn_mask, dropout=self.attn_drop)
         x = x.reshape(B, self.num_heads, N_q, C // self.num_heads)
@@ -816,6 +1137,24 @@ def scaled_dot_product_attention(q, k, v, att_mask, dropout):
     return y
 
 
+def block_sparse_attention(q, k, v, att_mask: tp.Optional[BlockSparseMask], dropout_p=0.):
+    """
+    Attention with `torch.nn.functional.scaled_dot_product_attention`.
+    For each block of queries in `att_mask`, only the keys it attends to are gathered.
+    """
+    if att_mask is None:
+        return F.scaled_dot_product_attention(q, k, v, dropout_p=dropout_p)
+    out = q.new_empty(q.shape[:-1] + v.shape[-1:])
+    for rows, cols, mask in att_mask.blocks:
+        if cols is None:
+            block_k, block_v = k, v
+        else:
+            block_k, block_v = k[:, cols], v[:, cols]
+        out[:, rows] = F.scaled_dot_product_attention(
+            q[:, rows], block_k, block_v, attn_mask=mask, dropout_p=dropout_p)
+    return out
+
+
 def _compute_buckets(x, R):
     qq = torch.einsum('btf,bfhi->bhti', x, R)
     qq = torch.cat([qq, -qq], dim=-1)
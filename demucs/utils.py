@@ -4,13 +4,15 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 
+import functools
 import math
 import os
 import tempfile
 import typing as tp
 from collections import defaultdict
 from concurrent.futures import CancelledError
-from contextlib import contextmanager
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
 
 import torch
 from torch.nn import functional as F
@@ -110,6 +112,53 @@ def temp_filenames(count: int, delete=True):
                 os.unlink(name)
 
 
+@contextmanager
+def atomic_write(path: tp.Union[str, Path]):
+    """
+    Yield a temporary path, unique to this call and in the same folder as `path`,
+    which is moved to `path` if the context exits without error, and removed otherwise.
+    Processes writing `path` at the same time thus never see a partially written file.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=path.name + '.', suffix='.tmp')
+    os.close(fd)
+    try:
+        yield Path(tmp)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+def _to_float(value):
+    if isinstance(value, torch.Tensor) and value.dtype in (torch.float16, torch.bfloat16):
+        return value.float()
+    return value
+
+
+def full_precision(method):
+    """Decorator running `method` with autocast disabled, and with its float16
+    or bfloat16 tensor arguments converted to float32.
+    This is used to keep the STFT and Wiener filtering in float32 when the rest
+    of the model runs in mixed precision.
+    """
+    @functools.wraps(method)
+    def _method(*args, **kwargs):
+        args = tuple(_to_float(arg) for arg in args)
+        kwargs = {key: _to_float(value) for key, value in kwargs.items()}
+        device_types = set(arg.device.type for arg in args if isinstance(arg, torch.Tensor))
+        context = nullcontext()
+        if len(device_types) == 1:
+            device_type = device_types.pop()
+            if device_type in ['cpu', 'cuda']:
+                context = torch.autocast(device_type, enabled=False)
+        with context:
+            return method(*args, **kwargs)
+    return _method
+
+
 def random_subset(dataset, max_samples: int, seed: int = 42):
     if max_samples >= len(dataset):
         return dataset
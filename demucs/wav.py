@@ -10,10 +10,11 @@ import json
 import math
 import os
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
-import julius
 import musdb
+import numpy as np
 import torch as th
 import torchaudio as ta
 import tqdm
@@ -21,10 +22,51 @@ from torch import distributed
 from torch.nn import functional as F
 
 from . import distrib
-from .audio import convert_audio_channels
+from .audio import convert_audio_channels, get_resampler
+from .utils import atomic_write
 
 MIXTURE = "mixture"
 EXT = ".wav"
+SHARD_INDEX = "shards.json"
+
+
+def _file_stamps(track, sources, ext=EXT):
+    # Size and modification time of the existing files of a track, to detect changes.
+    stamps = {}
+    for source in sources + [MIXTURE]:
+        try:
+            stat = (track / f"{source}{ext}").stat()
+        except FileNotFoundError:
+            continue
+        stamps[source] = [stat.st_size, stat.st_mtime_ns]
+    return stamps
+
+
+def _mean_std(file, chunk_size=2**20):
+    # Mean and std of the mono downmix of `file`, in a single pass over chunks of
+    # `chunk_size` frames, so that the track is never entirely loaded.
+    count = 0
+    mean = 0.
+    m2 = 0.
+    while True:
+        wav, _ = ta.load(str(file), frame_offset=count, num_frames=chunk_size)
+        chunk = wav.mean(0).double()
+        size = chunk.numel()
+        if size == 0:
+            break
+        chunk_mean = chunk.mean().item()
+        chunk_m2 = ((chunk - chunk_mean)**2).sum().item()
+        # Merge the statistics of the chunk with the previous ones, see Chan et al.
+        delta = chunk_mean - mean
+        total = count + size
+        mean += delta * size / total
+        m2 += chunk_m2 + delta**2 * count * size / total
+        count = total
+        if size < chunk_size:
+            break
+    # Unbiased, as `Tensor.std`.
+    std = math.sqrt(m2 / (count - 1)) if count > 1 else 0.
+    return mean, std
 
 
 def _track_metadata(track, sources, normalize=True, ext=EXT):
@@ -64,46 +106,74 @@ def _track_metadata(track, sources, normalize=True, ext=EXT):
                 f"expecting {track_samplerate} but got {info.sample_rate}.")
         if source == MIXTURE and normalize:
             try:
-                wav, _ = ta.load(str(file))
+                mean, std = _mean_std(file)
             except RuntimeError:
                 print(file)
                 raise
-            wav = wav.mean(0)
-            mean = wav.mean().item()
-            std = wav.std().item()
 
     return {"length": length, "mean": mean, "std": std, "samplerate": track_samplerate}
 
 
-def build_metadata(path, sources, normalize=True, ext=EXT):
+def build_metadata(path, sources, normalize=True, ext=EXT, cache=None, workers=None):
     """
     Build the metadata for `Wavset`.
 
     Args:
         path (str or Path): path to dataset.
         sources (list[str]): list of sources to look for.
-        normalize (bool): if True, loads full track and store normalization
+        normalize (bool): if True, reads the full track and store normalization
             values based on the mixture file.
         ext (str): extension of audio files (default is .wav).
+        cache (dict or None): metadata previously built for the same dataset. Tracks whose
+            files still have the same size and modification time are taken from it,
+            only the new or modified tracks are processed.
+        workers (int or None): number of processes used to process the tracks,
+            default to the number of cores.
     """
 
     meta = {}
     path = Path(path)
+    cache = cache or {}
     pendings = []
-    from concurrent.futures import ThreadPoolExecutor
-    with ThreadPoolExecutor(8) as pool:
+    with ProcessPoolExecutor(workers) as pool:
         for root, folders, files in os.walk(path, followlinks=True):
             root = Path(root)
             if root.name.startswith('.') or folders or root == path:
                 continue
             name = str(root.relative_to(path))
-            pendings.append((name, pool.submit(_track_metadata, root, sources, normalize, ext)))
-            # meta[name] = _track_metadata(root, sources, normalize, ext)
-        for name, pending in tqdm.tqdm(pendings, ncols=120):
-            meta[name] = pending.result()
+            cached = cache.get(name)
+            if cached is not None and cached.get('files') == _file_stamps(root, sources, ext):
+                pendings.append((name, root, cached))
+            else:
+                pendings.append((name, root, pool.submit(
+                    _track_metadata, root, sources, normalize, ext)))
+        for name, root, pending in tqdm.tqdm(pendings, ncols=120):
+            if isinstance(pending, dict):
+                meta[name] = pending
+            else:
+                meta[name] = pending.result()
+                # Taken after processing, as the mixture might have just been created.
+                meta[name]['files'] = _file_stamps(root, sources, ext)
     return meta
 
 
+def _update_metadata(metadata_file, build):
+    # Rebuild the metadata stored in `metadata_file` with `build`, which is given the
+    # previous metadata as cache, and save it if it changed.
+    metadata_file = Path(metadata_file)
+    try:
+        cache = json.loads(metadata_file.read_text())
+    except (OSError, ValueError):
+        # Missing or unreadable, everything is built again.
+        cache = None
+    metadata = build(cache)
+    if metadata != cache:
+        # Runs sharing the same metadata folder might do this at the same time.
+        with atomic_write(metadata_file) as tmp:
+            tmp.write_text(json.dumps(metadata))
+    return metadata
+
+
 class Wavset:
     def __init__(
             self,
@@ -140,69 +210,163 @@ class Wavset:
         self.channels = channels
         self.samplerate = samplerate
         self.ext = ext
-        self.num_examples = []
-        for name, meta in self.metadata.items():
-            track_duration = meta['length'] / meta['samplerate']
-            if segment is None or track_duration < segment:
-                examples = 1
-            else:
-                examples = int(math.ceil((track_duration - self.segment) / self.shift) + 1)
-            self.num_examples.append(examples)
+        self._names = list(self.metadata)
+        self.num_examples = np.ones(len(self._names), dtype=np.int64)
+        if segment is not None:
+            durations = np.array([meta['length'] / meta['samplerate']
+                                  for meta in self.metadata.values()], dtype=np.float64)
+            examples = np.ceil((durations - segment) / self.shift).astype(np.int64) + 1
+            self.num_examples = np.where(durations < segment, 1, examples)
+        # Index of the first example of each track, to find the track of an example
+        # with a binary search rather than walking through all the tracks.
+        self._offsets = np.cumsum(self.num_examples) - self.num_examples
+        self._length = int(self.num_examples.sum())
 
     def __len__(self):
-        return sum(self.num_examples)
+        return self._length
 
     def get_file(self, name, source):
         return self.root / name / f"{source}{self.ext}"
 
+    def _locate(self, index):
+        # Name of the track of the example `index`, and index of the example in that track.
+        if not 0 <= index < self._length:
+            raise IndexError(f"Index {index} out of range for {self._length} examples.")
+        track = int(np.searchsorted(self._offsets, index, side='right')) - 1
+        return self._names[track], int(index - self._offsets[track])
+
     def __getitem__(self, index):
-        for name, examples in zip(self.metadata, self.num_examples):
-            if index >= examples:
-                index -= examples
-                continue
-            meta = self.metadata[name]
-            num_frames = -1
-            offset = 0
-            if self.segment is not None:
-                offset = int(meta['samplerate'] * self.shift * index)
-                num_frames = int(math.ceil(meta['samplerate'] * self.segment))
-            wavs = []
-            for source in self.sources:
-                file = self.get_file(name, source)
-                wav, _ = ta.load(str(file), frame_offset=offset, num_frames=num_frames)
-                wav = convert_audio_channels(wav, self.channels)
-                wavs.append(wav)
-
-            example = th.stack(wavs)
-            example = julius.resample_frac(example, meta['samplerate'], self.samplerate)
-            if self.normalize:
-                example = (example - meta['mean']) / meta['std']
-            if self.segment:
-                length = int(self.segment * self.samplerate)
-                example = example[..., :length]
+        name, index = self._locate(index)
+        meta = self.metadata[name]
+        num_frames = -1
+        offset = 0
+        if self.segment is not None:
+            offset = int(meta['samplerate'] * self.shift * index)
+            num_frames = int(math.ceil(meta['samplerate'] * self.segment))
+        wavs = []
+        for source in self.sources:
+            file = self.get_file(name, source)
+            wav, _ = ta.load(str(file), frame_offset=offset, num_frames=num_frames)
+            wav = convert_audio_channels(wav, self.channels)
+            wavs.append(wav)
+
+        example = th.stack(wavs)
+        resampler = get_resampler(meta['samplerate'], self.samplerate,
+                                  example.device, example.dtype)
+        example = resampler(example)
+        if self.normalize:
+            example = (example - meta['mean']) / meta['std']
+        if self.segment:
+            length = int(self.segment * self.samplerate)
+            example = example[..., :length]
+            example = F.pad(example, (0, length - example.shape[-1]))
+        return example
+
+
+class ShardedWavset(Wavset):
+    def __init__(
+            self,
+            root, sources,
+            segment=None, shift=None, normalize=True,
+            samplerate=44100, channels=2):
+        """
+        Same as `Wavset`, but reading from the shards written by `demucs.pack.pack_wavset`,
+        where all the sources of each track are stored as one array of shape
+        `[time, sources, channels]`, already at the target sample rate and number
+        of channels. An example is a single contiguous slice of one memory mapped
+        shard, returned as a view when `normalize` is False and all the packed
+        sources are requested in order.
+
+        Args:
+            root (Path or str): folder with the shards and their index.
+            sources (list[str]): list of source names, must have been packed.
+            segment, shift, normalize: see `Wavset`, the normalization uses
+                the statistics stored in the index.
+            samplerate (int): sample rate, must be the one the shards were packed with.
+            channels (int): nb of channels, must be the one the shards were packed with.
+        """
+        root = Path(root)
+        index = json.load(open(root / SHARD_INDEX))
+        if index['samplerate'] != samplerate or index['channels'] != channels:
+            raise ValueError(
+                f"Shards in {root} have a sample rate of {index['samplerate']} and "
+                f"{index['channels']} channels, expecting {samplerate} and {channels}.")
+        missing = set(sources) - set(index['sources'])
+        if missing:
+            raise ValueError(f"Sources {', '.join(sorted(missing))} were not packed in {root}.")
+        metadata = {name: dict(track, samplerate=samplerate)
+                    for name, track in index['tracks'].items()}
+        super().__init__(root, metadata, sources, segment=segment, shift=shift,
+                         normalize=normalize, samplerate=samplerate, channels=channels)
+        self.shard_files = index['shards']
+        self._source_indexes = [index['sources'].index(source) for source in sources]
+        if self._source_indexes == list(range(len(index['sources']))):
+            self._source_indexes = None
+        self._shards = {}
+
+    def __getstate__(self):
+        # Memory maps are reopened by each data loader worker rather than pickled.
+        state = dict(self.__dict__)
+        state['_shards'] = {}
+        return state
+
+    def _shard(self, idx):
+        if idx not in self._shards:
+            # Copy on write, so that the tensors are writable without touching the file.
+            path = self.root / self.shard_files[idx]
+            self._shards[idx] = np.load(path, mmap_mode='c')
+        return self._shards[idx]
+
+    def __getitem__(self, index):
+        name, index = self._locate(index)
+        meta = self.metadata[name]
+        start = meta['offset']
+        end = start + meta['length']
+        if self.segment is not None:
+            start += int(self.samplerate * self.shift * index)
+            end = min(end, start + int(math.ceil(self.samplerate * self.segment)))
+        example = th.from_numpy(self._shard(meta['shard'])[start:end]).permute(1, 2, 0)
+        if self._source_indexes is not None:
+            example = example[self._source_indexes]
+        if self.normalize:
+            example = (example - meta['mean']) / meta['std']
+        if self.segment:
+            length = int(self.segment * self.samplerate)
+            example = example[..., :length]
+            if example.shape[-1] < length:
+                # Only the end of a track needs padding, otherwise `example` stays a view.
                 example = F.pad(example, (0, length - example.shape[-1]))
-            return example
+        return example
 
 
 def get_wav_datasets(args, name='wav'):
     """Extract the wav datasets from the XP arguments."""
     path = getattr(args, name)
+    if args.full_cv:
+        kw_cv = {}
+    else:
+        kw_cv = {'segment': args.segment, 'shift': args.shift}
+    if (Path(path) / "train" / SHARD_INDEX).is_file():
+        # Dataset packed with `python -m demucs.pack`.
+        train_set = ShardedWavset(Path(path) / "train", args.sources,
+                                  segment=args.segment, shift=args.shift,
+                                  samplerate=args.samplerate, channels=args.channels,
+                                  normalize=args.normalize)
+        valid_set = ShardedWavset(Path(path) / "valid", [MIXTURE] + list(args.sources),
+                                  samplerate=args.samplerate, channels=args.channels,
+                                  normalize=args.normalize, **kw_cv)
+        return train_set, valid_set
     sig = hashlib.sha1(str(path).encode()).hexdigest()[:8]
     metadata_file = Path(args.metadata) / ('wav_' + sig + ".json")
     train_path = Path(path) / "train"
     valid_path = Path(path) / "valid"
-    if not metadata_file.is_file() and distrib.rank == 0:
-        metadata_file.parent.mkdir(exist_ok=True, parents=True)
-        train = build_metadata(train_path, args.sources)
-        valid = build_metadata(valid_path, args.sources)
-        json.dump([train, valid], open(metadata_file, "w"))
+    if distrib.rank == 0:
+        _update_metadata(metadata_file, lambda cache: [
+            build_metadata(train_path, args.sources, cache=cache and cache[0]),
+            build_metadata(valid_path, args.sources, cache=cache and cache[1])])
     if distrib.world_size > 1:
         distributed.barrier()
     train, valid = json.load(open(metadata_file))
-    if args.full_cv:
-        kw_cv = {}
-    else:
-        kw_cv = {'segment': args.segment, 'shift': args.shift}
     train_set = Wavset(train_path, train, args.sources,
                        segment=args.segment, shift=args.shift,
                        samplerate=args.samplerate, channels=args.channels,
@@ -226,10 +390,9 @@ def get_musdb_wav_datasets(args):
     sig = hashlib.sha1(str(args.musdb).encode()).hexdigest()[:8]
     metadata_file = Path(args.metadata) / ('musdb_' + sig + ".json")
     root = Path(args.musdb) / "train"
-    if not metadata_file.is_file() and distrib.rank == 0:
-        metadata_file.parent.mkdir(exist_ok=True, parents=True)
-        metadata = build_metadata(root, args.sources)
-        json.dump(metadata, open(metadata_file, "w"))
+    if distrib.rank == 0:
+        _update_metadata(metadata_file,
+                         lambda cache: build_metadata(root, args.sources, cache=cache))
     if distrib.world_size > 1:
         distributed.barrier()
     metadata = json.load(open(metadata_file))
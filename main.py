@@ -5,17 +5,16 @@ import re
 import time
 from multiprocessing import Pipe, Process, Queue
 
-import matplotlib.pyplot as plt
-import pandas as pd
-import streamlit as st
-
-import demucs.api
+# The processes below are spawned, and so import this file again: the heavy modules
+# (streamlit, pandas, demucs and PyTorch, the YouTube downloader, crepe and TensorFlow)
+# are only imported where they are used.
 from audio.pitch_detection import YIN_realtime_pitch_detection, pitch_detection, realtime_pitch_detection
 from audio.utils import play_audio
-from DataCrawler.youtube2MP3 import convertMP4toWAV, downloadYouTube
 
 
 def download_song(url: str):
+    from DataCrawler.youtube2MP3 import convertMP4toWAV, downloadYouTube
+
     # Download the song
     download_dir = "downloaded_songs"
     filename = downloadYouTube(url, download_dir)
@@ -31,6 +30,8 @@ def download_song(url: str):
 
 
 def sep_audio(input_path, output_path):
+    import demucs.api
+
     # Check the output path
     if not os.path.exists(output_path):
         os.makedirs(output_path)
@@ -43,13 +44,15 @@ def sep_audio(input_path, output_path):
 
     # Separate the audio
     _, separated = separator.separate_tensor(wav)
-    for key in separated.keys():
-        demucs.api.save_audio(separated[key], f'{key}.wav', samplerate=44100, clip='none')
-        # Move the separated audio to the output path
-        os.rename(f'{key}.wav', os.path.join(output_path, f'{key}.wav'))
+    # Save the separated audio to the output path, all the stems at once
+    stems = {os.path.join(output_path, f'{key}.wav'): source for key, source in separated.items()}
+    demucs.api.save_stems(stems, samplerate=44100, clip='none')
 
 
 if __name__ == "__main__":
+    import pandas as pd
+    import streamlit as st
+
     mp.set_start_method('spawn', force=True)
     if st.session_state.get('stop_signal') is None:
         PARENT_CONN, CHILD_CONN = Pipe()
@@ -0,0 +1,75 @@
+import pytest
+import torch as th
+from torch import nn
+
+from demucs.apply import BagOfModels, TensorChunk, _shift_offsets, apply_model
+
+SOURCES = ['drums', 'bass', 'other', 'vocals']
+
+
+class _PointwiseModel(nn.Module):
+    # Tiny model mixing the channels of each time step independently, whose output
+    # does not depend on how the input is split, and which counts its calls.
+    def __init__(self, sources=SOURCES, samplerate=100, audio_channels=2, segment=1.):
+        super().__init__()
+        self.sources = sources
+        self.samplerate = samplerate
+        self.audio_channels = audio_channels
+        self.segment = segment
+        self.conv = nn.Conv1d(audio_channels, len(sources) * audio_channels, 1)
+        self.calls = 0
+
+    def forward(self, x):
+        self.calls += 1
+        B, C, T = x.shape
+        return self.conv(x).view(B, len(self.sources), C, T)
+
+
+def test_bag_sources():
+    th.manual_seed(1234)
+    models = [_PointwiseModel() for _ in SOURCES]
+    # Each sub-model only contributes to one source.
+    weights = [[float(k == idx) for k in range(len(SOURCES))] for idx in range(len(SOURCES))]
+    bag = BagOfModels(models, weights)
+    assert bag.active_models(['vocals', 'bass']) == [1, 3]
+    mix = th.randn(2, 2, 350)
+    full = apply_model(bag, mix, shifts=0)
+    assert all(model.calls > 0 for model in models)
+
+    for model in models:
+        model.calls = 0
+    out = apply_model(bag, mix, shifts=0, sources=['vocals'])
+    assert [model.calls > 0 for model in models] == [False, False, False, True]
+    assert out.shape == (2, 1, 2, 350)
+    assert th.allclose(out[:, 0], full[:, SOURCES.index('vocals')])
+
+
+@pytest.mark.parametrize('split', [False, True])
+@pytest.mark.parametrize('shift_mode, shift_seed', [('even', None), ('random', 42)])
+def test_batched_shifts_deterministic(split, shift_mode, shift_seed):
+    th.manual_seed(1234)
+    model = _PointwiseModel()
+    mix = th.randn(2, 2, 350)
+    kwargs = dict(shifts=3, split=split, shift_mode=shift_mode, shift_seed=shift_seed,
+                  batch_size=2, num_workers=2)
+    assert th.equal(apply_model(model, mix, **kwargs), apply_model(model, mix, **kwargs))
+
+
+@pytest.mark.parametrize('split', [False, True])
+def test_batched_shifts_sequential(split):
+    th.manual_seed(1234)
+    model = _PointwiseModel()
+    mix = th.randn(2, 2, 350)
+    shifts = 3
+    out = apply_model(model, mix, shifts=shifts, split=split, shift_mode='even', batch_size=2)
+
+    # Shifts one after the other, as done in the 'random' mode without a seed.
+    length = mix.shape[-1]
+    max_shift = int(0.5 * model.samplerate)
+    padded_mix = TensorChunk(mix).padded(length + 2 * max_shift)
+    ref = th.zeros_like(out)
+    for offset in _shift_offsets(shifts, max_shift, 'even', None):
+        shifted = TensorChunk(padded_mix, offset, length + max_shift - offset)
+        ref += apply_model(model, shifted, shifts=0, split=split)[..., max_shift - offset:]
+    ref /= shifts
+    assert th.allclose(out, ref, atol=1e-5)
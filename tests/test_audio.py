@@ -0,0 +1,22 @@
+import julius
+import pytest
+import torch as th
+
+from demucs.audio import StreamingResampler, get_resampler
+
+
+@pytest.mark.parametrize('rates', [(48000, 44100), (44100, 16000), (16000, 44100)])
+@pytest.mark.parametrize('chunk', [1, 1234, 10000])
+def test_streaming_resampler(rates, chunk):
+    old_sr, new_sr = rates
+    x = th.randn(2, old_sr // 10, generator=th.Generator().manual_seed(1234))
+    ref = julius.ResampleFrac(old_sr, new_sr)(x)
+    assert th.allclose(get_resampler(old_sr, new_sr)(x), ref)
+    streaming = StreamingResampler(old_sr, new_sr)
+    for _ in range(2):
+        # The resampler can be reused once flushed.
+        out = [streaming.push(x[:, offset: offset + chunk])
+               for offset in range(0, x.shape[-1], chunk)]
+        out = th.cat(out + [streaming.flush()], dim=-1)
+        assert out.shape == ref.shape
+        assert (ref - out).abs().max().item() < 1e-5
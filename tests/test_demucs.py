@@ -0,0 +1,63 @@
+import pytest
+import torch as th
+
+from demucs.demucs import BLSTM, DConv, FusedDConv
+from demucs.utils import unfold
+
+
+def _framed_blstm(blstm: BLSTM, x: th.Tensor) -> th.Tensor:
+    # Reference implementation of `BLSTM._forward_framed`, before the chunked version.
+    B, C, T = x.shape
+    width = blstm.max_steps
+    stride = width // 2
+    frames = unfold(x, width, stride)
+    nframes = frames.shape[2]
+    x = frames.permute(0, 2, 1, 3).reshape(-1, C, width).permute(2, 0, 1)
+    x = blstm.linear(blstm.lstm(x)[0]).permute(1, 2, 0)
+    out = []
+    frames = x.reshape(B, -1, C, width)
+    limit = stride // 2
+    for k in range(nframes):
+        if k == 0:
+            out.append(frames[:, k, :, :-limit])
+        elif k == nframes - 1:
+            out.append(frames[:, k, :, limit:])
+        else:
+            out.append(frames[:, k, :, limit:-limit])
+    return th.cat(out, -1)[..., :T]
+
+
+def _relative_error(ref: th.Tensor, out: th.Tensor) -> float:
+    return ((ref - out).abs().max() / ref.abs().max()).item()
+
+
+@pytest.mark.parametrize('dim', [3, 4])
+def test_fused_dconv(dim):
+    th.manual_seed(1234)
+    # A large LayerScale, so that the residual branch is not negligible.
+    dconv = DConv(16, depth=3, init=1.).eval()
+    shape = (2, 16, 3, 50) if dim == 4 else (2, 16, 50)
+    x = th.randn(*shape) * 10
+    with th.no_grad():
+        if dim == 4:
+            B, C, Fr, T = shape
+            ref = dconv(x.permute(0, 2, 1, 3).reshape(B * Fr, C, T))
+            ref = ref.view(B, Fr, C, T).permute(0, 2, 1, 3)
+        else:
+            ref = dconv(x)
+        out = FusedDConv(dconv)(x)
+    assert out.shape == ref.shape
+    assert _relative_error(ref, out) < 1e-5
+
+
+@pytest.mark.parametrize('length', [41, 100, 257])
+@pytest.mark.parametrize('max_batch', [None, 1, 2, 5, 100])
+def test_blstm_framed(length, max_batch):
+    th.manual_seed(1234)
+    blstm = BLSTM(8, layers=2, max_steps=40, max_batch=max_batch).eval()
+    x = th.randn(3, 8, length)
+    with th.no_grad():
+        ref = _framed_blstm(blstm, x)
+        out = blstm._forward_framed(x)
+    assert out.shape == ref.shape
+    assert _relative_error(ref, out) < 1e-5
@@ -0,0 +1,28 @@
+import pytest
+import torch as th
+
+from demucs.apply import apply_model
+from demucs.export import FrozenHTDemucs
+from demucs.htdemucs import HTDemucs
+from demucs.states import export_model
+
+SOURCES = ['drums', 'bass', 'other', 'vocals']
+
+
+@pytest.mark.parametrize('method', ['eager', 'torchscript', 'compile'])
+def test_export_model(method):
+    if method == 'compile' and not hasattr(th, 'compile'):
+        pytest.skip("torch.compile is not available.")
+    th.manual_seed(1234)
+    model = HTDemucs(SOURCES, channels=4, nfft=512, t_layers=2, segment=1).eval()
+    # Four segments, given to the model in batches of 1, or of 3 then 1.
+    mix = th.randn(1, 2, 100000)
+    ref = apply_model(model, mix, shifts=0)
+
+    exported = export_model(model, method, device='cpu', use_cache=False)
+    assert isinstance(exported, FrozenHTDemucs)
+    for batch_size in [1, 3]:
+        out = apply_model(exported, mix, shifts=0, batch_size=batch_size)
+        assert out.shape == ref.shape
+        error = ((ref - out).abs().max() / ref.abs().max()).item()
+        assert error < 1e-4, (batch_size, error)
@@ -0,0 +1,42 @@
+import pytest
+import torch as th
+
+from demucs.filtering import wiener
+
+
+def _openunmix_wiener(mag_out, mix_stft, niters, residual, window=300):
+    # Reference implementation, as used by HDemucs before `demucs.filtering`.
+    from openunmix.filtering import wiener
+
+    B, S, C, Fq, T = mag_out.shape
+    mag_out = mag_out.permute(0, 4, 3, 2, 1)
+    mix_stft = th.view_as_real(mix_stft.permute(0, 3, 2, 1))
+    outs = []
+    for sample in range(B):
+        out = []
+        for pos in range(0, T, window):
+            frame = slice(pos, pos + window)
+            z_out = wiener(mag_out[sample, frame], mix_stft[sample, frame], niters,
+                           residual=residual)
+            out.append(z_out.transpose(-1, -2))
+        outs.append(th.cat(out, dim=0))
+    out = th.view_as_complex(th.stack(outs, 0))
+    out = out.permute(0, 4, 3, 2, 1).contiguous()
+    if residual:
+        out = out[:, :-1]
+    return out
+
+
+@pytest.mark.parametrize('niters', [0, 1, 2])
+@pytest.mark.parametrize('residual', [False, True])
+def test_wiener(niters, residual):
+    pytest.importorskip('openunmix')
+    generator = th.Generator().manual_seed(1234)
+    # 350 frames, so that the last window is shorter than the others.
+    mix = th.randn(2, 2, 64, 350, dtype=th.complex64, generator=generator) * 30
+    mag = th.rand(2, 4, 2, 64, 350, generator=generator) * 30
+    with th.no_grad():
+        ref = _openunmix_wiener(mag, mix, niters, residual)
+        out = wiener(mag, mix, niters, residual)
+    assert out.shape == ref.shape
+    assert ((ref - out).abs().max() / ref.abs().max()).item() < 1e-4
@@ -0,0 +1,21 @@
+import pytest
+import torch as th
+
+from demucs.hdemucs import HDemucs, MultiWrap, set_multiwrap_workers
+
+
+@pytest.mark.parametrize('workers', [0, 2])
+def test_multiwrap_inference(workers):
+    th.manual_seed(1234)
+    model = HDemucs(['drums', 'bass', 'other', 'vocals'], channels=4, depth=4, nfft=512,
+                    multi_freqs=[0.25, 0.5]).eval()
+    assert any(isinstance(module, MultiWrap) for module in model.modules())
+    set_multiwrap_workers(model, workers)
+    x = th.randn(2, 2, 22050)
+    # With grad enabled, `MultiWrap` goes through the training code path.
+    ref = model(x).detach()
+    with th.no_grad():
+        out = model(x)
+    assert out.shape == ref.shape
+    error = ((ref - out).abs().max() / ref.abs().max()).item()
+    assert error < 1e-5
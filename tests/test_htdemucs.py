@@ -0,0 +1,43 @@
+import torch as th
+
+from demucs import htdemucs
+from demucs.apply import apply_model
+from demucs.hdemucs import _autocast_enabled
+from demucs.htdemucs import HTDemucs
+
+SOURCES = ['drums', 'bass', 'other', 'vocals']
+
+
+def _sdr(ref: th.Tensor, out: th.Tensor) -> float:
+    return (10 * th.log10(ref.pow(2).sum() / (ref - out).pow(2).sum())).item()
+
+
+def test_bf16_precision(monkeypatch):
+    th.manual_seed(1234)
+    # Without complex as channels, the masks go through `_wiener`.
+    model = HTDemucs(SOURCES, channels=4, nfft=512, cac=False, wiener_iters=1,
+                     t_layers=2, segment=1).eval()
+    calls = []
+
+    def _record(name, function):
+        def _recorded(*args, **kwargs):
+            dtypes = [arg.dtype for arg in args if isinstance(arg, th.Tensor)]
+            calls.append((name, dtypes, _autocast_enabled()))
+            return function(*args, **kwargs)
+        return _recorded
+
+    monkeypatch.setattr(model.spectro, 'stft', _record('stft', model.spectro.stft))
+    monkeypatch.setattr(model.spectro, 'istft', _record('istft', model.spectro.istft))
+    monkeypatch.setattr(htdemucs, 'wiener', _record('wiener', htdemucs.wiener))
+
+    mix = th.randn(1, 2, 30000)
+    ref = apply_model(model, mix, shifts=0)
+    calls.clear()
+    out = apply_model(model, mix, shifts=0, precision='bf16')
+    assert out.dtype == th.float32
+    assert _sdr(ref, out) > 20
+
+    assert sorted(set(name for name, _, _ in calls)) == ['istft', 'stft', 'wiener']
+    for name, dtypes, autocast in calls:
+        assert not autocast, name
+        assert all(dtype in [th.float32, th.complex64] for dtype in dtypes), (name, dtypes)
@@ -0,0 +1,68 @@
+import pytest
+import torch as th
+
+from demucs.apply import apply_model
+from demucs.filtering import wiener
+from demucs.htdemucs import HTDemucs
+from demucs.onnx_backend import OnnxHTDemucs, _wiener, export_onnx, load_onnx
+from demucs.spec import HybridSpectro
+
+pytest.importorskip('onnx')
+pytest.importorskip('onnxruntime')
+
+SOURCES = ['drums', 'bass', 'other', 'vocals']
+
+
+def _relative_error(ref: th.Tensor, out: th.Tensor) -> float:
+    return ((ref - out).abs().max() / ref.abs().max()).item()
+
+
+def _small_htdemucs(**kwargs) -> HTDemucs:
+    th.manual_seed(1234)
+    return HTDemucs(SOURCES, channels=4, nfft=512, t_layers=2, segment=1, **kwargs).eval()
+
+
+@pytest.fixture(scope='module')
+def onnx_model(tmp_path_factory) -> OnnxHTDemucs:
+    folder = tmp_path_factory.mktemp('onnx')
+    export_onnx(_small_htdemucs(), folder)
+    return load_onnx(folder)
+
+
+# Without complex as channels, the masks go through the NumPy `_wiener`.
+@pytest.mark.parametrize('kwargs', [{}, {'cac': False, 'wiener_iters': 1}])
+def test_onnx_model(tmp_path, kwargs):
+    model = _small_htdemucs(**kwargs)
+    mix = th.randn(2, 2, 60000)
+    ref = apply_model(model, mix, shifts=0)
+    export_onnx(model, tmp_path)
+    out = apply_model(load_onnx(tmp_path), mix, shifts=0)
+    assert out.shape == ref.shape
+    assert _relative_error(ref, out) < 1e-4
+
+
+def test_onnx_spec(onnx_model):
+    spectro = HybridSpectro(onnx_model.nfft, onnx_model.hop_length)
+    x = th.randn(2, 2, onnx_model.length)
+    z = spectro.stft(x)
+    out = th.from_numpy(onnx_model._spec(x.numpy()))
+    assert out.shape == z.shape
+    assert _relative_error(z, out) < 1e-5
+
+    ref = spectro.istft(z, onnx_model.length)
+    out = th.from_numpy(onnx_model._ispec(z.numpy(), onnx_model.length))
+    assert out.shape == ref.shape
+    assert _relative_error(ref, out) < 1e-5
+
+
+@pytest.mark.parametrize('niters', [0, 1, 2])
+@pytest.mark.parametrize('residual', [False, True])
+def test_onnx_wiener(niters, residual):
+    th.manual_seed(1234)
+    # Not a multiple of the window, so that the last window is padded.
+    mix_stft = th.randn(2, 2, 32, 350, dtype=th.complex64) * 10
+    mag_out = th.rand(2, 4, 2, 32, 350) * 10
+    ref = wiener(mag_out, mix_stft, niters, residual=residual)
+    out = th.from_numpy(_wiener(mag_out.numpy(), mix_stft.numpy(), niters, residual))
+    assert out.shape == ref.shape
+    assert _relative_error(ref, out.to(ref.dtype)) < 1e-4
@@ -0,0 +1,22 @@
+import pytest
+import torch as th
+
+from demucs.apply import apply_model
+from demucs.htdemucs import HTDemucs
+from demucs.quantize import quantize_int8
+
+SOURCES = ['drums', 'bass', 'other', 'vocals']
+
+
+@pytest.mark.skipif(th.backends.quantized.engine in [None, 'none'],
+                    reason="No quantized engine available.")
+@pytest.mark.parametrize('calibrated', [False, True])
+def test_quantize_int8(calibrated):
+    th.manual_seed(1234)
+    model = HTDemucs(SOURCES, channels=4, nfft=512, t_layers=2, segment=1).eval()
+    calibration = [th.randn(2, 50000)] if calibrated else None
+    quantized = quantize_int8(model, calibration)
+    mix = th.randn(2, 2, 60000)
+    out = apply_model(quantized, mix, shifts=0)
+    assert out.shape == (2, len(SOURCES), 2, 60000)
+    assert th.isfinite(out).all()
@@ -0,0 +1,45 @@
+import math
+
+import pytest
+import torch as th
+
+from demucs.hdemucs import pad1d
+from demucs.spec import HybridSpectro, ispectro, spectro
+
+
+def _padded_spectro(x, nfft, hl):
+    # Reference implementation, as used by HTDemucs before `HybridSpectro`.
+    le = int(math.ceil(x.shape[-1] / hl))
+    pad = hl // 2 * 3
+    x = pad1d(x, (pad, pad + le * hl - x.shape[-1]), mode="reflect")
+    z = spectro(x, nfft, hl)[..., :-1, :]
+    return z[..., 2: 2 + le]
+
+
+def _padded_ispectro(z, hl, length):
+    z = th.nn.functional.pad(z, (0, 0, 0, 1))
+    z = th.nn.functional.pad(z, (2, 2))
+    pad = hl // 2 * 3
+    le = hl * int(math.ceil(length / hl)) + 2 * pad
+    x = ispectro(z, hl, length=le)
+    return x[..., pad: pad + length]
+
+
+def _relative_error(ref: th.Tensor, out: th.Tensor) -> float:
+    return ((ref - out).abs().max() / ref.abs().max()).item()
+
+
+# The first length is shorter than the padding, which is then partly zeros.
+@pytest.mark.parametrize('length', [1000, 44100, 44100 * 3 + 17])
+def test_hybrid_spectro(length):
+    nfft = 4096
+    hl = nfft // 4
+    spectro = HybridSpectro(nfft, hl)
+    x = th.randn(2, 2, length, generator=th.Generator().manual_seed(1234))
+    ref = _padded_spectro(x, nfft, hl)
+    z = spectro.stft(x)
+    assert z.shape == ref.shape
+    assert _relative_error(ref, z) < 1e-5
+    out = spectro.istft(z, length)
+    assert out.shape == x.shape
+    assert _relative_error(_padded_ispectro(ref, hl, length), out) < 1e-5
@@ -0,0 +1,67 @@
+import random
+
+import pytest
+import torch as th
+import torchaudio as ta
+
+pytest.importorskip('musdb')
+
+from demucs.pack import pack_wavset  # noqa: E402
+from demucs.wav import EXT, ShardedWavset, Wavset  # noqa: E402
+
+
+def _linear_locate(dset, index):
+    # Track lookup of `Wavset.__getitem__` before the offsets index.
+    for name, examples in zip(dset.metadata, dset.num_examples):
+        if index >= examples:
+            index -= examples
+            continue
+        return name, index
+    raise IndexError(index)
+
+
+def test_locate():
+    rng = random.Random(1234)
+    # Some tracks are shorter than the segment, and count for a single example.
+    metadata = {f"track{idx}": {'length': rng.randint(1, 60) * 44100, 'samplerate': 44100,
+                                'mean': 0., 'std': 1.}
+                for idx in range(50)}
+    dset = Wavset('/dev/null', metadata, ['drums', 'bass'], segment=4., shift=1.)
+    for index in range(len(dset)):
+        assert dset._locate(index) == _linear_locate(dset, index)
+    with pytest.raises(IndexError):
+        dset._locate(len(dset))
+    with pytest.raises(IndexError):
+        dset._locate(-1)
+
+
+@pytest.mark.parametrize('segment', [None, 1.])
+@pytest.mark.parametrize('sources', [['drums', 'bass'], ['bass']])
+def test_sharded_wavset(tmp_path, segment, sources):
+    samplerate = 8000
+    packed = ['drums', 'bass']
+    generator = th.Generator().manual_seed(1234)
+    metadata = {}
+    for idx, duration in enumerate([2.5, 0.7, 4.]):
+        name = f"track{idx}"
+        length = int(duration * samplerate)
+        (tmp_path / 'raw' / name).mkdir(parents=True)
+        for source in packed:
+            wav = th.randn(2, length, generator=generator)
+            ta.save(str(tmp_path / 'raw' / name / f"{source}{EXT}"), wav, samplerate)
+        metadata[name] = {'length': length, 'samplerate': samplerate, 'mean': 0.1, 'std': 2.}
+    # Shards of about 0.3s, so that the tracks are spread over several of them.
+    shard_size = 0.3 * samplerate * len(packed) * 2 * 4 / 2**30
+    index = pack_wavset(tmp_path / 'raw', tmp_path / 'packed', packed, samplerate,
+                        shard_size=shard_size, metadata=metadata, workers=2)
+    assert len(index['shards']) == 3
+
+    kwargs = dict(segment=segment, shift=0.5, samplerate=samplerate)
+    ref = Wavset(tmp_path / 'raw', metadata, sources, **kwargs)
+    dset = ShardedWavset(tmp_path / 'packed', sources, **kwargs)
+    assert len(dset) == len(ref)
+    for index in range(len(ref)):
+        expected = ref[index]
+        example = dset[index]
+        assert example.shape == expected.shape
+        assert th.allclose(example, expected, atol=1e-6)
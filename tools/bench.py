@@ -0,0 +1,585 @@
+"""
+Benchmarks and regression checks for the inference code.
+
+Usage: python -m tools.bench SUBCOMMAND [OPTIONS], see `--help` for the list of subcommands.
+"""
+import argparse
+import math
+import sys
+import time
+import typing as tp
+from pathlib import Path
+
+import torch as th
+import torchaudio as ta
+
+from demucs.apply import apply_model
+from demucs.audio import convert_audio
+from demucs.pretrained import add_model_flags, get_model_from_args
+
+DEFAULT_TRACK = Path(__file__).parent.parent / 'audio' / 'beat.wav'
+
+
+def nsdr(references: th.Tensor, estimates: th.Tensor, eps: float = 1e-8) -> th.Tensor:
+    """SDR in dB of `estimates` with respect to `references`, over the last two dimensions."""
+    num = (references ** 2).sum(dim=(-2, -1))
+    den = ((references - estimates) ** 2).sum(dim=(-2, -1))
+    return 10 * th.log10((num + eps) / (den + eps))
+
+
+def load_track(path: Path, samplerate: int, channels: int, duration: tp.Optional[float] = None):
+    """Load a track for benchmarking, tiled to `duration` seconds if given."""
+    wav, sr = ta.load(str(path))
+    wav = convert_audio(wav, sr, samplerate, channels)
+    if duration is not None:
+        length = int(duration * samplerate)
+        wav = wav.repeat(1, (length + wav.shape[-1] - 1) // wav.shape[-1])[:, :length]
+    return wav
+
+
+def _normalize(wav: th.Tensor) -> th.Tensor:
+    ref = wav.mean(0)
+    return (wav - ref.mean()) / (ref.std() + 1e-8)
+
+
+def _load_normalized_track(args):
+    # Model given by the command line arguments, in eval mode,
+    # and the normalized track to separate with it.
+    model = get_model_from_args(args)
+    model.eval()
+    wav = load_track(args.track, model.samplerate, model.audio_channels, args.duration)
+    return model, _normalize(wav)
+
+
+def _check(name: str, error: float, tolerance: float):
+    # Exits with an error if the difference `error` with `name` is above `tolerance`.
+    if error > tolerance:
+        print(f"Difference with {name} above {tolerance}.", file=sys.stderr)
+        sys.exit(1)
+
+
+def _timed(func: tp.Callable[[], tp.Any]) -> tp.Tuple[tp.Any, float]:
+    begin = time.time()
+    out = func()
+    return out, time.time() - begin
+
+
+def check_precision(model, wav: th.Tensor, precisions: tp.Sequence[str],
+                    device='cpu', shifts: int = 0) -> tp.Dict[str, dict]:
+    """
+    Separate `wav` in fp32 and in each of the `precisions`, and return for each precision
+    the SDR per source of its estimates with respect to the fp32 ones, along with timings.
+    """
+    wav = _normalize(wav)
+    kwargs = dict(shifts=shifts, shift_mode='even', device=device)
+    results = {}
+    reference, duration = _timed(lambda: apply_model(model, wav[None], precision='fp32', **kwargs))
+    results['fp32'] = {'time': duration, 'sdr': {}}
+    for precision in precisions:
+        estimate, duration = _timed(
+            lambda: apply_model(model, wav[None], precision=precision, **kwargs))
+        sdrs = nsdr(reference[0], estimate[0])
+        results[precision] = {
+            'time': duration,
+            'sdr': {source: sdr.item() for source, sdr in zip(model.sources, sdrs)},
+        }
+    return results
+
+
+def bench_precision(args):
+    model = get_model_from_args(args)
+    model.eval()
+    wav = load_track(args.track, model.samplerate, model.audio_channels, args.duration)
+    results = check_precision(model, wav, args.precisions, args.device, args.shifts)
+    failed = False
+    for precision, result in results.items():
+        sdrs = ' '.join(f"{source}={sdr:.1f}dB" for source, sdr in result['sdr'].items())
+        print(f"{precision}: {result['time']:.2f}s {sdrs}")
+        if any(sdr < args.min_sdr for sdr in result['sdr'].values()):
+            failed = True
+    if failed:
+        print(f"SDR with respect to fp32 is below {args.min_sdr}dB.", file=sys.stderr)
+        sys.exit(1)
+
+
+def _time_call(func: tp.Callable[[], tp.Any], repeat: int) -> float:
+    func()  # warmup
+    begin = time.time()
+    for _ in range(repeat):
+        func()
+    return (time.time() - begin) / repeat
+
+
+def bench_attention(args):
+    from demucs import transformer
+
+    dim = args.dim // args.heads
+    print(f"{'length':>8} {'dense':>10} {'masked':>10} {'sparse':>10} {'xformers':>10}  density")
+    for length in args.lengths:
+        q, k, v = [th.randn(args.heads, length, dim, device=args.device) for _ in range(3)]
+        mask_args = (length, length, args.mask_type, args.window, args.global_window,
+                     42, args.sparsity, args.device)
+        dense_mask = transformer.get_dense_mask(*mask_args)
+        block_mask = transformer.BlockSparseMask.from_dense(dense_mask, args.block_size)
+        with th.no_grad():
+            times = [
+                _time_call(lambda: th.nn.functional.scaled_dot_product_attention(q, k, v),
+                           args.repeat),
+                _time_call(lambda: th.nn.functional.scaled_dot_product_attention(
+                    q, k, v, attn_mask=dense_mask), args.repeat),
+                _time_call(lambda: transformer.block_sparse_attention(q, k, v, block_mask),
+                           args.repeat),
+            ]
+            try:
+                csr_mask = transformer.get_mask(*mask_args)
+            except ImportError:
+                xformers = "n/a"
+            else:
+                xformers = "{:10.2f}".format(1000 * _time_call(
+                    lambda: transformer.scaled_dot_product_attention(
+                        q, k, v, csr_mask, dropout=th.nn.Identity()), args.repeat))
+        cells = ' '.join(f"{1000 * duration:10.2f}" for duration in times)
+        print(f"{length:>8} {cells} {xformers:>10}  {dense_mask.float().mean().item():.3f}")
+    print("Times in ms per call.")
+
+
+def _openunmix_wiener(mag_out, mix_stft, niters, residual, window=300):
+    # Reference implementation, as used by HDemucs before `demucs.filtering`.
+    from openunmix.filtering import wiener
+
+    B, S, C, Fq, T = mag_out.shape
+    mag_out = mag_out.permute(0, 4, 3, 2, 1)
+    mix_stft = th.view_as_real(mix_stft.permute(0, 3, 2, 1))
+    outs = []
+    for sample in range(B):
+        out = []
+        for pos in range(0, T, window):
+            frame = slice(pos, pos + window)
+            z_out = wiener(mag_out[sample, frame], mix_stft[sample, frame], niters,
+                           residual=residual)
+            out.append(z_out.transpose(-1, -2))
+        outs.append(th.cat(out, dim=0))
+    out = th.view_as_complex(th.stack(outs, 0))
+    out = out.permute(0, 4, 3, 2, 1).contiguous()
+    if residual:
+        out = out[:, :-1]
+    return out
+
+
+def bench_wiener(args):
+    from demucs.filtering import wiener
+
+    generator = th.Generator().manual_seed(1234)
+    shape = (args.batch_size, args.channels, args.bins, args.frames)
+    mix = th.randn(*shape, dtype=th.complex64, generator=generator) * args.scale
+    mag = th.rand(args.batch_size, args.sources, *shape[1:], generator=generator) * args.scale
+    errors = []
+    for niters in args.iters:
+        with th.no_grad():
+            ref, ref_time = _timed(lambda: _openunmix_wiener(mag, mix, niters, args.residual))
+            out, new_time = _timed(lambda: wiener(mag, mix, niters, args.residual))
+        error = ((ref - out).abs().max() / ref.abs().max()).item()
+        print(f"iters={niters} openunmix={ref_time:.3f}s batched={new_time:.3f}s "
+              f"speedup={ref_time / new_time:.2f}x max relative error={error:.2e}")
+        errors.append(error)
+    _check('openunmix', max(errors), args.tolerance)
+
+
+def _padded_spectro(x, nfft, hl):
+    # Reference implementation, as used by HTDemucs before `demucs.spec.HybridSpectro`.
+    from demucs.hdemucs import pad1d
+    from demucs.spec import spectro
+
+    le = int(math.ceil(x.shape[-1] / hl))
+    pad = hl // 2 * 3
+    x = pad1d(x, (pad, pad + le * hl - x.shape[-1]), mode="reflect")
+    z = spectro(x, nfft, hl)[..., :-1, :]
+    return z[..., 2: 2 + le]
+
+
+def _padded_ispectro(z, hl, length):
+    from demucs.spec import ispectro
+
+    z = th.nn.functional.pad(z, (0, 0, 0, 1))
+    z = th.nn.functional.pad(z, (2, 2))
+    pad = hl // 2 * 3
+    le = hl * int(math.ceil(length / hl)) + 2 * pad
+    x = ispectro(z, hl, length=le)
+    return x[..., pad: pad + length]
+
+
+def bench_spectro(args):
+    from demucs.spec import HybridSpectro
+
+    hl = args.nfft // 4
+    spectro = HybridSpectro(args.nfft, hl)
+    print(f"{'segment':>8} {'batch':>6} {'stft':>8} {'fused':>8} {'istft':>8} {'fused':>8}  error")
+    for segment in args.segments:
+        length = int(segment * args.samplerate)
+        for batch_size in args.batch_sizes:
+            x = th.randn(batch_size, args.channels, length, device=args.device)
+            z = spectro.stft(x)
+            with th.no_grad():
+                times = [
+                    _time_call(lambda: _padded_spectro(x, args.nfft, hl), args.repeat),
+                    _time_call(lambda: spectro.stft(x), args.repeat),
+                    _time_call(lambda: _padded_ispectro(z, hl, length), args.repeat),
+                    _time_call(lambda: spectro.istft(z, length), args.repeat),
+                ]
+                ref = _padded_ispectro(_padded_spectro(x, args.nfft, hl), hl, length)
+                out = spectro.istft(spectro.stft(x), length)
+            error = ((ref - out).abs().max() / ref.abs().max()).item()
+            cells = ' '.join(f"{1000 * duration:8.2f}" for duration in times)
+            print(f"{segment:>8} {batch_size:>6} {cells}  {error:.1e}")
+    print("Times in ms per call, error is the max relative error after a round trip.")
+
+
+def bench_resample(args):
+    import julius
+
+    from demucs.audio import StreamingResampler, get_resampler
+
+    print(f"{'rates':>12} {'duration':>8} {'julius':>8} {'cached':>8} {'stream':>8}  error")
+    for rates in args.rates:
+        old_sr, new_sr = map(int, rates.split(':'))
+        for duration in args.durations:
+            x = th.randn(args.channels, int(duration * old_sr), device=args.device)
+            chunk = int(args.chunk * old_sr)
+            streaming = StreamingResampler(old_sr, new_sr, x.device, x.dtype)
+
+            def _stream():
+                out = [streaming.push(x[:, offset: offset + chunk])
+                       for offset in range(0, x.shape[-1], chunk)]
+                return th.cat(out + [streaming.flush()], dim=-1)
+
+            with th.no_grad():
+                times = [
+                    _time_call(lambda: julius.resample_frac(x, old_sr, new_sr), args.repeat),
+                    _time_call(lambda: get_resampler(old_sr, new_sr, x.device, x.dtype)(x),
+                               args.repeat),
+                    _time_call(_stream, args.repeat),
+                ]
+                error = (julius.resample_frac(x, old_sr, new_sr) - _stream()).abs().max().item()
+            cells = ' '.join(f"{1000 * elapsed:8.2f}" for elapsed in times)
+            print(f"{rates:>12} {duration:>8} {cells}  {error:.1e}")
+    print(f"Times in ms per call, stream is fed with chunks of {args.chunk}s, "
+          "error is the max difference between stream and julius.")
+
+
+def _linear_locate(dset, index: int) -> tp.Tuple[str, int]:
+    # Track lookup of `Wavset.__getitem__` before the offsets index.
+    for name, examples in zip(dset.metadata, dset.num_examples):
+        if index >= examples:
+            index -= examples
+            continue
+        return name, index
+    raise IndexError(index)
+
+
+def bench_wavset(args):
+    import random
+
+    from demucs.wav import Wavset
+
+    rng = random.Random(1234)
+    print(f"{'tracks':>8} {'examples':>9} {'init':>8} {'linear':>9} {'indexed':>9}")
+    for tracks in args.tracks:
+        metadata = {f"track{idx}": {'length': rng.randint(60, 600) * 44100, 'samplerate': 44100,
+                                    'mean': 0., 'std': 1.}
+                    for idx in range(tracks)}
+        dset, init = _timed(lambda: Wavset('/dev/null', metadata, ['drums', 'bass'],
+                                           segment=args.segment, shift=args.shift))
+        indexes = [rng.randrange(len(dset)) for _ in range(args.lookups)]
+        for index in indexes[:100]:
+            assert dset._locate(index) == _linear_locate(dset, index), index
+        _, linear = _timed(lambda: [_linear_locate(dset, index) for index in indexes])
+        _, indexed = _timed(lambda: [dset._locate(index) for index in indexes])
+        print(f"{tracks:>8} {len(dset):>9} {1000 * init:8.1f} "
+              f"{1e6 * linear / len(indexes):9.2f} {1e6 * indexed / len(indexes):9.2f}")
+    print("init in ms, linear and indexed are the track lookup times per example in us.")
+
+
+def bench_export(args):
+    from demucs.states import export_model
+
+    model, wav = _load_normalized_track(args)
+    kwargs = dict(shifts=0, device=args.device, batch_size=args.batch_size)
+    reference, eager_time = _timed(lambda: apply_model(model, wav[None], **kwargs))
+    exported, export_time = _timed(lambda: export_model(
+        model, args.method, device=args.device, use_cache=not args.no_cache))
+    apply_model(exported, wav[None], **kwargs)  # warmup, compiles with torch.compile.
+    estimate, frozen_time = _timed(lambda: apply_model(exported, wav[None], **kwargs))
+    error = (reference - estimate).abs().max().item()
+    print(f"eager={eager_time:.2f}s {args.method}={frozen_time:.2f}s "
+          f"export={export_time:.2f}s max abs difference={error:.2e}")
+    _check('eager mode', error, args.tolerance)
+
+
+def bench_onnx(args):
+    import tempfile
+
+    from demucs.onnx_backend import export_onnx, load_onnx
+
+    model, wav = _load_normalized_track(args)
+    duration = wav.shape[-1] / model.samplerate
+    kwargs = dict(shifts=0, device='cpu', num_workers=args.jobs)
+    reference, eager_time = _timed(lambda: apply_model(model, wav[None], **kwargs))
+    with tempfile.TemporaryDirectory() as folder:
+        _, export_time = _timed(lambda: export_onnx(model, folder))
+        onnx_model = load_onnx(folder, args.threads)
+        estimate, onnx_time = _timed(lambda: apply_model(onnx_model, wav[None], **kwargs))
+    error = (reference - estimate).abs().max().item()
+    print(f"export={export_time:.2f}s max abs difference={error:.2e}")
+    for name, elapsed in [('torch', eager_time), ('onnx', onnx_time)]:
+        print(f"{name}: {elapsed:.2f}s, {duration / elapsed:.2f} seconds of audio per second")
+    _check('PyTorch', error, args.tolerance)
+
+
+def bench_int8(args):
+    from demucs.quantize import quantize_int8
+
+    th.set_num_threads(args.threads or th.get_num_threads())
+    model, wav = _load_normalized_track(args)
+    calibration = [load_track(track, model.samplerate, model.audio_channels,
+                              args.calibration_duration)
+                   for track in args.calibration or [args.track]]
+    kwargs = dict(shifts=0, device='cpu')
+    with th.no_grad():
+        reference, fp32_time = _timed(lambda: apply_model(model, wav[None], **kwargs))
+        results = {'fp32': (fp32_time, None)}
+        dynamic = quantize_int8(model)
+        estimate, elapsed = _timed(lambda: apply_model(dynamic, wav[None], **kwargs))
+        results['int8'] = (elapsed, nsdr(reference[0], estimate[0]))
+        static, calibration_time = _timed(lambda: quantize_int8(model, calibration))
+        estimate, elapsed = _timed(lambda: apply_model(static, wav[None], **kwargs))
+        results['int8-calibrated'] = (elapsed, nsdr(reference[0], estimate[0]))
+    print(f"calibration={calibration_time:.2f}s")
+    failed = False
+    for name, (elapsed, sdrs) in results.items():
+        line = f"{name}: {elapsed:.2f}s, {fp32_time / elapsed:.2f}x"
+        if sdrs is not None:
+            line += ' ' + ' '.join(f"{source}={sdr:.1f}dB"
+                                   for source, sdr in zip(model.sources, sdrs.tolist()))
+            failed |= bool((sdrs < args.min_sdr).any())
+        print(line)
+    if failed:
+        print(f"SDR with respect to fp32 is below {args.min_sdr}dB.", file=sys.stderr)
+        sys.exit(1)
+
+
+def _module_timings(model, wav: th.Tensor,
+                    types: tp.Tuple[type, ...]) -> tp.Tuple[th.Tensor, tp.Dict[str, float]]:
+    # Separates `wav` and returns the time spent in each submodule of one of `types`.
+    timings: tp.Dict[str, float] = {}
+    begins: tp.Dict[str, float] = {}
+    handles = []
+    for name, module in model.named_modules():
+        if isinstance(module, types):
+            def pre_hook(module, inputs, name=name):
+                begins[name] = time.time()
+
+            def hook(module, inputs, output, name=name):
+                timings[name] = timings.get(name, 0.) + time.time() - begins[name]
+            handles += [module.register_forward_pre_hook(pre_hook),
+                        module.register_forward_hook(hook)]
+    try:
+        with th.no_grad():
+            out = apply_model(model, wav[None], shifts=0, device='cpu')
+    finally:
+        for handle in handles:
+            handle.remove()
+    return out, timings
+
+
+def bench_dconv(args):
+    import copy
+
+    from demucs.demucs import DConv, FusedDConv, fuse_dconv
+
+    model, wav = _load_normalized_track(args)
+    fused = copy.deepcopy(model)
+    print(f"Fused {fuse_dconv(fused)} residual branches.")
+    reference, timings = _module_timings(model, wav, (DConv, FusedDConv))
+    estimate, fused_timings = _module_timings(fused, wav, (DConv, FusedDConv))
+    for name, elapsed in timings.items():
+        if name in fused_timings:
+            fused_elapsed = fused_timings[name]
+            print(f"{name}: {1000 * elapsed:.1f}ms -> {1000 * fused_elapsed:.1f}ms, "
+                  f"{elapsed / fused_elapsed:.2f}x")
+    total = sum(timings.values())
+    fused_total = sum(fused_timings.values())
+    error = (reference - estimate).abs().max().item()
+    print(f"total: {total:.2f}s -> {fused_total:.2f}s, {total / fused_total:.2f}x, "
+          f"max abs difference={error:.2e}")
+    _check('DConv', error, args.tolerance)
+
+
+def bench_multiwrap(args):
+    from demucs.hdemucs import MultiWrap, set_multiwrap_workers
+
+    model, wav = _load_normalized_track(args)
+    results = {}
+    for workers in [0, args.workers]:
+        set_multiwrap_workers(model, workers)
+        results[workers] = _module_timings(model, wav, (MultiWrap,))
+    reference, timings = results[0]
+    estimate, concurrent_timings = results[args.workers]
+    if not timings:
+        print("The model has no MultiWrap layer.", file=sys.stderr)
+        sys.exit(1)
+    for name, elapsed in timings.items():
+        print(f"{name}: {1000 * elapsed:.1f}ms -> {1000 * concurrent_timings[name]:.1f}ms")
+    total = sum(timings.values())
+    concurrent_total = sum(concurrent_timings.values())
+    error = (reference - estimate).abs().max().item()
+    print(f"total: {total:.2f}s -> {concurrent_total:.2f}s with {args.workers} workers, "
+          f"{total / concurrent_total:.2f}x, max abs difference={error:.2e}")
+    _check('sequential bands', error, args.tolerance)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser("tools.bench", description=__doc__.strip())
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    sub = subparsers.add_parser(
+        'precision', help="Check the SDR of reduced precision inference against fp32.")
+    add_model_flags(sub)
+    sub.add_argument('--track', type=Path, default=DEFAULT_TRACK)
+    sub.add_argument('--duration', type=float,
+                     help="Tile the track to that duration, in seconds.")
+    sub.add_argument('-d', '--device', default='cpu')
+    sub.add_argument('--shifts', type=int, default=0)
+    sub.add_argument('-p', '--precisions', nargs='+', default=['bf16'],
+                     choices=['bf16', 'fp16'])
+    sub.add_argument('--min-sdr', type=float, default=30.,
+                     help="Fail if the SDR with respect to fp32 is below this value.")
+    sub.set_defaults(func=bench_precision)
+
+    sub = subparsers.add_parser(
+        'export', help="Check that an exported model gives the same output as in eager mode.")
+    add_model_flags(sub)
+    sub.add_argument('--track', type=Path, default=DEFAULT_TRACK)
+    sub.add_argument('--duration', type=float,
+                     help="Tile the track to that duration, in seconds.")
+    sub.add_argument('-d', '--device', default='cpu')
+    sub.add_argument('-m', '--method', default='torchscript',
+                     choices=['torchscript', 'compile', 'eager'])
+    sub.add_argument('-b', '--batch-size', type=int, default=1)
+    sub.add_argument('--no-cache', action='store_true',
+                     help="Do not use the cache of traced models.")
+    sub.add_argument('--tolerance', type=float, default=1e-4)
+    sub.set_defaults(func=bench_export)
+
+    sub = subparsers.add_parser(
+        'onnx', help="Compare the ONNX Runtime backend with PyTorch, on CPU.")
+    add_model_flags(sub)
+    sub.add_argument('--track', type=Path, default=DEFAULT_TRACK)
+    sub.add_argument('--duration', type=float,
+                     help="Tile the track to that duration, in seconds.")
+    sub.add_argument('-j', '--jobs', type=int, default=0)
+    sub.add_argument('--threads', type=int, help="ONNX Runtime threads per model.")
+    sub.add_argument('--tolerance', type=float, default=1e-4)
+    sub.set_defaults(func=bench_onnx)
+
+    sub = subparsers.add_parser(
+        'int8', help="Check the SDR and speed of int8 inference on CPU against fp32.")
+    add_model_flags(sub)
+    sub.add_argument('--track', type=Path, default=DEFAULT_TRACK)
+    sub.add_argument('--duration', type=float,
+                     help="Tile the track to that duration, in seconds.")
+    sub.add_argument('--calibration', type=Path, nargs='+',
+                     help="Tracks used to calibrate the convolutions, default to --track.")
+    sub.add_argument('--calibration-duration', type=float, default=30.)
+    sub.add_argument('--threads', type=int)
+    sub.add_argument('--min-sdr', type=float, default=10.,
+                     help="Fail if the SDR with respect to fp32 is below this value.")
+    sub.set_defaults(func=bench_int8)
+
+    sub = subparsers.add_parser(
+        'dconv', help="Check the fused DConv residual branches and time them, per layer.")
+    add_model_flags(sub)
+    sub.add_argument('--track', type=Path, default=DEFAULT_TRACK)
+    sub.add_argument('--duration', type=float,
+                     help="Tile the track to that duration, in seconds.")
+    sub.add_argument('--tolerance', type=float, default=1e-5)
+    sub.set_defaults(func=bench_dconv)
+
+    sub = subparsers.add_parser(
+        'multiwrap', help="Time the frequency bands of MultiWrap layers run concurrently.")
+    add_model_flags(sub)
+    sub.add_argument('--track', type=Path, default=DEFAULT_TRACK)
+    sub.add_argument('--duration', type=float,
+                     help="Tile the track to that duration, in seconds.")
+    sub.add_argument('-w', '--workers', type=int, default=3)
+    sub.add_argument('--tolerance', type=float, default=1e-5)
+    sub.set_defaults(func=bench_multiwrap)
+
+    sub = subparsers.add_parser(
+        'attention', help="Compare the attention backends across sequence lengths.")
+    sub.add_argument('--lengths', type=int, nargs='+', default=[256, 1024, 4096])
+    sub.add_argument('--dim', type=int, default=512)
+    sub.add_argument('--heads', type=int, default=8)
+    sub.add_argument('--mask-type', default='diag_jmask')
+    sub.add_argument('--window', type=int, default=100, help="Sparse attention window.")
+    sub.add_argument('--global-window', type=int, default=50)
+    sub.add_argument('--sparsity', type=float, default=0.95)
+    sub.add_argument('--block-size', type=int, default=64)
+    sub.add_argument('--repeat', type=int, default=5)
+    sub.add_argument('-d', '--device', default='cpu')
+    sub.set_defaults(func=bench_attention)
+
+    sub = subparsers.add_parser(
+        'wiener', help="Check the batched Wiener filtering against openunmix.")
+    sub.add_argument('-b', '--batch-size', type=int, default=2)
+    sub.add_argument('--sources', type=int, default=4)
+    sub.add_argument('--channels', type=int, default=2)
+    sub.add_argument('--bins', type=int, default=2048)
+    sub.add_argument('--frames', type=int, default=336)
+    sub.add_argument('--scale', type=float, default=30.)
+    sub.add_argument('--iters', type=int, nargs='+', default=[0, 1, 2])
+    sub.add_argument('--residual', action='store_true')
+    sub.add_argument('--tolerance', type=float, default=1e-4)
+    sub.set_defaults(func=bench_wiener)
+
+    sub = subparsers.add_parser(
+        'spectro', help="Compare the fused STFT/iSTFT of the hybrid models with the old one.")
+    sub.add_argument('--segments', type=float, nargs='+', default=[7.8, 10.],
+                     help="Segment durations in seconds, default to HTDemucs and HDemucs ones.")
+    sub.add_argument('-b', '--batch-sizes', type=int, nargs='+', default=[1, 4])
+    sub.add_argument('--samplerate', type=int, default=44100)
+    sub.add_argument('--channels', type=int, default=2)
+    sub.add_argument('--nfft', type=int, default=4096)
+    sub.add_argument('--repeat', type=int, default=10)
+    sub.add_argument('-d', '--device', default='cpu')
+    sub.set_defaults(func=bench_spectro)
+
+    sub = subparsers.add_parser(
+        'resample', help="Compare the cached and streaming resamplers with julius.")
+    sub.add_argument('--rates', nargs='+', default=['48000:44100', '44100:16000', '48000:16000'],
+                     help="Conversions to time, as FROM:TO samplerates.")
+    sub.add_argument('--durations', type=float, nargs='+', default=[1., 10.],
+                     help="Durations of the audio in seconds.")
+    sub.add_argument('--chunk', type=float, default=0.1,
+                     help="Duration of the chunks fed to the streaming resampler.")
+    sub.add_argument('--channels', type=int, default=2)
+    sub.add_argument('--repeat', type=int, default=10)
+    sub.add_argument('-d', '--device', default='cpu')
+    sub.set_defaults(func=bench_resample)
+
+    sub = subparsers.add_parser(
+        'wavset', help="Time the lookup of the examples of Wavset against the corpus size.")
+    sub.add_argument('--tracks', type=int, nargs='+', default=[100, 1000, 10000, 50000])
+    sub.add_argument('--segment', type=float, default=11.)
+    sub.add_argument('--shift', type=float, default=1.)
+    sub.add_argument('--lookups', type=int, default=1000)
+    sub.set_defaults(func=bench_wavset)
+    return parser
+
+
+def main(opts=None):
+    args = get_parser().parse_args(opts)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
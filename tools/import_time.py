@@ -0,0 +1,96 @@
+"""
+Cold start time of the entry points, i.e. the time taken to import them in a fresh
+interpreter, along with the slowest modules they import, as reported by `-X importtime`.
+
+Usage: python -m tools.import_time [ENTRY_POINT ...] [--preload torch] [--top 10]
+
+This module does not import PyTorch itself, so that it can be run before and after a change
+to the imports without skewing the results.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess as sp
+import sys
+import typing as tp
+from pathlib import Path
+
+ROOT = Path(__file__).parent.parent
+ENTRY_POINTS = [
+    'demucs.api',
+    'demucs.separate',
+    'demucs.pretrained',
+    'demucs.store',
+    'audio.pitch_detection',
+]
+
+
+def import_times(module: str,
+                 preload: tp.Sequence[str] = ()) -> tp.Tuple[int, tp.Dict[str, int]]:
+    """
+    Import `module` in a fresh interpreter, after the `preload` modules, and return the
+    total import time in microseconds, along with the cumulative import time of each of
+    the modules directly imported by `module` or its parent packages.
+    """
+    code = ''.join(f'import {name};' for name in preload)
+    code += 'import sys; sys.stderr.write("-- start\\n");'
+    code += f'import {module}'
+    path = os.pathsep.join([str(ROOT), os.environ.get('PYTHONPATH', '')])
+    proc = sp.run([sys.executable, '-X', 'importtime', '-c', code], stdout=sp.DEVNULL,
+                  stderr=sp.PIPE, text=True, env=dict(os.environ, PYTHONPATH=path), cwd=ROOT)
+    if proc.returncode:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1])
+    total = 0
+    children: tp.Dict[str, int] = {}
+    for line in proc.stderr.split('-- start\n', 1)[1].splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # The nesting is given by the indentation, with `module` and its parent packages
+        # at depth 0.
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 0:
+            total += int(cumulative)
+        elif depth == 1:
+            children[name.strip()] = int(cumulative)
+    return total, children
+
+
+def main(opts=None):
+    parser = argparse.ArgumentParser("tools.import_time", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('modules', nargs='*', default=ENTRY_POINTS,
+                        help="Entry points to import, default to %(default)s.")
+    parser.add_argument('--preload', action='append', default=[],
+                        help="Modules imported before starting the clock, e.g. `torch`, "
+                             "whose import time cannot be reduced anyway.")
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help="Number of fresh interpreters per entry point, the median is kept.")
+    parser.add_argument('--top', type=int, default=5,
+                        help="Number of slowest imported modules to report per entry point.")
+    parser.add_argument('--json', type=Path, help="Also dump the results to this file.")
+    args = parser.parse_args(opts)
+
+    results = {}
+    for module in args.modules:
+        try:
+            runs = [import_times(module, args.preload) for _ in range(args.repeat)]
+        except RuntimeError as error:
+            print(f"{module}: failed, {error}")
+            continue
+        total = statistics.median(run[0] for run in runs)
+        # Slowest modules, from the run closest to the median.
+        _, children = min(runs, key=lambda run: abs(run[0] - total))
+        slowest = sorted(children.items(), key=lambda item: -item[1])[:args.top]
+        results[module] = {'total_ms': total / 1000,
+                           'slowest_ms': {name: time / 1000 for name, time in slowest}}
+        print(f"{module}: {total / 1000:.1f}ms")
+        for name, time in slowest:
+            print(f"    {name:<40} {time / 1000:7.1f}ms")
+    if args.json is not None:
+        args.json.write_text(json.dumps({'preload': args.preload, 'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()